@@ -0,0 +1,5 @@
+"""
+@@Synthetic checkpoints and planted face images
+@@End to end cascade benchmark sweeps
+@@Machine readable baselines and regression diff
+"""
@@ -0,0 +1,190 @@
+"""
+End to end benchmark of JDAPDetector
+@@Sweep image size, min_face_size, scale_factor, thresholds and batch sizes
+@@Images/sec and per stage latency percentiles from Telemetry records
+@@Baseline JSON of a run, diffed against an earlier baseline to catch regressions
+Usage:
+    python -m benchmark.cascade_benchmark --output baseline.json
+    python -m benchmark.cascade_benchmark --output current.json --compare baseline.json
+"""
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+from benchmark.synthetic import NETS, SYNTHETIC_EPOCH, make_checkpoint, planted_images
+from demo.detector import Detector
+from demo.fcn_detector import FcnDetector
+from demo.jdap_detect import JDAPDetector
+from demo.telemetry import Telemetry
+from tools.detections import unpack_result
+from tools.utils import IoU
+
+FLAGS = tf.flags.FLAGS
+
+# Telemetry times reported, a stage an image never reached counts 0
+STAGES = ['total', 'pnet', 'pnet/pyramid', 'pnet/net', 'pnet/post', 'rnet', 'rnet/crop', 'rnet/net',
+          'onet', 'onet/crop', 'onet/net']
+# Candidates left after every stage
+COUNTS = ['pnet/merge_nms', 'rnet/nms', 'onet/nms']
+PERCENTILES = [50, 90, 99]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='JDAP cascade benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--work_dir', dest='work_dir', help='folder of synthetic checkpoints',
+                        default='/tmp/jdap_benchmark', type=str)
+    parser.add_argument('--prefix', dest='prefix', help='trained pnet, rnet and onet prefix, synthetic if not set',
+                        nargs="+", default=None, type=str)
+    parser.add_argument('--epoch', dest='epoch', help='epoch of trained models', nargs="+",
+                        default=[13, 16, 16], type=int)
+    parser.add_argument('--rnet', dest='rnet', help='second stage net', default='rnet', choices=['rnet', 'mnet'])
+    parser.add_argument('--onet', dest='onet', help='third stage net', default='onet',
+                        choices=[x for x in NETS.keys() if x.startswith('onet')])
+    # 48Net landmark variants add a mean shape of landmark_num points
+    parser.add_argument('--landmark_num', dest='landmark_num', help='landmark points of the onet', default=68,
+                        type=int)
+    parser.add_argument('--image_size', dest='image_size', help='WxH list', nargs="+", default=['640x480'], type=str)
+    parser.add_argument('--min_face', dest='min_face', help='min_face_size list', nargs="+", default=[24], type=int)
+    parser.add_argument('--scale_factor', dest='scale_factor', help='scale_factor list', nargs="+",
+                        default=[0.709], type=float)
+    parser.add_argument('--thresh', dest='thresh', help='pnet,rnet,onet threshold list', nargs="+",
+                        default=['0.6,0.7,0.7'], type=str)
+    parser.add_argument('--batch_size', dest='batch_size', help='rnet,onet batch size list', nargs="+",
+                        default=['256,16'], type=str)
+    parser.add_argument('--image_num', dest='image_num', help='images per config', default=20, type=int)
+    parser.add_argument('--face_num', dest='face_num', help='planted faces per image', default=5, type=int)
+    parser.add_argument('--output', dest='output', help='baseline json to write', default='', type=str)
+    parser.add_argument('--compare', dest='compare', help='earlier baseline json to diff with', default='', type=str)
+    parser.add_argument('--tolerance', dest='tolerance', help='relative slowdown reported as regression',
+                        default=0.1, type=float)
+    args = parser.parse_args()
+    return args
+
+
+def load_detectors(args):
+    """ pnet, rnet and onet detectors, aux_idx of the onet """
+    names = ['pnet', args.rnet, args.onet]
+    if args.prefix:
+        model_path = ['%s-%s' % (x, y) for x, y in zip(args.prefix, args.epoch)]
+    else:
+        model_path = ['%s-%s' % (make_checkpoint(x, args.work_dir), SYNTHETIC_EPOCH) for x in names]
+    pnet = FcnDetector(NETS['pnet'][0], model_path[0])
+    rnet = Detector(NETS[args.rnet][0], NETS[args.rnet][1], 256, model_path[1])
+    net_factory, data_size, aux_idx = NETS[args.onet]
+    onet = Detector(net_factory, data_size, 16, model_path[2], aux_idx)
+    return [pnet, rnet, onet], aux_idx
+
+
+def sweep_configs(args):
+    for size, min_face, scale_factor, thresh, batch_size in itertools.product(
+            args.image_size, args.min_face, args.scale_factor, args.thresh, args.batch_size):
+        width, height = [int(x) for x in size.split('x')]
+        config = OrderedDict([('width', width), ('height', height), ('min_face_size', min_face),
+                              ('scale_factor', scale_factor), ('thresh', [float(x) for x in thresh.split(',')]),
+                              ('batch_size', [int(x) for x in batch_size.split(',')])])
+        yield config
+
+
+def config_key(config):
+    return '%dx%d min%d sf%g th%s bs%s' % (config['width'], config['height'], config['min_face_size'],
+                                           config['scale_factor'], ','.join('%g' % x for x in config['thresh']),
+                                           ','.join('%d' % x for x in config['batch_size']))
+
+
+def _recall(result, gt_boxes, iou_thresh=0.5):
+    boxes = unpack_result(result)[0]
+    if len(boxes) == 0:
+        return 0
+    return sum([IoU(gt, boxes).max() >= iou_thresh for gt in gt_boxes])
+
+
+def run_config(detectors, aux_idx, config, images):
+    """ Detect every image with a telemetry record, summary of the records """
+    detectors[1].batch_size, detectors[2].batch_size = config['batch_size']
+    jdap = JDAPDetector(detectors, min_face_size=config['min_face_size'], threshold=config['thresh'],
+                        scale_factor=config['scale_factor'])
+    # Warm up kernels and memoized plans of this image size
+    jdap.detect(images[0][0], aux_idx)
+    records = list()
+    found, planted = 0, 0
+    start = time.time()
+    for image, gt_boxes in images:
+        telemetry = Telemetry()
+        result = jdap.detect(image, aux_idx, telemetry)
+        records.append(telemetry)
+        found += _recall(result, gt_boxes)
+        planted += len(gt_boxes)
+    cost = time.time() - start
+
+    stages = OrderedDict()
+    for stage in STAGES:
+        values = [t.times.get(stage, 0.0) * 1000 for t in records]
+        stages[stage] = OrderedDict([('p%d' % q, float(np.percentile(values, q))) for q in PERCENTILES])
+    counts = OrderedDict([(name, float(np.mean([t.counts.get(name, 0) for t in records]))) for name in COUNTS])
+    return OrderedDict([('key', config_key(config)), ('config', config),
+                        ('images_per_sec', len(images) / cost), ('stage_ms', stages),
+                        ('candidates', counts), ('recall', float(found) / max(planted, 1))])
+
+
+def compare(results, baseline, tolerance):
+    """ Print throughput and p50 latency changes of configs in both runs, returns regression number """
+    old = dict([(r['key'], r) for r in baseline['results']])
+    regressions = 0
+    print('%-48s %10s %10s %8s %10s %10s %8s' % ('config', 'old img/s', 'new img/s', 'change',
+                                                 'old p50ms', 'new p50ms', 'change'))
+    for result in results:
+        if result['key'] not in old:
+            print('%-48s new config' % result['key'])
+            continue
+        base = old[result['key']]
+        speed_change = result['images_per_sec'] / base['images_per_sec'] - 1
+        old_p50, new_p50 = base['stage_ms']['total']['p50'], result['stage_ms']['total']['p50']
+        latency_change = new_p50 / max(old_p50, 1e-6) - 1
+        regressed = speed_change < -tolerance or latency_change > tolerance
+        regressions += regressed
+        print('%-48s %10.2f %10.2f %+7.1f%% %10.2f %10.2f %+7.1f%%%s' % (
+            result['key'], base['images_per_sec'], result['images_per_sec'], speed_change * 100,
+            old_p50, new_p50, latency_change * 100, '  REGRESSION' if regressed else ''))
+        for stage in STAGES[1:]:
+            old_stage, new_stage = base['stage_ms'][stage]['p50'], result['stage_ms'][stage]['p50']
+            if new_stage > old_stage * (1 + tolerance) and new_stage - old_stage > 0.5:
+                print('%-48s   %s p50 %.2f -> %.2f ms' % ('', stage, old_stage, new_stage))
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    FLAGS.landmark_num = args.landmark_num
+    detectors, aux_idx = load_detectors(args)
+    results = list()
+    image_cache = dict()
+    for config in sweep_configs(args):
+        size = (config['height'], config['width'])
+        if size not in image_cache:
+            image_cache[size] = planted_images(args.image_num, config['height'], config['width'], args.face_num)
+        result = run_config(detectors, aux_idx, config, image_cache[size])
+        stage_ms = result['stage_ms']
+        print('%-48s %8.2f img/s  total p50 %.2f p90 %.2f p99 %.2f ms  pnet %.2f rnet %.2f onet %.2f ms' % (
+            result['key'], result['images_per_sec'], stage_ms['total']['p50'], stage_ms['total']['p90'],
+            stage_ms['total']['p99'], stage_ms['pnet']['p50'], stage_ms['rnet']['p50'], stage_ms['onet']['p50']))
+        results.append(result)
+
+    if args.output:
+        meta = OrderedDict([('time', time.strftime('%Y-%m-%d %H:%M:%S')), ('python', platform.python_version()),
+                            ('tensorflow', tf.__version__), ('machine', platform.machine()),
+                            ('models', 'trained' if args.prefix else 'synthetic'),
+                            ('nets', ['pnet', args.rnet, args.onet]), ('image_num', args.image_num),
+                            ('face_num', args.face_num)])
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('meta', meta), ('results', results)]), f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
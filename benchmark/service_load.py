@@ -0,0 +1,153 @@
+"""
+Load generator of demo/detect_service.py
+@@Closed loop clients, each posts the next jpg as soon as its last answer is back
+@@Throughput, shed rate and client latency percentiles per concurrency level
+@@Server side queue and detect time from /metrics after every level
+Usage:
+    python demo/detect_service.py --port 8080 --prefix <pnet> <rnet> <onet> &
+    python -m benchmark.service_load --port 8080 --concurrency 1 2 4 8 16
+"""
+import argparse
+import json
+import socket
+import threading
+import time
+from collections import OrderedDict
+import cv2
+import numpy as np
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+from tools.runtime_benchmark import synthetic_images
+
+PERCENTILES = [50, 90, 99]
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """ HTTP over a Unix socket, host is only sent in the Host header """
+    def __init__(self, path, timeout=60):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Throughput and latency of the detection service',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', dest='host', help='service address', default='127.0.0.1', type=str)
+    parser.add_argument('--port', dest='port', help='service port', default=8080, type=int)
+    parser.add_argument('--unix_socket', dest='unix_socket', help='service Unix socket instead of a port',
+                        default=None, type=str)
+    parser.add_argument('--concurrency', dest='concurrency', help='client threads list', nargs="+",
+                        default=[1, 2, 4, 8, 16], type=int)
+    parser.add_argument('--duration', dest='duration', help='seconds per concurrency level', default=10.0, type=float)
+    parser.add_argument('--image_num', dest='image_num', help='distinct images posted in turn', default=20, type=int)
+    parser.add_argument('--width', dest='width', help='synthetic image width', default=640, type=int)
+    parser.add_argument('--height', dest='height', help='synthetic image height', default=480, type=int)
+    parser.add_argument('--retry_wait', dest='retry_wait', help='seconds a client waits after a shed request',
+                        default=0.05, type=float)
+    parser.add_argument('--output', dest='output', help='json of all levels to write', default='', type=str)
+    args = parser.parse_args()
+    return args
+
+
+def connect(args):
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket)
+    return HTTPConnection(args.host, args.port, timeout=60)
+
+
+def request(conn, method, path, body=None):
+    """ status and decoded json body """
+    conn.request(method, path, body, {'Content-Type': 'application/octet-stream'} if body else {})
+    response = conn.getresponse()
+    return response.status, json.loads(response.read().decode('utf-8'))
+
+
+def client(args, bodies, offset, stop_time, records):
+    """ Post images until stop_time, (status, seconds) of every request """
+    conn = connect(args)
+    k = offset
+    while time.time() < stop_time:
+        start = time.time()
+        try:
+            status, _ = request(conn, 'POST', '/detect', bodies[k % len(bodies)])
+        except Exception:
+            # Broken connection counts as an error, reconnect
+            conn.close()
+            conn = connect(args)
+            status = -1
+        records.append((status, time.time() - start))
+        if status != 200:
+            time.sleep(args.retry_wait)
+        k += 1
+    conn.close()
+
+
+def server_stats(args):
+    """ /metrics and its service rows by name """
+    conn = connect(args)
+    _, metrics = request(conn, 'GET', '/metrics')
+    conn.close()
+    stats = dict([(row['name'], row) for row in metrics['stats'] if row['tag'] == 'service'])
+    return metrics, stats
+
+
+def run_level(args, bodies, concurrency):
+    records = list()
+    stop_time = time.time() + args.duration
+    threads = [threading.Thread(target=client, args=(args, bodies, k, stop_time, records))
+               for k in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cost = time.time() - start
+
+    ok = [t * 1000 for status, t in records if status == 200]
+    shed = sum([status == 503 for status, _ in records])
+    errors = len(records) - len(ok) - shed
+    result = OrderedDict([('concurrency', concurrency), ('requests', len(records)),
+                          ('images_per_sec', len(ok) / cost), ('shed_rate', float(shed) / max(len(records), 1)),
+                          ('errors', errors)])
+    result['latency_ms'] = OrderedDict([('p%d' % q, float(np.percentile(ok, q)) if ok else 0.0)
+                                        for q in PERCENTILES])
+    return result
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    bodies = [cv2.imencode('.jpg', image)[1].tobytes()
+              for image in synthetic_images(args.image_num, args.width, args.height)]
+    # Warm up the service at this image size
+    conn = connect(args)
+    request(conn, 'POST', '/detect', bodies[0])
+    conn.close()
+
+    results = list()
+    print('%6s %10s %8s %8s %10s %10s %10s %12s %12s %8s' % (
+        'conc', 'img/s', 'shed', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'srv queue', 'srv detect', 'batch'))
+    for concurrency in args.concurrency:
+        result = run_level(args, bodies, concurrency)
+        # Server histograms are cumulative, a rough view of the levels so far
+        metrics, stats = server_stats(args)
+        result['server'] = OrderedDict([('queue_p50_ms', stats['queue']['p50'] if 'queue' in stats else 0.0),
+                                        ('detect_p50_ms', stats['detect']['p50'] if 'detect' in stats else 0.0),
+                                        ('batch_mean', stats['batch_size']['mean'] if 'batch_size' in stats else 0.0),
+                                        ('queue_depth', metrics['queue_depth'])])
+        latency, server = result['latency_ms'], result['server']
+        print('%6d %10.2f %7.1f%% %8d %10.2f %10.2f %10.2f %12.2f %12.2f %8.2f' % (
+            concurrency, result['images_per_sec'], result['shed_rate'] * 100, result['errors'], latency['p50'],
+            latency['p90'], latency['p99'], server['queue_p50_ms'], server['detect_p50_ms'], server['batch_mean']))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('width', args.width), ('height', args.height), ('results', results)]), f,
+                      indent=2)
@@ -0,0 +1,97 @@
+"""
+Synthetic models and images of the cascade benchmark
+@@Randomly initialized checkpoints with the same variables as trained ones
+@@Noise images with planted face patterns of known boxes
+"""
+import os
+from collections import OrderedDict
+import cv2
+import numpy as np
+import tensorflow as tf
+from nets.JDAP_Net import JDAP_12Net_wo_pooling, JDAP_24Net, JDAP_24Net_ERC, JDAP_mNet_normal, JDAP_48Net
+from nets.JDAP_Net import JDAP_48Net_Landmark_Mean_Shape, JDAP_48Net_Pose, JDAP_48Net_Landmark_Pose_Mean_Shape
+
+# name -> (net factory, input size, aux_idx), pnet is fully convolutional
+NETS = OrderedDict([
+    ('pnet', (JDAP_12Net_wo_pooling, 12, 0)),
+    ('rnet', (JDAP_24Net, 24, 0)),
+    ('rnet_erc', (JDAP_24Net_ERC, 24, 4)),
+    ('mnet', (JDAP_mNet_normal, 18, 0)),
+    ('onet', (JDAP_48Net, 48, 0)),
+    ('onet_landmark', (JDAP_48Net_Landmark_Mean_Shape, 48, 1)),
+    ('onet_pose', (JDAP_48Net_Pose, 48, 2)),
+    ('onet_landmark_pose', (JDAP_48Net_Landmark_Pose_Mean_Shape, 48, 3)),
+])
+# Synthetic checkpoints are saved as <save_dir>/<name>-<SYNTHETIC_EPOCH>
+SYNTHETIC_EPOCH = 0
+
+
+def make_checkpoint(name, save_dir, seed=0):
+    """ Save randomly initialized weights of one net, kept if already there
+    Args:
+        name: Key of NETS
+        save_dir: Checkpoint folder
+        seed: Graph level random seed of the initializers
+
+    Returns:
+        prefix of the checkpoint, model path is '%s-%s' % (prefix, SYNTHETIC_EPOCH)
+    """
+    net_factory, data_size, _ = NETS[name]
+    prefix = os.path.join(save_dir, name)
+    if tf.train.checkpoint_exists('%s-%s' % (prefix, SYNTHETIC_EPOCH)):
+        return prefix
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    with tf.Graph().as_default():
+        tf.set_random_seed(seed)
+        image_op = tf.placeholder(tf.float32, shape=[None, data_size, data_size, 3])
+        net_factory(image_op, is_training=False)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            tf.train.Saver().save(sess, prefix, global_step=SYNTHETIC_EPOCH)
+    return prefix
+
+
+def _draw_face(image, x1, y1, side, rng):
+    """ Skin colored ellipse with darker eyes and mouth, roughly what a 12 x 12 pnet window sees """
+    cx, cy = x1 + side // 2, y1 + side // 2
+    skin = tuple(int(c) for c in rng.randint(80, 220) * np.array([0.75, 0.85, 1.0]))
+    cv2.ellipse(image, (cx, cy), (max(side * 2 // 5, 1), max(side // 2, 1)), 0, 0, 360, skin, -1)
+    dark = tuple(int(c * 0.3) for c in skin)
+    eye_r = max(side // 12, 1)
+    for ex in [x1 + side * 3 // 10, x1 + side * 7 // 10]:
+        cv2.circle(image, (ex, y1 + side * 2 // 5), eye_r, dark, -1)
+    cv2.line(image, (x1 + side * 3 // 8, y1 + side * 3 // 4), (x1 + side * 5 // 8, y1 + side * 3 // 4),
+             dark, max(side // 20, 1))
+
+
+def planted_image(height, width, face_num=5, min_face=24, max_face=None, seed=0):
+    """ Smoothed noise background with face_num planted faces
+    Args:
+        height, width: Image size
+        face_num: Planted faces
+        min_face, max_face: Face side range, sampled log uniform, max_face is min(height, width) / 2 if None
+
+    Returns:
+        image: height x width x 3 uint8
+        boxes: face_num x 4, x1 y1 x2 y2
+    """
+    rng = np.random.RandomState(seed)
+    coarse = rng.randint(0, 256, (max(height // 16, 1), max(width // 16, 1), 3)).astype(np.uint8)
+    image = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_LINEAR)
+    image = np.clip(image + rng.randn(height, width, 3) * 8, 0, 255).astype(np.uint8)
+    max_face = max_face or min(height, width) // 2
+    max_face = max(min(max_face, height, width), min_face)
+    boxes = list()
+    for _ in range(face_num):
+        side = int(np.exp(rng.uniform(np.log(min_face), np.log(max_face))))
+        x1 = rng.randint(0, width - side + 1)
+        y1 = rng.randint(0, height - side + 1)
+        _draw_face(image, x1, y1, side, rng)
+        boxes.append([x1, y1, x1 + side - 1, y1 + side - 1])
+    return image, np.array(boxes, dtype=np.float32).reshape(-1, 4)
+
+
+def planted_images(num, height, width, face_num=5, min_face=24, max_face=None, seed=0):
+    """ num planted images, list of (image, boxes) """
+    return [planted_image(height, width, face_num, min_face, max_face, seed + k) for k in range(num)]
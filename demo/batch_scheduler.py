@@ -0,0 +1,123 @@
+import threading
+import time
+import numpy as np
+
+
+class _Request(object):
+    def __init__(self, databatch):
+        self.databatch = databatch
+        self.arrive_time = time.time()
+        self.done = threading.Event()
+        self.outputs = None
+        self.error = None
+
+
+class BatchScheduler(object):
+    def __init__(self, detector, max_wait=0.005, batch_size=None):
+        """
+        Micro batching in front of a Detector, same predict interface.
+        Crops of concurrent predict calls (one per image) are concatenated and run
+        as one Detector.predict, outputs are sliced back to every caller.
+        Args:
+            detector: Detector of rnet or onet
+            max_wait: Seconds the oldest waiting crops may wait for a fuller batch
+            batch_size: Rows that trigger a run at once, detector.batch_size by default
+        """
+        self.detector = detector
+        self.data_size = detector.data_size
+        self.batch_size = batch_size or detector.batch_size
+        self.max_wait = max_wait
+        # Early reject classifier returns rows of survivors and their index
+        self._aux_idx = detector._aux_idx
+        self._cond = threading.Condition()
+        self._pending = list()
+        self._pending_rows = 0
+        self._closed = False
+        # Utilization counters
+        self.run_num = 0
+        self.request_num = 0
+        self.row_num = 0
+        self.padded_row_num = 0
+        self._thread = threading.Thread(target=self._dispatch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def predict(self, databatch):
+        if databatch.shape[0] == 0:
+            return self.detector.predict(databatch)
+        request = _Request(databatch)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is closed.")
+            self._pending.append(request)
+            self._pending_rows += databatch.shape[0]
+            self._cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.outputs
+
+    def padded_rows(self, num):
+        return self.detector.padded_rows(num)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def stats(self):
+        """Mean requests and rows of one Detector.predict, fill is real rows over rows run with padding"""
+        runs = max(self.run_num, 1)
+        return {'runs': self.run_num,
+                'requests_per_run': float(self.request_num) / runs,
+                'rows_per_run': float(self.row_num) / runs,
+                'fill': float(self.row_num) / max(self.padded_row_num, 1)}
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                deadline = self._pending[0].arrive_time + self.max_wait
+                while self._pending_rows < self.batch_size and not self._closed:
+                    remain = deadline - time.time()
+                    if remain <= 0:
+                        break
+                    self._cond.wait(remain)
+                requests = self._pending
+                self._pending = list()
+                self._pending_rows = 0
+            self._run(requests)
+
+    def _run(self, requests):
+        sizes = [r.databatch.shape[0] for r in requests]
+        try:
+            if len(requests) == 1:
+                databatch = requests[0].databatch
+            else:
+                databatch = np.concatenate([r.databatch for r in requests], axis=0)
+            outputs = self.detector.predict(databatch)
+        except Exception as e:
+            for r in requests:
+                r.error = e
+                r.done.set()
+            return
+        self.run_num += 1
+        self.request_num += len(requests)
+        self.row_num += databatch.shape[0]
+        self.padded_row_num += self.detector.padded_rows(databatch.shape[0])
+
+        starts = np.cumsum([0] + sizes)
+        for k, r in enumerate(requests):
+            begin, end = starts[k], starts[k + 1]
+            if self._aux_idx == 4:
+                # Rows are survivors only, keep the ones of this request by their index
+                cls_prob, bbox_pred, last_index = outputs
+                mask = (last_index >= begin) & (last_index < end)
+                r.outputs = (cls_prob[mask], bbox_pred[mask], last_index[mask] - begin)
+            else:
+                r.outputs = tuple([o[begin:end] if len(o) else o for o in outputs])
+            r.done.set()
@@ -1,5 +1,9 @@
 # _*_ coding: utf-8 _*_
 import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
 
 import numpy as np
 import cv2
@@ -21,66 +25,279 @@ from nets.JDAP_Net import JDAP_aNet_Cls as A_Cls_Net
 from fcn_detector import FcnDetector
 from jdap_detect import JDAPDetector
 from detector import Detector
+from batch_scheduler import BatchScheduler
+from runtime import Runtime
+from tools.detections import Detections, unpack_result
 import tensorflow as tf
 
 
 class DetectAPI(object):
-    def __init__(self, prefix, epoch, test_mode, batch_size, is_ERC, thresh, min_face_size):
+    def __init__(self, prefix, epoch, test_mode, batch_size, is_ERC, thresh, min_face_size, is_mosaic=False,
+                 incremental_pyramid=False, max_face_size=None, coarse_to_fine=False, micro_batch_wait=None,
+                 dynamic_batch=False, bucket_batch=False, frozen=False, shared_session=False, intra_op_threads=0,
+                 inter_op_threads=0, telemetry_sink=None, pnet_memory_limit=None, tile_workers=1,
+                 pnet_on_graph=False, size_buckets=False, warmup_resolutions=None, buffer_arena=True,
+                 as_detections=False):
         # To do compare experiments
         self.fix_param = [test_mode, batch_size, is_ERC, thresh, min_face_size]
+        self.is_mosaic = is_mosaic
+        self.incremental_pyramid = incremental_pyramid
+        self.max_face_size = max_face_size
+        self.coarse_to_fine = coarse_to_fine
+        # Seconds rnet and onet crops of concurrent images wait for a fuller batch, None disables
+        self.micro_batch_wait = micro_batch_wait
+        # Exact size rnet and onet batches, optionally padded to power of two buckets
+        self.batch_mode = dict(dynamic_batch=dynamic_batch, bucket_batch=bucket_batch)
+        # Load <prefix>-<epoch>.pb exported by tools/freeze_graph.py instead of checkpoints
+        self.frozen = frozen
+        # One graph and session for all nets, or one per net as before
+        self.shared_session = shared_session
+        self.runtime_param = dict(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+        self._shared_runtime = None
+        # TelemetrySink collecting a record of every detect call, None disables
+        self.telemetry_sink = telemetry_sink
+        # PNet tile working set in bytes (float buffers of PNet passes, not the image or uint8 pyramid),
+        # larger pyramid levels run in tiles, tile_workers at a time,
+        # and level threshold and nms in the pnet graph
+        self.pnet_param = dict(pnet_memory_limit=pnet_memory_limit, tile_workers=tile_workers,
+                               pnet_on_graph=pnet_on_graph)
+        # Reuse pyramid, crop and minibatch buffers, see tools/arena.py
+        self.buffer_arena = buffer_arena
+        # detect results as tools.detections.Detections instead of an array or tuple per aux_idx
+        self.as_detections = as_detections
+        # PNet inputs padded to a few bucket shapes, (width, height) list detected once at load and
+        # reload so their shapes are set up before real frames, warmup_report has the cold and warm times
+        self.size_buckets = size_buckets
+        self.warmup_resolutions = warmup_resolutions
+        self.warmup_report = None
+        # Detect calls running per model generation, reset_model releases a generation at 0
+        self._model_cond = threading.Condition()
+        self._generation = 0
+        self._in_flight = dict()
+        # Release of an old generation still in use after the reset_model timeout, run by its last call
+        self._pending_release = dict()
+        self._reload_lock = threading.Lock()
+        # Exception of the last background reset_model, None if it succeeded
+        self.reload_error = None
         self.jdap_detector = self._init_model(prefix, epoch)
+        if warmup_resolutions:
+            self.warmup_report = self.jdap_detector.warmup(warmup_resolutions, self.aux_idx)
 
-    # TODO:Loading new model, other no change
-    def reset_model(self, prefix, epoch):
-        # load new model
-        # replace self.jdap_detector
-        pass
+    def reset_model(self, prefix, epoch, block=True, warmup_image=None, release_timeout=60.):
+        """
+        Hot reload of the stages whose <prefix>-<epoch> changed, detection goes on meanwhile.
+        New stages are loaded and warmed up aside, then swapped in at once. Detect calls already
+        running, streams and videos included, finish on the old models, whose sessions are closed after.
+        A stream or video is done when exhausted or closed, close() the ones left early.
+        With shared_session all stages are reloaded into a new session, one graph can not drop a net.
+        Args:
+            prefix, epoch: Same as the constructor
+            block: Wait for the swap and release, or run them in a background thread
+            warmup_image: Image of the warmup detect, noise of every warmup_resolutions or 640 x 480 if None
+            release_timeout: Seconds to wait for calls on the old models, None waits forever. On timeout the
+                new models serve already, the old ones are released by their last call and RuntimeError is raised
+        Returns:
+            the background thread if not block
+        """
+        if not block:
+            thread = threading.Thread(target=self._reload_background,
+                                      args=(prefix, epoch, warmup_image, release_timeout))
+            thread.daemon = True
+            thread.start()
+            return thread
+        with self._reload_lock:
+            model_path = self._model_paths(prefix, epoch)
+            old = self.jdap_detector
+            old_detectors = [old.pnet_detector, old.rnet_detector, old.onet_detector]
+            changed = [k for k in range(3) if old_detectors[k] is not None and model_path[k] != self.model_path[k]]
+            if not changed:
+                return
+            if self.shared_session:
+                # Any change reloads every stage
+                changed = [k for k in range(3) if old_detectors[k] is not None]
+                old_runtime, self._shared_runtime = self._shared_runtime, None
+            detectors = list(old_detectors)
+            try:
+                for k in changed:
+                    detectors[k] = self._load_stage(k, model_path[k])
+                jdap_detector = self._build_detector(detectors)
+                if warmup_image is not None:
+                    jdap_detector.detect(warmup_image, self.aux_idx)
+                else:
+                    jdap_detector.warmup(self.warmup_resolutions or [(640, 480)], self.aux_idx, repeat=0)
+            except Exception:
+                # Drop what was loaded, the old models stay
+                self._release([detectors[k] for k in changed if detectors[k] is not old_detectors[k]],
+                              self._shared_runtime)
+                if self.shared_session:
+                    self._shared_runtime = old_runtime
+                raise
+
+            release = partial(self._release, [old_detectors[k] for k in changed],
+                              old_runtime if self.shared_session else None)
+            with self._model_cond:
+                old_generation = self._generation
+                self.jdap_detector = jdap_detector
+                self.model_path = model_path
+                self._generation += 1
+                deadline = None if release_timeout is None else time.time() + release_timeout
+                while self._in_flight.get(old_generation, 0):
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self._pending_release[old_generation] = release
+                        raise RuntimeError('%d detect calls, streams or videos still use the old models after %gs, '
+                                           'they are released when those end' %
+                                           (self._in_flight[old_generation], release_timeout))
+                    self._model_cond.wait(remaining)
+            release()
+
+    def _release(self, detectors, shared_runtime=None):
+        """ Stop batch schedulers and close sessions of detectors, or of their shared runtime """
+        for detector in detectors:
+            if detector is None:
+                continue
+            if isinstance(detector, BatchScheduler):
+                detector.close()
+            if not self.shared_session:
+                getattr(detector, 'detector', detector).runtime.close()
+        if shared_runtime is not None:
+            shared_runtime.close()
+
+    def _reload_background(self, prefix, epoch, warmup_image, release_timeout):
+        try:
+            self.reset_model(prefix, epoch, warmup_image=warmup_image, release_timeout=release_timeout)
+            self.reload_error = None
+        except Exception as e:
+            # Old models keep serving
+            self.reload_error = e
+
+    @contextmanager
+    def _using_model(self):
+        """ Current JDAPDetector, its models are not released before the block ends """
+        jdap_detector, generation = self._hold_model()
+        try:
+            yield jdap_detector
+        finally:
+            self._drop_model(generation)
+
+    def _hold_model(self):
+        """ Current JDAPDetector and its generation, held until _drop_model of the generation """
+        with self._model_cond:
+            generation = self._generation
+            self._in_flight[generation] = self._in_flight.get(generation, 0) + 1
+            return self.jdap_detector, generation
+
+    def _drop_model(self, generation):
+        with self._model_cond:
+            self._in_flight[generation] -= 1
+            if self._in_flight[generation]:
+                return
+            del self._in_flight[generation]
+            self._model_cond.notify_all()
+            release = self._pending_release.pop(generation, None)
+        # Old models reset_model stopped waiting for
+        if release is not None:
+            release()
+
+    def _runtime(self):
+        if not self.shared_session:
+            return Runtime(**self.runtime_param)
+        if self._shared_runtime is None:
+            self._shared_runtime = Runtime(**self.runtime_param)
+        return self._shared_runtime
+
+    def _model_paths(self, prefix, epoch):
+        model_path = ['%s-%s' % (x, y) for x, y in zip(prefix, epoch)]
+        if self.frozen:
+            model_path = [x + '.pb' for x in model_path]
+        return model_path
 
     def _init_model(self, prefix, epoch):
+        self.aux_idx = self._result_aux_idx()
+        self.model_path = self._model_paths(prefix, epoch)
+        detectors = [self._load_stage(k, x) for k, x in enumerate(self.model_path)]
+        return self._build_detector(detectors)
+
+    def _result_aux_idx(self):
+        """ aux_idx of the onet head, what detect results hold. ERC only sets the rnet Detector's own
+        aux_idx, rnet results are boxes as with a plain rnet.
+        """
+        test_mode = self.fix_param[0]
+        if "onet" in test_mode:
+            if 'landmark_pose' in test_mode:
+                return 3
+            elif 'landmark' in test_mode:
+                return 1
+            elif 'pose' in test_mode:
+                return 2
+        return 0
+
+    def _load_stage(self, stage, model_path):
+        """ Detector of stage 0, 1 or 2 (pnet, rnet, onet), None if test_mode stops earlier """
         test_mode, batch_size, is_ERC, thresh, min_face_size = self.fix_param
         # load pnet model
-        detectors = [None, None, None]
-        model_path = ['%s-%s' % (x, y) for x, y in zip(prefix, epoch)]
-        PNet = FcnDetector(P_Net, model_path[0])
-        detectors[0] = PNet
-        self.aux_idx = 0
+        if stage == 0:
+            return FcnDetector(P_Net, model_path, runtime=self._runtime(), size_buckets=self.size_buckets)
         # load rnet model
-        if "onet" in test_mode or "rnet" in test_mode:
+        if stage == 1:
+            if not ("onet" in test_mode or "rnet" in test_mode):
+                return None
             if is_ERC:
-                self.aux_idx = 4
-                RNet = Detector(R_Net_ERC, 24, batch_size[1], model_path[1], self.aux_idx)
+                RNet = Detector(R_Net_ERC, 24, batch_size[1], model_path, 4, runtime=self._runtime(),
+                                **self.batch_mode)
             else:
-                #RNet = Detector(M_Net, 18, batch_size[1], model_path[1])
-                RNet = Detector(R_Net, 24, batch_size[1], model_path[1])
-            detectors[1] = RNet
+                #RNet = Detector(M_Net, 18, batch_size[1], model_path)
+                RNet = Detector(R_Net, 24, batch_size[1], model_path, runtime=self._runtime(), **self.batch_mode)
+            return self._schedule(RNet)
 
         # load onet model
-        if "onet" in test_mode:
-            if 'landmark_pose' in test_mode:
-                self.aux_idx = 3
-                #ONet = Detector(JDAP_48Net_Landmark_Pose_Dynamic_Shape, 48, batch_size[2], model_path[2], self.aux_idx)
-                ONet = Detector(JDAP_48Net_Landmark_Pose_Mean_Shape, 48, batch_size[2], model_path[2], self.aux_idx)
-                #ONet = Detector(O_AUX_Net, 48, batch_size[2], model_path[2], self.aux_idx)
-                #ONet = Detector(A_Net, 36, batch_size[2], model_path[2], self.aux_idx)
-            elif 'landmark' in test_mode:
-                self.aux_idx = 1
-                #ONet = Detector(JDAP_48Net_Landmark, 48, batch_size[2], model_path[2], self.aux_idx)
-                ONet = Detector(JDAP_48Net_Landmark_Mean_Shape, 48, batch_size[2], model_path[2], self.aux_idx)
-            elif 'pose' in test_mode:
-                self.aux_idx = 2
-                ONet = Detector(JDAP_48Net_Pose, 48, batch_size[2], model_path[2], self.aux_idx)
-                #ONet = Detector(JDAP_48Net_Pose_Branch, 48, batch_size[2], model_path[2], self.aux_idx)
-            else:
-                #ONet = Detector(A_Cls_Net, 36, batch_size[2], model_path[2])
-                ONet = Detector(O_Net, 48, batch_size[2], model_path[2])
+        if "onet" not in test_mode:
+            return None
+        if 'landmark_pose' in test_mode:
+            #ONet = Detector(JDAP_48Net_Landmark_Pose_Dynamic_Shape, 48, batch_size[2], model_path, 3)
+            ONet = Detector(JDAP_48Net_Landmark_Pose_Mean_Shape, 48, batch_size[2], model_path, 3,
+                            runtime=self._runtime(), **self.batch_mode)
+            #ONet = Detector(O_AUX_Net, 48, batch_size[2], model_path, 3)
+            #ONet = Detector(A_Net, 36, batch_size[2], model_path, 3)
+        elif 'landmark' in test_mode:
+            #ONet = Detector(JDAP_48Net_Landmark, 48, batch_size[2], model_path, 1)
+            ONet = Detector(JDAP_48Net_Landmark_Mean_Shape, 48, batch_size[2], model_path, 1,
+                            runtime=self._runtime(), **self.batch_mode)
+        elif 'pose' in test_mode:
+            ONet = Detector(JDAP_48Net_Pose, 48, batch_size[2], model_path, 2,
+                            runtime=self._runtime(), **self.batch_mode)
+            #ONet = Detector(JDAP_48Net_Pose_Branch, 48, batch_size[2], model_path, 2)
+        else:
+            #ONet = Detector(A_Cls_Net, 36, batch_size[2], model_path)
+            ONet = Detector(O_Net, 48, batch_size[2], model_path, runtime=self._runtime(), **self.batch_mode)
+        return self._schedule(ONet)
 
-            detectors[2] = ONet
+    def _schedule(self, detector):
+        if self.micro_batch_wait is None:
+            return detector
+        return BatchScheduler(detector, self.micro_batch_wait)
 
-        jdap_detector = JDAPDetector(detectors=detectors, is_ERC=False, min_face_size=min_face_size, threshold=thresh)
+    def _build_detector(self, detectors):
+        test_mode, batch_size, is_ERC, thresh, min_face_size = self.fix_param
+        jdap_detector = JDAPDetector(detectors=detectors, is_ERC=is_ERC, min_face_size=min_face_size, threshold=thresh,
+                                     is_mosaic=self.is_mosaic, incremental_pyramid=self.incremental_pyramid,
+                                     max_face_size=self.max_face_size, coarse_to_fine=self.coarse_to_fine,
+                                     concurrent_refine=self.micro_batch_wait is not None,
+                                     telemetry_sink=self.telemetry_sink, buffer_arena=self.buffer_arena,
+                                     **self.pnet_param)
         return jdap_detector
 
+    def erc_stats(self):
+        """Early reject rates and estimated saving of the ERC rnet, None without ERC"""
+        rnet = self.jdap_detector.rnet_detector
+        if not self.jdap_detector.is_ERC or rnet is None:
+            return None
+        # Behind a BatchScheduler
+        rnet = getattr(rnet, 'detector', rnet)
+        return rnet.erc_stats()
+
     def show_result(self, image, results, save_name='', is_cap=False):
-        cal_boxes = results[0] if type(results) is tuple else results
+        cal_boxes, pose_reg, landmark_reg = unpack_result(results)
         box_num = cal_boxes.shape[0]
 
         for i in range(box_num):
@@ -91,12 +308,12 @@ class DetectAPI(object):
             #self.draw_text(image, bbox, score)
             # Head pose
             if self.aux_idx == 3 or self.aux_idx == 2:
-                head_pose = results[1][i] * 180 / 3.14
+                head_pose = pose_reg[i] * 180 / 3.14
                 self.draw_text(image, bbox, head_pose)
 
             # Face landmark
             if self.aux_idx == 3 or self.aux_idx == 1:
-                land_point = np.round(results[-1][i]).astype(dtype=np.int32)
+                land_point = np.round(landmark_reg[i]).astype(dtype=np.int32)
                 self.draw_point(image, land_point, tf.app.flags.FLAGS.landmark_num)
                 # point_x = int(land_reg[i][land_id * 2] * proposal_side + src_boxes[i][0])
                 # point_y = int(land_reg[i][land_id * 2 + 1] * proposal_side + src_boxes[i][1])
@@ -135,8 +352,35 @@ class DetectAPI(object):
             # Draw center
             cv2.putText(image, s, ((rect[0]+rect[2])//2, (rect[1]+rect[3])//2), 1, 1, color)
 
-    def detect(self, image):
-        return self.jdap_detector.detect(image, self.aux_idx)
+    def detect(self, image, telemetry=None):
+        with self._using_model() as jdap_detector:
+            return self._result(jdap_detector, jdap_detector.detect(image, self.aux_idx, telemetry))
+
+    def detect_batch(self, images):
+        with self._using_model() as jdap_detector:
+            return [self._result(jdap_detector, x) for x in jdap_detector.detect_batch(images, self.aux_idx)]
+
+    def detect_stream(self, images, depth=4):
+        # The whole stream runs on the models it started with, held until it is exhausted or closed
+        jdap_detector, generation = self._hold_model()
+        try:
+            for result in jdap_detector.detect_stream(images, self.aux_idx, depth):
+                yield self._result(jdap_detector, result)
+        finally:
+            self._drop_model(generation)
+
+    def detect_video(self, frames, detect_interval=10):
+        jdap_detector, generation = self._hold_model()
+        try:
+            for img, result, ids, is_full in jdap_detector.detect_video(frames, self.aux_idx, detect_interval):
+                yield img, self._result(jdap_detector, result), ids, is_full
+        finally:
+            self._drop_model(generation)
+
+    def _result(self, jdap_detector, result):
+        if not self.as_detections:
+            return result
+        return Detections.from_result(result, self.aux_idx, jdap_detector.last_stage())
 
 
 def test_aux_net(name_list, dataset_path, prefix, epoch, batch_size, test_mode="rnet",
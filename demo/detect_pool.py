@@ -0,0 +1,209 @@
+"""
+Process pool of detectors for bulk jobs
+@@Every worker process loads its own DetectAPI models, optionally pinned to its own cores
+@@Images go to workers through a shared memory ring buffer of fixed size slots, not pickled
+@@Results come back in input order
+"""
+import multiprocessing
+import os
+import time
+import traceback
+import numpy as np
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+# Bytes of one ring buffer slot, a 1080p BGR frame, larger images are pickled through the task queue
+SLOT_BYTES = 1920 * 1080 * 3
+# Seconds between worker liveness checks while waiting for a result
+POLL_SECONDS = 1.0
+
+
+def _split_cores(workers):
+    """ Cores of every worker, None where the platform can not pin (no sched_setaffinity) """
+    if not hasattr(os, 'sched_getaffinity'):
+        return [None] * workers
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < workers:
+        return [None] * workers
+    per_worker = len(cores) // workers
+    return [cores[k * per_worker:(k + 1) * per_worker] for k in range(workers)]
+
+
+def _worker(worker_id, api_args, api_kwargs, cores, shared, slot_bytes, task_queue, result_queue):
+    """ Load models, then detect tasks until None """
+    try:
+        if cores is not None:
+            os.sched_setaffinity(0, cores)
+        from detectAPI import DetectAPI
+        detector = DetectAPI(*api_args, **api_kwargs)
+        ring = np.ctypeslib.as_array(shared)
+    except Exception:
+        result_queue.put(('error', worker_id, None, traceback.format_exc()))
+        return
+    result_queue.put(('ready', worker_id, detector.aux_idx, None))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        seq, slot, shape, image = task
+        try:
+            if image is None:
+                # View of the slot, the parent does not reuse it before the result is back
+                start = slot * slot_bytes
+                image = ring[start:start + int(np.prod(shape))].reshape(shape)
+            result_queue.put(('result', seq, slot, detector.detect(image)))
+        except Exception:
+            result_queue.put(('error', seq, slot, traceback.format_exc()))
+
+
+class DetectPool(object):
+    def __init__(self, *args, **kwargs):
+        """
+        Same arguments as DetectAPI, every worker builds DetectAPI(*args, **kwargs), and pool options:
+            workers: Worker processes, cpu count if None
+            slots: Images in flight, 2 per worker if None
+            slot_bytes: Max uint8 image bytes sent through shared memory
+            pin_cores: Pin every worker to its own share of the cores (linux), intra_op_threads
+                defaults to that share
+            result_timeout: Max seconds without any result (model loading included), None waits as long as
+                workers are alive. A dead worker or the timeout raises RuntimeError with the pending images
+        Workers are spawned where the platform supports it, so tensorflow state of this process
+        is never forked. Scripts using the pool need the usual __main__ guard.
+        """
+        workers = kwargs.pop('workers', None) or multiprocessing.cpu_count()
+        self.slots = kwargs.pop('slots', None) or 2 * workers
+        self.slot_bytes = kwargs.pop('slot_bytes', SLOT_BYTES)
+        pin_cores = kwargs.pop('pin_cores', True)
+        self.result_timeout = kwargs.pop('result_timeout', None)
+        if kwargs.get('telemetry_sink') is not None:
+            raise ValueError('telemetry_sink is not shared by worker processes')
+        ctx = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        self._shared = ctx.RawArray('B', self.slots * self.slot_bytes)
+        self._ring = np.ctypeslib.as_array(self._shared)
+        self._free_slots = list(range(self.slots))
+        self._task_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        self._seq = 0
+        self._in_flight = 0
+        # Seq of every image in flight
+        self._pending = set()
+        self._results = dict()
+        self._workers = list()
+        worker_cores = _split_cores(workers) if pin_cores else [None] * workers
+        for worker_id, cores in enumerate(worker_cores):
+            worker_kwargs = dict(kwargs)
+            if cores is not None:
+                worker_kwargs.setdefault('intra_op_threads', len(cores))
+            process = ctx.Process(target=_worker, args=(worker_id, args, worker_kwargs, cores, self._shared,
+                                                        self.slot_bytes, self._task_queue, self._result_queue))
+            process.daemon = True
+            process.start()
+            self._workers.append(process)
+        for _ in range(workers):
+            try:
+                kind, _, aux_idx, error = self._get_result()
+            except RuntimeError:
+                self.close()
+                raise
+            if kind == 'error':
+                self.close()
+                raise RuntimeError('Detect worker failed to load:\n' + error)
+            self.aux_idx = aux_idx
+
+    def _submit(self, image):
+        """ An image in flight, at most slots are, so a slot is always free here """
+        shape = image.shape
+        if image.dtype == np.uint8 and image.nbytes <= self.slot_bytes:
+            slot = self._free_slots.pop()
+            start = slot * self.slot_bytes
+            self._ring[start:start + image.nbytes] = image.reshape(-1)
+            self._task_queue.put((self._seq, slot, shape, None))
+        else:
+            self._task_queue.put((self._seq, -1, shape, image))
+        self._pending.add(self._seq)
+        self._seq += 1
+        self._in_flight += 1
+
+    def _get_result(self):
+        """ Next message of the result queue, polled so a dead worker or the timeout raises instead of hanging """
+        deadline = None if self.result_timeout is None else time.time() + self.result_timeout
+        while True:
+            try:
+                return self._result_queue.get(timeout=POLL_SECONDS)
+            except Empty:
+                pass
+            dead = ['%d (exit code %s)' % (worker_id, process.exitcode)
+                    for worker_id, process in enumerate(self._workers) if not process.is_alive()]
+            if dead:
+                raise RuntimeError('Detect workers %s died, pending images %s' %
+                                   (', '.join(dead), sorted(self._pending)))
+            if deadline is not None and time.time() > deadline:
+                raise RuntimeError('No detect result in %gs, pending images %s' %
+                                   (self.result_timeout, sorted(self._pending)))
+
+    def _collect(self):
+        """ Wait for one result, its slot is free again """
+        kind, seq, slot, result = self._get_result()
+        self._in_flight -= 1
+        self._pending.discard(seq)
+        if slot >= 0:
+            self._free_slots.append(slot)
+        if kind == 'error':
+            raise RuntimeError('Detect worker failed on image %d:\n%s' % (seq, result))
+        self._results[seq] = result
+
+    def imap(self, images):
+        """ Detect result of every image in input order, up to slots images in flight.
+        Images are read from the iterable only as slots free up.
+        """
+        # Results of an abandoned earlier imap are dropped
+        while self._in_flight:
+            self._collect()
+        self._results.clear()
+        next_seq = self._seq
+        images = iter(images)
+        exhausted = False
+        while True:
+            # Keep slots images in flight, pickled ones (too large) included
+            while not exhausted and self._in_flight < self.slots:
+                try:
+                    image = next(images)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self._submit(image)
+            if next_seq == self._seq and exhausted:
+                return
+            while next_seq not in self._results:
+                self._collect()
+            yield self._results.pop(next_seq)
+            next_seq += 1
+
+    def map(self, images):
+        return list(self.imap(images))
+
+    def detect(self, image):
+        return self.map([image])[0]
+
+    def close(self):
+        for process in self._workers:
+            if process.is_alive():
+                self._task_queue.put(None)
+        for process in self._workers:
+            process.join()
+        self._workers = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def detect_images(detector, images):
+    """ Results of images in order, through the pool if detector is a DetectPool """
+    if isinstance(detector, DetectPool):
+        return detector.imap(images)
+    return (detector.detect(image) for image in images)
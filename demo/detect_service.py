@@ -0,0 +1,285 @@
+"""
+Local detection service of DetectAPI
+@@POST /detect with an encoded image (jpg, png) body returns the detect result as JSON
+@@GET /metrics returns queue depth, shed requests and queue, detect and total latency histograms
+@@HTTP on localhost or on a Unix socket, one thread per connection
+@@Concurrent requests are coalesced into micro batches of DetectAPI.detect_batch
+@@At most max_queue images wait, later requests are shed at once with 503
+Usage:
+    python demo/detect_service.py --port 8080 --prefix <pnet> <rnet> <onet>
+    curl --data-binary @face.jpg http://127.0.0.1:8080/detect
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import cv2
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+from telemetry import Telemetry, TelemetrySink
+from tools.detections import Detections
+
+# Names of the detect result fields per aux_idx, a bare boxes array for 0
+RESULT_FIELDS = {0: ['boxes'], 1: ['boxes', 'landmarks'], 2: ['boxes', 'pose'], 3: ['boxes', 'pose', 'landmarks']}
+# Connections waiting for accept, the default 5 makes concurrent clients retry connect
+REQUEST_QUEUE_SIZE = 128
+
+
+class ServiceOverloaded(Exception):
+    pass
+
+
+class _Job(object):
+    def __init__(self, image):
+        self.image = image
+        self.arrive_time = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DetectService(object):
+    def __init__(self, detector, max_batch=8, max_wait=0.005, max_queue=64):
+        """
+        Micro batching front of a detector, thread safe.
+        Args:
+            detector: DetectAPI
+            max_batch: Images of one detect_batch
+            max_wait: Seconds the oldest queued image waits for a fuller batch
+            max_queue: Images waiting, submit raises ServiceOverloaded beyond
+        """
+        self.detector = detector
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        # Every request gets a 'service' record: queue, detect and total time, batch size
+        self.sink = TelemetrySink()
+        self.request_num = 0
+        self.shed_num = 0
+        self.error_num = 0
+        self.batch_num = 0
+        self._cond = threading.Condition()
+        self._pending = list()
+        self._closed = False
+        self._thread = threading.Thread(target=self._dispatch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, image):
+        """ Detect result of image, waits for its batch """
+        job = _Job(image)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('DetectService is closed')
+            self.request_num += 1
+            if len(self._pending) >= self.max_queue:
+                self.shed_num += 1
+                raise ServiceOverloaded('%d images queued' % len(self._pending))
+            self._pending.append(job)
+            self._cond.notify()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def metrics(self):
+        with self._cond:
+            depth = len(self._pending)
+        return OrderedDict([('queue_depth', depth), ('max_queue', self.max_queue), ('requests', self.request_num),
+                            ('shed', self.shed_num), ('errors', self.error_num), ('batches', self.batch_num),
+                            ('stats', self.sink.summary())])
+
+    def close(self):
+        """ Queued images are still detected """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                deadline = self._pending[0].arrive_time + self.max_wait
+                while len(self._pending) < self.max_batch and not self._closed:
+                    remain = deadline - time.time()
+                    if remain <= 0:
+                        break
+                    self._cond.wait(remain)
+                jobs = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            self._run(jobs)
+
+    def _run(self, jobs):
+        start = time.time()
+        try:
+            results = self.detector.detect_batch([job.image for job in jobs])
+        except Exception as e:
+            self.error_num += len(jobs)
+            for job in jobs:
+                job.error = e
+                job.done.set()
+            return
+        end = time.time()
+        self.batch_num += 1
+        for job, result in zip(jobs, results):
+            job.result = result
+            telemetry = Telemetry(tag='service')
+            telemetry.add_time('queue', start - job.arrive_time)
+            telemetry.add_time('detect', end - start)
+            telemetry.add_time('total', end - job.arrive_time)
+            telemetry.count('batch_size', len(jobs))
+            self.sink.submit(telemetry)
+            job.done.set()
+
+
+def result_to_json(result, aux_idx):
+    """ Detect result or Detections as a dict of lists, empty boxes if nothing is found """
+    if isinstance(result, Detections):
+        result = result.as_result(aux_idx)
+    fields = result if type(result) is tuple else (result,)
+    names = RESULT_FIELDS.get(aux_idx, ['boxes'])
+    return OrderedDict([(name, np.asarray(field).tolist() if field is not None else [])
+                        for name, field in zip(names, fields)])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep alive, every response has a Content-Length
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.path != '/detect':
+            return self._send(404, {'error': 'unknown path %s' % self.path})
+        length = int(self.headers.get('Content-Length', 0))
+        data = np.frombuffer(self.rfile.read(length), dtype=np.uint8)
+        image = cv2.imdecode(data, cv2.IMREAD_COLOR) if length else None
+        if image is None:
+            return self._send(400, {'error': 'body is not an encoded image'})
+        service = self.server.service
+        try:
+            result = service.submit(image)
+        except ServiceOverloaded as e:
+            return self._send(503, {'error': str(e)}, {'Retry-After': '1'})
+        except Exception as e:
+            return self._send(500, {'error': repr(e)})
+        self._send(200, result_to_json(result, service.detector.aux_idx))
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self._send(404, {'error': 'unknown path %s' % self.path})
+        self._send(200, self.server.service.metrics())
+
+    def _send(self, code, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        # No stderr line per request, see /metrics
+        pass
+
+
+class _TcpHandler(_Handler):
+    # Headers and body are separate writes, Nagle would hold the body for the client's delayed ack
+    disable_nagle_algorithm = True
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+def make_server(service, host='127.0.0.1', port=8080, unix_socket=None):
+    """ HTTP server of service on host:port, or on unix_socket if set """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, _Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), _TcpHandler)
+    server.service = service
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local detection service',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', dest='host', help='address to listen on', default='127.0.0.1', type=str)
+    parser.add_argument('--port', dest='port', help='port to listen on', default=8080, type=int)
+    parser.add_argument('--unix_socket', dest='unix_socket', help='listen on this Unix socket instead of a port',
+                        default=None, type=str)
+    parser.add_argument('--max_batch', dest='max_batch', help='images of one micro batch', default=8, type=int)
+    parser.add_argument('--max_wait_ms', dest='max_wait_ms', help='wait of the oldest image for a fuller batch',
+                        default=5.0, type=float)
+    parser.add_argument('--max_queue', dest='max_queue', help='queued images, more are shed with 503',
+                        default=64, type=int)
+    parser.add_argument('--test_mode', dest='test_mode', help='test net type, can be pnet, rnet or onet',
+                        default='onet', type=str)
+    parser.add_argument('--prefix', dest='prefix', help='prefix of model name', nargs="+", type=str)
+    parser.add_argument('--epoch', dest='epoch', help='epoch number of model to load', nargs="+",
+                        default=[13, 16, 16], type=int)
+    parser.add_argument('--batch_size', dest='batch_size', help='list of batch size used in prediction', nargs="+",
+                        default=[2048, 256, 16], type=int)
+    parser.add_argument('--thresh', dest='thresh', help='list of thresh for pnet, rnet, onet', nargs="+",
+                        default=[0.6, 0.7, 0.7], type=float)
+    parser.add_argument('--min_face', dest='min_face', help='minimum face size for detection', default=24, type=int)
+    parser.add_argument('--is_ERC', dest='is_ERC', help='rnet with early reject classifier', action='store_true')
+    parser.add_argument('--frozen', dest='frozen', help='load frozen .pb graphs', action='store_true')
+    parser.add_argument('--landmark_num', dest='landmark_num', help='landmark points of the onet', default=68,
+                        type=int)
+    parser.add_argument('--size_buckets', dest='size_buckets', help='pad pnet inputs to a few bucket sizes',
+                        action='store_true')
+    parser.add_argument('--warmup', dest='warmup', help='WxH resolutions detected once before serving', nargs="+",
+                        default=None, type=str)
+    parser.add_argument('--micro_batch_wait_ms', dest='micro_batch_wait_ms',
+                        help='rnet and onet crops of a batch wait for each other, off if not set', default=None,
+                        type=float)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    import tensorflow as tf
+    from detectAPI import DetectAPI
+    FLAGS = tf.flags.FLAGS
+    FLAGS.ERC_thresh = 0.1
+    args = parse_args()
+    FLAGS.landmark_num = args.landmark_num
+    detector = DetectAPI(args.prefix, args.epoch, args.test_mode, args.batch_size, args.is_ERC, args.thresh,
+                         args.min_face, frozen=args.frozen,
+                         micro_batch_wait=args.micro_batch_wait_ms / 1000.0 if args.micro_batch_wait_ms else None,
+                         size_buckets=args.size_buckets,
+                         warmup_resolutions=[tuple(int(x) for x in size.split('x')) for size in args.warmup or []])
+    for row in detector.warmup_report or []:
+        print('warmup %s: cold %.2f ms, warm %.2f ms, %d new pnet shapes' % (
+            row['resolution'], row['cold_ms'], row['warm_ms'], row['new_shapes']))
+    service = DetectService(detector, args.max_batch, args.max_wait_ms / 1000.0, args.max_queue)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    print('Serving on %s' % (args.unix_socket or '%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.close()
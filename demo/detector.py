@@ -1,144 +1,190 @@
+import time
 import tensorflow as tf
 import numpy as np
 from collections import OrderedDict
+from tools.freeze_graph import frozen_tensor, name_outputs
+from tools.arena import BufferArena
+from runtime import Runtime
+
+# Same normalization the nets are trained with
+PIXEL_MEAN = 127.5
+PIXEL_SCALE = 0.0078125
+
+
+def normalize_input(image_op):
+    """ (uint8 pixel - 127.5) * 0.0078125 on graph, exact in float32 like the numpy normalization """
+    return (tf.cast(image_op, tf.float32) - PIXEL_MEAN) * PIXEL_SCALE
+
+
+def check_frozen_input(image_op, pb_path):
+    if image_op.dtype != tf.uint8:
+        raise ValueError("%s feeds normalized float input, export it again with tools/freeze_graph.py." % pb_path)
+
+
+# Outputs every aux_idx needs
+AUX_OUTPUTS = {0: ['cls_prob', 'bbox_pred'],
+               1: ['cls_prob', 'bbox_pred', 'land_pred'],
+               2: ['cls_prob', 'bbox_pred', 'pose_pred'],
+               3: ['cls_prob', 'bbox_pred', 'pose_pred', 'land_pred'],
+               4: ['cls_prob', 'bbox_pred', 'DR1_index', 'DR2_index']}
+
+# Multiply-adds per 24 x 24 crop of JDAP_24Net_ERC parts, conv1 and ERC1 run on every row,
+# conv2 and ERC2 on ERC1 survivors, conv3 and fc layers on ERC2 survivors
+ERC_MACS = {'conv1': 22 * 22 * 27 * 32, 'ERC1': 11 * 11 * 32 * 24 + 24 * 2,
+            'conv2': 9 * 9 * 288 * 64, 'ERC2': 4 * 4 * 64 * 48 + 48 * 2,
+            'tail': 3 * 3 * 256 * 96 + 864 * 128 + 128 * 6}
 
 
 class Detector(object):
-    def __init__(self, net_factory, data_size, batch_size, model_path, aux_idx=0):
+    def __init__(self, net_factory, data_size, batch_size, model_path, aux_idx=0, dynamic_batch=False,
+                 bucket_batch=False, runtime=None):
         self._aux_idx = aux_idx
-        graph = tf.Graph()
-        with graph.as_default():
-            self.image_op = tf.placeholder(tf.float32, shape=[None, data_size, data_size, 3], name='input_image')
-            if self._aux_idx == 0:
-                self.cls_prob, self.bbox_pred, self.end_points = net_factory(self.image_op, is_training=False)
-            # Only face landmark aux
-            if self._aux_idx == 1:
-                self.cls_prob, self.bbox_pred, self.land_pred = net_factory(self.image_op, is_training=False)
-            # Only head pose aux
-            elif self._aux_idx == 2:
-                self.cls_prob, self.bbox_pred, self.pose_pred = net_factory(self.image_op, is_training=False)
-            # face landmark and head pose aux together
-            elif self._aux_idx == 3:
-                self.cls_prob, self.bbox_pred, self.pose_pred, self.land_pred, self.end_points\
-                    = net_factory(self.image_op, is_training=False)
-            # Using early reject classifier
-            elif self._aux_idx == 4:
-                self.cls_prob, self.bbox_pred, self.DR1_index, self.DR2_index = net_factory(self.image_op, is_training=False)
-            self.sess = tf.Session(
-                config=tf.ConfigProto(allow_soft_placement=True, gpu_options=tf.GPUOptions(allow_growth=True)))
-            saver = tf.train.Saver()
-            saver.restore(self.sess, model_path)
+        # Run exact size batches instead of padding the last one to batch_size
+        self.dynamic_batch = dynamic_batch
+        # In dynamic batch, pad a batch to the next power of two to limit shape variety
+        self.bucket_batch = bucket_batch
+        # Padded minibatches of predict
+        self.arena = BufferArena()
+        self.output_names = AUX_OUTPUTS[aux_idx]
+        self.reset_erc_stats()
+        # Own graph and session unless a shared runtime is given
+        self.runtime = runtime if runtime is not None else Runtime()
+        self.sess = self.runtime.sess
+        if model_path.endswith('.pb'):
+            # Frozen inference graph from tools/freeze_graph.py
+            scope = self.runtime.import_frozen(model_path)
+            self.image_op = frozen_tensor(self.runtime.graph, 'input_image', is_output=False, scope=scope)
+            check_frozen_input(self.image_op, model_path)
+            for name in self.output_names:
+                setattr(self, name, frozen_tensor(self.runtime.graph, name, scope=scope))
+            self.end_points = dict()
+        else:
+            self.runtime.restore(lambda: self._build_graph(net_factory, data_size), model_path)
 
         self.data_size = data_size
         self.batch_size = batch_size
 
-    def predict(self, databatch):
-        # access data
-        # databatch: N x 3 x data_size x data_size
-        batch_size = self.batch_size
+    def _build_graph(self, net_factory, data_size):
+        # uint8 crops, normalized on graph
+        self.image_op = tf.placeholder(tf.uint8, shape=[None, data_size, data_size, 3], name='input_image')
+        image = normalize_input(self.image_op)
+        if self._aux_idx == 0:
+            self.cls_prob, self.bbox_pred, self.end_points = net_factory(image, is_training=False)
+        # Only face landmark aux
+        if self._aux_idx == 1:
+            self.cls_prob, self.bbox_pred, self.land_pred = net_factory(image, is_training=False)
+        # Only head pose aux
+        elif self._aux_idx == 2:
+            self.cls_prob, self.bbox_pred, self.pose_pred = net_factory(image, is_training=False)
+        # face landmark and head pose aux together
+        elif self._aux_idx == 3:
+            self.cls_prob, self.bbox_pred, self.pose_pred, self.land_pred, self.end_points\
+                = net_factory(image, is_training=False)
+        # Using early reject classifier
+        elif self._aux_idx == 4:
+            self.cls_prob, self.bbox_pred, self.DR1_index, self.DR2_index = net_factory(image, is_training=False)
+        # Fixed output names, kept by freeze_graph
+        outputs = OrderedDict([(name, getattr(self, name)) for name in self.output_names])
+        for name, tensor in zip(outputs.keys(), name_outputs(outputs)):
+            setattr(self, name, tensor)
+
+    def _fetches(self):
+        """ Outputs of aux_idx, in the order predict returns them """
+        return [getattr(self, name) for name in self.output_names]
 
-        minibatch = []
-        cur = 0
+    def _feed(self, data):
+        """ Minibatch as run, rows repeated up to batch_size, or to the next power of two in dynamic
+        bucket batch, or data itself. Rows after data are only padding, their outputs are dropped """
+        m = data.shape[0]
+        size = self.padded_rows(m)
+        if size == m:
+            return data
+        feed = self.arena.get('feed', (size,) + data.shape[1:], data.dtype)
+        feed[:m] = data
+        np.take(data, np.arange(m, size) % m, axis=0, out=feed[m:])
+        return feed
+
+    def padded_rows(self, num):
+        """ Rows predict runs for num crops, batch padding included """
+        if num == 0:
+            return num
+        full_num, last = divmod(num, self.batch_size)
+        if last and not self.dynamic_batch:
+            last = self.batch_size
+        elif last and self.bucket_batch:
+            last = min(1 << (last - 1).bit_length(), self.batch_size)
+        return full_num * self.batch_size + last
+
+    def reset_erc_stats(self):
+        self.erc_rows = 0
+        self.erc1_pass = 0
+        self.erc2_pass = 0
+        self.erc_time = 0.0
+
+    def erc_stats(self):
+        """ Early reject rates since last reset, and the multiply-adds (and net time, estimated from them)
+        saved against running every crop through the whole net """
+        rows = float(max(self.erc_rows, 1))
+        full = (ERC_MACS['conv1'] + ERC_MACS['conv2'] + ERC_MACS['tail']) * float(self.erc_rows)
+        spent = ((ERC_MACS['conv1'] + ERC_MACS['ERC1']) * self.erc_rows +
+                 (ERC_MACS['conv2'] + ERC_MACS['ERC2']) * self.erc1_pass + ERC_MACS['tail'] * self.erc2_pass)
+        return {'rows': self.erc_rows,
+                'ERC1_reject': (self.erc_rows - self.erc1_pass) / rows,
+                'ERC2_reject': (self.erc1_pass - self.erc2_pass) / float(max(self.erc1_pass, 1)),
+                'total_reject': (self.erc_rows - self.erc2_pass) / rows,
+                'mac_saved': (full - spent) / max(full, 1),
+                'net_time': self.erc_time,
+                'time_saved': self.erc_time * (full / max(spent, 1) - 1)}
+
+    def predict_erc(self, databatch):
+        """ Early reject classifier net in minibatches like predict, outputs of ERC2 survivors only
+        Returns:
+            cls_prob, bbox_pred: Rows of survivors
+            last_index: Row of every survivor in databatch, ascending
+        """
         n = databatch.shape[0]
-        while cur < n:
-            minibatch.append(databatch[cur:min(cur+batch_size, n), :, :, :])
-            cur += batch_size
-        cls_prob_list = []
-        bbox_pred_list = []
-        land_pred_list = []
-        pose_pred_list = []
-        #end_points_dict = OrderedDict()
-        DR_index_list = []
-        if self._aux_idx == 4:
-            cls_prob, bbox_pred, DR1_index, DR2_index = \
-                self.sess.run([self.cls_prob, self.bbox_pred, self.DR1_index, self.DR2_index],
-                              feed_dict={self.image_op: databatch})
-            last_index = DR1_index[DR2_index]
-            return cls_prob, bbox_pred, last_index
-        else:
-            for idx, data in enumerate(minibatch):
+        fetches = self._fetches()
+        cls_list, bbox_list, index_list = list(), list(), list()
+        start = time.time()
+        with self.arena.scope():
+            for cur in range(0, n, self.batch_size):
+                data = databatch[cur:cur + self.batch_size]
                 m = data.shape[0]
-                real_size = self.batch_size
-                if m < batch_size:
-                    keep_inds = np.arange(m)
-                    gap = self.batch_size - m
-                    while gap >= len(keep_inds):
-                        gap -= len(keep_inds)
-                        keep_inds = np.concatenate((keep_inds, keep_inds))
-                    if gap != 0:
-                        keep_inds = np.concatenate((keep_inds, keep_inds[:gap]))
-                    data = data[keep_inds]
-                    real_size = m
-                if self._aux_idx == 0:
-                    cls_prob, bbox_pred = self.sess.run([self.cls_prob, self.bbox_pred], feed_dict={self.image_op: data})
-                elif self._aux_idx == 1:
-                    cls_prob, bbox_pred, land_pred = \
-                        self.sess.run([self.cls_prob, self.bbox_pred, self.land_pred], feed_dict={self.image_op: data})
-                    land_pred_list.append(land_pred[:real_size])
-                elif self._aux_idx == 2:
-                    cls_prob, bbox_pred, pose_pred = \
-                        self.sess.run([self.cls_prob, self.bbox_pred, self.pose_pred], feed_dict={self.image_op: data})
-                    pose_pred_list.append(pose_pred[:real_size])
-                elif self._aux_idx == 3:
-                    cls_prob, bbox_pred, pose_pred, land_pred = \
-                        self.sess.run([self.cls_prob, self.bbox_pred, self.pose_pred, self.land_pred],
-                                      feed_dict={self.image_op: data})
-                    land_pred_list.append(land_pred[:real_size])
-                    pose_pred_list.append(pose_pred[:real_size])
-                # elif self._aux_idx == 4:
-                #     cls_prob, bbox_pred, DR1_index, DR2_index = \
-                #         self.sess.run([self.cls_prob, self.bbox_pred, self.DR1_index, self.DR2_index], feed_dict={self.image_op: data})
-                #     index_1 = np.where(DR1_index < real_size)
-                #     filter_num_1 = np.size(index_1, axis=1)
-                #     #DR1_index_list.append(DR1_index[:filter_num_1])
-                #     valid_base_index = DR1_index[:filter_num_1]
-                #     index_2 = np.where(DR2_index < filter_num_1)
-                #     filter_num_2 = np.size(index_2, axis=1)
-                #     #DR2_index_list.append(DR2_index[:filter_num_2])
-                #     short_index = DR2_index[:filter_num_2]
-                #     last_index = valid_base_index[short_index]
-                #     mask = np.zeros(batch_size, dtype=np.int32)
-                #     mask[last_index] = 1
-                #     cls_prob_list.append(cls_prob[short_index])
-                #     bbox_pred_list.append(bbox_pred[short_index])
-                #     DR_index_list.append(mask[:real_size])
-
-                cls_prob_list.append(cls_prob[:real_size])
-                bbox_pred_list.append(bbox_pred[:real_size])
-                # for k, v in end_points.items():
-                #     if k not in end_points:
-                #         end_points[k] = v
-                #     else:
-                #         end_points[k] = np.concatenate((end_points[k], v), axis=0)
-            if len(cls_prob_list):
-                cls_result = np.concatenate(cls_prob_list, axis=0)
-                bbox_result = np.concatenate(bbox_pred_list, axis=0)
-            else:
-                cls_result = []
-                bbox_result = []
+                cls_prob, bbox_pred, DR1_index, DR2_index = self.sess.run(
+                    fetches, feed_dict={self.image_op: self._feed(data)})
+                last_index = DR1_index[DR2_index]
+                # Survivors of padding rows are dropped
+                real = last_index < m
+                cls_list.append(cls_prob[real])
+                bbox_list.append(bbox_pred[real])
+                index_list.append(last_index[real] + cur)
+                self.erc1_pass += int(np.sum(DR1_index < m))
+                self.erc2_pass += int(np.sum(real))
+        self.erc_rows += n
+        self.erc_time += time.time() - start
+        if n == 0:
+            return np.zeros((0, 2), np.float32), np.zeros((0, 4), np.float32), np.zeros(0, np.int64)
+        return np.concatenate(cls_list), np.concatenate(bbox_list), np.concatenate(index_list)
 
-        if self._aux_idx == 0:
-            return cls_result, bbox_result
-        elif self._aux_idx == 1:
-            land_result = []
-            if len(land_pred_list):
-                land_result = np.concatenate(land_pred_list, axis=0)
-            return cls_result, bbox_result, land_result
-        elif self._aux_idx == 2:
-            pose_result = []
-            if len(pose_pred_list):
-                pose_result = np.concatenate(pose_pred_list, axis=0)
-            return cls_result, bbox_result, pose_result
-        elif self._aux_idx == 3:
-            land_result = []
-            pose_result = []
-            if len(land_pred_list):
-                land_result = np.concatenate(land_pred_list, axis=0)
-                pose_result = np.concatenate(pose_pred_list, axis=0)
-            return cls_result, bbox_result, pose_result, land_result
-        # elif self._aux_idx == 4:
-        #     # DR1_index_list = np.concatenate(DR1_index_list, axis=0)
-        #     # DR2_index_list = np.concatenate(DR2_index_list, axis=0)
-        #     # return cls_result, bbox_result, DR1_index_list, DR2_index_list
-        #     reserve_mask = np.concatenate(DR_index_list, axis=0)
-        #     return cls_result, bbox_result, reserve_mask
\ No newline at end of file
+    def predict(self, databatch):
+        """ Outputs of aux_idx for all rows, in minibatches of batch_size
+        Returns:
+            tuple of N x ... arrays in AUX_OUTPUTS order, lists if N is 0
+        """
+        if self._aux_idx == 4:
+            return self.predict_erc(databatch)
+        n = databatch.shape[0]
+        fetches = self._fetches()
+        if n == 0:
+            return tuple([[] for _ in fetches])
+        results = None
+        with self.arena.scope():
+            for cur in range(0, n, self.batch_size):
+                data = databatch[cur:cur + self.batch_size]
+                m = data.shape[0]
+                outputs = self.sess.run(fetches, feed_dict={self.image_op: self._feed(data)})
+                if results is None:
+                    results = [np.empty((n,) + o.shape[1:], dtype=o.dtype) for o in outputs]
+                for result, output in zip(results, outputs):
+                    result[cur:cur + m] = output[:m]
+        return tuple(results)
@@ -1,27 +1,220 @@
+import numpy as np
 import tensorflow as tf
+from collections import OrderedDict
+from tools.freeze_graph import frozen_tensor, name_outputs
+from tools.utils import pnet_bucket_size, pnet_map_size
+from tools.arena import BufferArena
+from runtime import Runtime
+from detector import normalize_input, check_frozen_input
 
-BATCH_NUM = 1
 CHANNEL = 3
+# Placeholders of on graph post processing, (attribute, exported name)
+POST_INPUTS = [('scales_op', 'pnet_scales'), ('threshold_op', 'pnet_threshold'),
+               ('iou_threshold_op', 'pnet_iou_threshold'), ('top_k_op', 'pnet_top_k')]
+# generate_bbox cells, stride 2 and 12 x 12 boxes
+STRIDE = 2
+CELL_SIZE = 12
+
+
+def pnet_boxes_op(cls_prob, bbox_pred, scales, threshold, iou_threshold, top_k, valid_size):
+    """
+    generate_bbox and nms of every image in a pnet batch on graph
+    Args:
+        cls_prob, bbox_pred: N x h x w x 2 and N x h x w x 4 pnet outputs
+        scales: N float64, pyramid scale of every image
+        threshold: Face score threshold
+        iou_threshold: nms threshold, same IoU as py_nms (+1 box sides)
+        top_k: Boxes of the highest scores kept per image before nms
+        valid_size: Map rows and columns of the real images, cells of bucket padding beyond are dropped
+
+    Returns:
+        boxes: K x 9 float64 (x1, y1, x2, y2, score, dx1, dy1, dx2, dy2) of all images,
+            descending score in every image
+        box_image: K int32, image of every box
+        threshold_num: N int32, cells over threshold per image
+    """
+    score_map = cls_prob[:, :, :, 1]
+    image_num = tf.shape(score_map)[0]
+    map_shape = tf.shape(score_map)
+    inside = tf.logical_and(tf.reshape(tf.range(map_shape[1]) < valid_size[0], [1, -1, 1]),
+                            tf.reshape(tf.range(map_shape[2]) < valid_size[1], [1, 1, -1]))
+    # (image, y, x) of cells over threshold, row major like np.where
+    cells = tf.where(tf.logical_and(score_map > threshold, inside))
+    score = tf.gather_nd(score_map, cells)
+    reg = tf.gather_nd(bbox_pred, cells)
+    cell_num = tf.shape(cells)[0]
+    image_id = tf.cast(cells[:, 0], tf.int32)
+    threshold_num = tf.unsorted_segment_sum(tf.ones_like(image_id), image_id, image_num)
+    # By image then descending score, a full top_k keeps equal keys in cell order
+    key = tf.cast(image_id, tf.float64) * 2 - tf.cast(score, tf.float64)
+    order = tf.nn.top_k(-key, k=cell_num).indices
+    sorted_image = tf.gather(image_id, order)
+    position = tf.range(cell_num)
+    first = tf.unsorted_segment_min(position, sorted_image, image_num)
+    order = tf.boolean_mask(order, position - tf.gather(first, sorted_image) < top_k)
+    cells, score, reg, image_id = [tf.gather(x, order) for x in [cells, score, reg, image_id]]
+
+    # Box decoding of generate_bbox in float64, tf.round is half to even like np.round
+    scale = tf.expand_dims(tf.gather(scales, image_id), 1)
+    cell_xy = tf.cast(tf.stack([cells[:, 2], cells[:, 1]], axis=1), tf.float64)
+    top_left = tf.round(STRIDE * cell_xy / scale)
+    bottom_right = tf.round((STRIDE * cell_xy + CELL_SIZE) / scale - 1)
+    boxes = tf.concat([top_left, bottom_right, tf.cast(tf.expand_dims(score, 1), tf.float64),
+                       tf.cast(reg, tf.float64)], axis=1)
+
+    # Images are put apart along x by more than any box reaches, one nms then never mixes two images.
+    # Box coordinates are integers, exact in float32, [y1, x1, y2 + 1, x2 + 1] gives the +1 areas of py_nms
+    reach = tf.ceil((tf.cast(tf.shape(score_map)[2], tf.float64) * STRIDE + CELL_SIZE) / tf.reduce_min(scales)) + 1
+    shift = tf.cast(image_id, tf.float64) * reach
+    nms_boxes = tf.cast(tf.stack([top_left[:, 1], top_left[:, 0] + shift,
+                                  bottom_right[:, 1] + 1, bottom_right[:, 0] + 1 + shift], axis=1), tf.float32)
+    keep = tf.image.non_max_suppression(nms_boxes, score, tf.shape(score)[0], iou_threshold)
+    return tf.gather(boxes, keep), tf.gather(image_id, keep), threshold_num
 
 
 class FcnDetector(object):
-    def __init__(self, net_factory, model_path):
-        with tf.Graph().as_default():
-            self.image_op = tf.placeholder(tf.float32, name='input_image')
-            self.width_op = tf.placeholder(tf.int32, name='image_width')
-            self.height_op = tf.placeholder(tf.int32, name='image_height')
-            if BATCH_NUM is not 1 or CHANNEL is not 3:
-                raise Exception("PNet using FCN, it only support 1 batch size. Channel only support 3.")
-            image_reshape = tf.reshape(self.image_op, [BATCH_NUM, self.height_op, self.width_op, CHANNEL])
-            self.cls_prob, self.bbox_pred, self.end_points = net_factory(image_reshape, is_training=False, mode='TEST')
-            self.sess = tf.Session(
-                config=tf.ConfigProto(allow_soft_placement=True, gpu_options=tf.GPUOptions(allow_growth=True)))
-            saver = tf.train.Saver()
-            saver.restore(self.sess, model_path)
+    def __init__(self, net_factory, model_path, runtime=None, size_buckets=False):
+        self.output_names = ['cls_prob', 'bbox_pred', 'boxes', 'box_image', 'threshold_num']
+        # Zero pad inputs bottom right to pnet_bucket_size sides and crop the maps back, far fewer
+        # input shapes pay first run setup. Cells of the real image see the same pixels, maps are exact
+        self.size_buckets = size_buckets
+        # (height, width) of every input run so far, see warmup
+        self.input_shapes = set()
+        # Batches and bucket padding of predict_batch and predict_boxes
+        self.arena = BufferArena()
+        # Own graph and session unless a shared runtime is given
+        self.runtime = runtime if runtime is not None else Runtime()
+        self.sess = self.runtime.sess
+        if model_path.endswith('.pb'):
+            # Frozen inference graph from tools/freeze_graph.py, without end_points
+            scope = self.runtime.import_frozen(model_path)
+            graph = self.runtime.graph
+            self.image_op = frozen_tensor(graph, 'input_image', is_output=False, scope=scope)
+            check_frozen_input(self.image_op, model_path)
+            self.width_op = frozen_tensor(graph, 'image_width', is_output=False, scope=scope)
+            self.height_op = frozen_tensor(graph, 'image_height', is_output=False, scope=scope)
+            self.cls_prob = frozen_tensor(graph, 'cls_prob', scope=scope)
+            self.bbox_pred = frozen_tensor(graph, 'bbox_pred', scope=scope)
+            self.end_points = dict()
+            try:
+                for attr, name in POST_INPUTS:
+                    setattr(self, attr, frozen_tensor(graph, name, is_output=False, scope=scope))
+                for name in self.output_names[2:]:
+                    setattr(self, name, frozen_tensor(graph, name, scope=scope))
+            except KeyError:
+                # Frozen before on graph post processing, maps only
+                self.boxes = None
+                self.output_names = self.output_names[:2]
+            try:
+                self.valid_size_op = frozen_tensor(graph, 'pnet_valid_size', is_output=False, scope=scope)
+            except KeyError:
+                # Frozen before size buckets, predict_boxes runs unpadded
+                self.valid_size_op = None
+        else:
+            self.runtime.restore(lambda: self._build_graph(net_factory), model_path)
+
+    def _build_graph(self, net_factory):
+        # uint8 pyramid levels, normalized on graph
+        self.image_op = tf.placeholder(tf.uint8, name='input_image')
+        self.width_op = tf.placeholder(tf.int32, name='image_width')
+        self.height_op = tf.placeholder(tf.int32, name='image_height')
+        # Single image (H x W x C) or image batch (N x H x W x C), all images in batch share the same size
+        image_reshape = tf.reshape(normalize_input(self.image_op), [-1, self.height_op, self.width_op, CHANNEL])
+        self.cls_prob, self.bbox_pred, self.end_points = net_factory(image_reshape, is_training=False, mode='TEST')
+        # On graph post processing of predict_boxes
+        self.scales_op = tf.placeholder(tf.float64, shape=[None], name='pnet_scales')
+        self.threshold_op = tf.placeholder(tf.float32, shape=[], name='pnet_threshold')
+        self.iou_threshold_op = tf.placeholder(tf.float32, shape=[], name='pnet_iou_threshold')
+        self.top_k_op = tf.placeholder(tf.int32, shape=[], name='pnet_top_k')
+        self.valid_size_op = tf.placeholder_with_default(tf.shape(self.cls_prob)[1:3], shape=[2],
+                                                         name='pnet_valid_size')
+        boxes, box_image, threshold_num = pnet_boxes_op(self.cls_prob, self.bbox_pred, self.scales_op,
+                                                        self.threshold_op, self.iou_threshold_op, self.top_k_op,
+                                                        self.valid_size_op)
+        # Fixed output names, kept by freeze_graph
+        self.cls_prob, self.bbox_pred, self.boxes, self.box_image, self.threshold_num = name_outputs(
+            OrderedDict([('cls_prob', self.cls_prob), ('bbox_pred', self.bbox_pred), ('boxes', boxes),
+                         ('box_image', box_image), ('threshold_num', threshold_num)]))
 
     def predict(self, image):
         height, width, _ = image.shape
+        if len(self.end_points) == 0:
+            cls_prob, bbox_pred = self.sess.run([self.cls_prob, self.bbox_pred],
+                                                feed_dict={self.image_op: image, self.width_op: width,
+                                                           self.height_op: height})
+            return cls_prob, bbox_pred, self.end_points
         cls_prob, bbox_pred, end_points = self.sess.run([self.cls_prob, self.bbox_pred, self.end_points],
                                                         feed_dict={self.image_op: image, self.width_op: width,
                                                                    self.height_op: height})
-        return cls_prob, bbox_pred, end_points
\ No newline at end of file
+        return cls_prob, bbox_pred, end_points
+
+    def predict_batch(self, images):
+        """
+        Args:
+            images: List of images or N x H x W x C array, all images have the same size
+
+        Returns:
+            cls_prob: N x h x w x 2
+            bbox_pred: N x h x w x 4
+        """
+        height, width = images[0].shape[:2]
+        with self.arena.scope():
+            databatch = self._feed(images, self.size_buckets)
+            cls_prob, bbox_pred = self.sess.run([self.cls_prob, self.bbox_pred],
+                                                feed_dict={self.image_op: databatch, self.width_op: databatch.shape[2],
+                                                           self.height_op: databatch.shape[1]})
+        if databatch.shape[1:3] != (height, width):
+            map_h, map_w = pnet_map_size(height), pnet_map_size(width)
+            cls_prob, bbox_pred = cls_prob[:, :map_h, :map_w], bbox_pred[:, :map_h, :map_w]
+        return cls_prob, bbox_pred
+
+    def _feed(self, images, size_buckets):
+        """ N x H x W x C batch of images in an arena buffer, an array batch is fed as it is unless padded.
+        Zero padded bottom right to the bucket size if size_buckets """
+        num = len(images)
+        height, width = images[0].shape[:2]
+        if size_buckets:
+            feed_h, feed_w = pnet_bucket_size(height), pnet_bucket_size(width)
+        else:
+            feed_h, feed_w = height, width
+        if isinstance(images, np.ndarray) and (feed_h, feed_w) == (height, width):
+            feed = images
+        else:
+            feed = self.arena.get('feed', (num, feed_h, feed_w, CHANNEL), images[0].dtype)
+            for k, image in enumerate(images):
+                feed[k, :height, :width] = image
+            feed[:, height:] = 0
+            feed[:, :height, width:] = 0
+        self.input_shapes.add((feed_h, feed_w))
+        return feed
+
+    def predict_boxes(self, images, scales, threshold, iou_threshold=0.5, top_k=None):
+        """
+        Level boxes of predict_batch images with threshold, box decoding, top_k and nms done on graph,
+        only the kept boxes are fetched
+        Args:
+            images: Same as predict_batch
+            scales: Pyramid scale of every image
+            threshold, iou_threshold: Of generate_bbox and the level nms
+            top_k: Highest score boxes of an image going into nms, all if None
+
+        Returns:
+            boxes: List of K x 9 boxes per image, nms(generate_bbox(...)) of its maps up to score ties
+                and float32 IoU at the nms threshold
+            threshold_num: Cells over threshold per image
+        """
+        if self.boxes is None:
+            raise ValueError('Frozen pnet graph without on graph post processing, freeze it again')
+        height, width = images[0].shape[:2]
+        feed_dict = {self.scales_op: np.asarray(scales, np.float64), self.threshold_op: threshold,
+                     self.iou_threshold_op: iou_threshold,
+                     self.top_k_op: top_k if top_k is not None else np.iinfo(np.int32).max}
+        with self.arena.scope():
+            databatch = self._feed(images, self.size_buckets and self.valid_size_op is not None)
+            if databatch.shape[1:3] != (height, width):
+                feed_dict[self.valid_size_op] = [pnet_map_size(height), pnet_map_size(width)]
+            feed_dict.update({self.image_op: databatch, self.width_op: databatch.shape[2],
+                              self.height_op: databatch.shape[1]})
+            boxes, box_image, threshold_num = self.sess.run([self.boxes, self.box_image, self.threshold_num],
+                                                            feed_dict=feed_dict)
+        return [boxes[box_image == k] for k in range(len(images))], threshold_num
@@ -1,7 +1,16 @@
 import time
+import threading
+from collections import OrderedDict
 from tools.utils import *
+from tools.nms import nms
+from tools.pyramid import PyramidBuilder
+from tools.arena import BufferArena, arena_scope
+from tools.detections import STAGE_PNET, STAGE_RNET, STAGE_ONET
+from telemetry import Telemetry, NULL_TELEMETRY
 import tensorflow as tf
 FLAGS = tf.app.flags.FLAGS
+# IoU threshold of the nms inside every pyramid level
+LEVEL_NMS_THRESH = 0.5
 
 
 class JDAPDetector(object):
@@ -10,7 +19,22 @@ class JDAPDetector(object):
                  is_ERC=False,
                  min_face_size=24,
                  threshold=[0.6, 0.7, 0.7],
-                 scale_factor=0.709):
+                 scale_factor=0.709,
+                 is_mosaic=False,
+                 incremental_pyramid=False,
+                 max_face_size=None,
+                 coarse_to_fine=False,
+                 coarse_levels=3,
+                 roi_threshold=0.3,
+                 roi_margin=0.5,
+                 roi_fallback=True,
+                 concurrent_refine=False,
+                 telemetry_sink=None,
+                 pnet_memory_limit=None,
+                 tile_workers=1,
+                 pnet_on_graph=False,
+                 pnet_top_k=None,
+                 buffer_arena=True):
 
         self.pnet_detector = detectors[0]
         self.rnet_detector = detectors[1]
@@ -19,25 +43,413 @@ class JDAPDetector(object):
         self.min_face_size = min_face_size
         self.thresh = threshold
         self.scale_factor = scale_factor
+        # Run all pyramid levels of PNet in one mosaic canvas
+        self.is_mosaic = is_mosaic
+        # Reusable pyramid level, crop and detector minibatch buffers, per call allocation if not buffer_arena
+        self.arena = BufferArena(enabled=buffer_arena)
+        for detector in detectors:
+            # Behind a BatchScheduler
+            detector = getattr(detector, 'detector', detector)
+            if hasattr(detector, 'arena'):
+                detector.arena.enabled = buffer_arena
+        # Cached scale plans and level buffers, optionally levels resized from larger levels,
+        # levels and crops stay uint8, detectors normalize on graph
+        self.pyramid = PyramidBuilder(incremental=incremental_pyramid, normalize=False, arena=self.arena)
+        # Coarse levels are not built for faces larger than max_face_size
+        self.max_face_size = max_face_size
+        # Run coarse_levels coarsest levels on full frame, finer levels only around cells
+        # scoring > roi_threshold there (expanded by roi_margin of box side),
+        # on full frame again if coarse levels find nothing and roi_fallback. Its crops run one image at a
+        # time as plain levels, there is no mosaic canvas or on graph post processing of them
+        if coarse_to_fine and (is_mosaic or pnet_on_graph):
+            raise ValueError('coarse_to_fine does not run with is_mosaic or pnet_on_graph')
+        self.coarse_to_fine = coarse_to_fine
+        self.coarse_levels = coarse_levels
+        self.roi_threshold = roi_threshold
+        self.roi_margin = roi_margin
+        self.roi_fallback = roi_fallback
+        # Refine images of detect_batch in parallel threads, for rnet and onet behind BatchScheduler
+        self.concurrent_refine = concurrent_refine
+        # Full pyramid pixels and pixels PNet really ran on, see pixel_stats. Stream stages, refine
+        # threads and concurrent callers count at once, updates go through _count_pixels
+        self.pyramid_pixels = 0
+        self.evaluated_pixels = 0
+        self._pixel_lock = threading.Lock()
+        # Every detect call without its own telemetry record submits one here, see telemetry.py
+        self.telemetry_sink = telemetry_sink
+        # PNet tile working set in bytes, None is unlimited: the float buffers of all PNet forward passes
+        # in flight (PNET_BYTES_PER_PIXEL per input pixel). Levels (or mosaic canvas, coarse to fine crops)
+        # needing more run as overlapping tiles, tile_workers tiles at a time. The input image and its
+        # uint8 pyramid levels are not counted, they are still built in full
+        self.pnet_memory_limit = pnet_memory_limit
+        self.tile_workers = tile_workers
+        # Threshold, box decoding, nms of plain pyramid levels in the pnet graph, only the level boxes
+        # are fetched, see FcnDetector.predict_boxes. Highest pnet_top_k boxes of a level go into nms, all if None
+        self.pnet_on_graph = pnet_on_graph
+        self.pnet_top_k = pnet_top_k
+
+    def pixel_stats(self):
+        """Pyramid pixels skipped by max_face_size and coarse to fine since last reset"""
+        with self._pixel_lock:
+            pyramid_pixels, evaluated_pixels = self.pyramid_pixels, self.evaluated_pixels
+        skipped = pyramid_pixels - evaluated_pixels
+        return {'pyramid_pixels': pyramid_pixels,
+                'evaluated_pixels': evaluated_pixels,
+                'skipped_pixels': skipped,
+                'skipped_ratio': float(skipped) / max(pyramid_pixels, 1)}
+
+    def reset_pixel_stats(self):
+        with self._pixel_lock:
+            self.pyramid_pixels = 0
+            self.evaluated_pixels = 0
+
+    def _count_pixels(self, pyramid_pixels=0, evaluated_pixels=0):
+        with self._pixel_lock:
+            self.pyramid_pixels += pyramid_pixels
+            self.evaluated_pixels += evaluated_pixels
+
+    def arena_stats(self):
+        """Buffer arena stats of the cascade (levels, crops) and of every detector (minibatches)"""
+        stats = {'cascade': self.arena.stats()}
+        for name, detector in zip(['pnet', 'rnet', 'onet'],
+                                  [self.pnet_detector, self.rnet_detector, self.onet_detector]):
+            detector = getattr(detector, 'detector', detector)
+            if hasattr(detector, 'arena'):
+                stats[name] = detector.arena.stats()
+        return stats
+
+    def last_stage(self):
+        """ STAGE_* of detect results, the last net of the cascade """
+        if self.onet_detector:
+            return STAGE_ONET
+        return STAGE_RNET if self.rnet_detector else STAGE_PNET
+
+    def _plan(self, height, width):
+        """Scale plan of one image, counts its full pyramid pixels"""
+        plan, full_pixels = self.pyramid.plan_pixels(height, width, self.min_face_size, self.scale_factor,
+                                                     self.max_face_size)
+        self._count_pixels(pyramid_pixels=full_pixels)
+        return plan
+
+    def _tile_pixels(self):
+        """Max input pixels of one pnet tile, None without tile working set limit"""
+        if self.pnet_memory_limit is None:
+            return None
+        return self.pnet_memory_limit // (PNET_BYTES_PER_PIXEL * max(self.tile_workers, 1))
+
+    def _needs_tiles(self, tuple_wh):
+        max_pixels = self._tile_pixels()
+        return max_pixels is not None and tuple_wh[0] * tuple_wh[1] > max_pixels
+
+    def _pnet_tiles(self, level, tiles, handle, telemetry, level_name):
+        """Run pnet on the input window of every tile, handle(tile, cls_map, bbox_reg) gets the maps of each
+
+        With tile_workers > 1 tiles run in parallel threads and handle is called in completion order,
+        under a lock. Only tile_workers tile outputs are alive at a time.
+        """
+        def run(tile):
+            cell_x, cell_y, cell_w, cell_h = tile
+            # Even pixel offset keeps the window cells aligned with the level cells
+            window = level[2 * cell_y:2 * (cell_y + cell_h - 1) + 11, 2 * cell_x:2 * (cell_x + cell_w - 1) + 11]
+            cls_maps, bbox_regs = self.pnet_detector.predict_batch([window])
+            return cls_maps[0, :, :, 1], bbox_regs[0]
+
+        start = time.time()
+        if self.tile_workers <= 1 or len(tiles) == 1:
+            for tile in tiles:
+                handle(tile, *run(tile))
+        else:
+            lock = threading.Lock()
+            pending = list(reversed(tiles))
+            errors = list()
+
+            def worker():
+                while True:
+                    with lock:
+                        if len(pending) == 0 or len(errors):
+                            return
+                        tile = pending.pop()
+                    try:
+                        maps = run(tile)
+                        with lock:
+                            handle(tile, *maps)
+                    except Exception as e:
+                        errors.append(e)
+                        return
+
+            threads = [threading.Thread(target=worker) for _ in range(min(self.tile_workers, len(tiles)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if len(errors):
+                raise errors[0]
+        # Wall time, tiles of parallel workers overlap
+        cost = time.time() - start
+        telemetry.add_time('pnet/net', cost)
+        telemetry.add_time(level_name + '/net', cost)
+        telemetry.count('pnet/tiles', len(tiles))
+
+    def _pnet_rect_maps(self, level, rect, cls_map, bbox_reg, telemetry, level_name):
+        """Maps of the (cell_x, cell_y, cell_w, cell_h) cells of a level, run in tiles and written into
+        cls_map and bbox_reg"""
+        cell_x, cell_y, cell_w, cell_h = rect
+        tiles = [(cell_x + x, cell_y + y, w, h) for x, y, w, h in calc_pnet_tiles(cell_w, cell_h, self._tile_pixels())]
+
+        def handle(tile, tile_cls, tile_reg):
+            x, y, w, h = tile
+            cls_map[y:y + h, x:x + w] = tile_cls
+            bbox_reg[y:y + h, x:x + w] = tile_reg
+
+        self._pnet_tiles(level, tiles, handle, telemetry, level_name)
+
+    def _pnet_tiled_boxes(self, level, current_scale, tuple_wh, telemetry, level_name):
+        """Boxes of a whole level after threshold and level nms, run tile by tile, full heat maps are never held
+
+        Boxes come in the row major cell order of generate_bbox on the whole map,
+        nms breaks score ties by that order, so the level result is exactly the untiled one.
+        """
+        map_w, map_h = pnet_map_size(tuple_wh[0]), pnet_map_size(tuple_wh[1])
+        found = list()
+
+        def handle(tile, cls_map, bbox_reg):
+            boxes = generate_bbox(cls_map, bbox_reg, current_scale, self.thresh[0], offset=tile[:2])
+            if boxes.size:
+                cell_y, cell_x = np.where(cls_map > self.thresh[0])
+                found.append((boxes, (cell_y + tile[1]) * map_w + cell_x + tile[0]))
+
+        self._pnet_tiles(level, calc_pnet_tiles(map_w, map_h, self._tile_pixels()), handle, telemetry, level_name)
+        if len(found) == 0:
+            return np.array([])
+        order = np.argsort(np.concatenate([x[1] for x in found]), kind='mergesort')
+        boxes = np.vstack([x[0] for x in found])[order]
+        telemetry.count(level_name + '/threshold', len(boxes))
+        telemetry.count('pnet/threshold', len(boxes))
+        return boxes[nms(boxes[:, :5], LEVEL_NMS_THRESH, 'Union')]
 
     def _candidate_arrange(self, dets, img, net_size):
-        [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = pad(dets, self.width, self.height)
-        num_boxes = dets.shape[0]
-
-        cropped_ims = np.zeros((num_boxes, net_size, net_size, 3), dtype=np.float32)
-        for i in range(num_boxes):
-            tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.uint8)
-            tmp[dy[i]:edy[i] + 1, dx[i]:edx[i] + 1, :] = img[y[i]:ey[i] + 1, x[i]:ex[i] + 1, :]
-            cropped_ims[i, :, :, :] = resize_image_by_wh(tmp, (net_size, net_size))
-        return cropped_ims
-    import cv2
-    def detect_pnet(self, image):
+        return crop_resize_batch(img, dets, net_size, normalize=False, arena=self.arena)
+
+    def _pnet_predict(self, images, telemetry, level_name=None):
+        """pnet predict_batch, network time goes to pnet/net and the level if given"""
+        start = time.time()
+        outputs = self.pnet_detector.predict_batch(images)
+        cost = time.time() - start
+        telemetry.add_time('pnet/net', cost)
+        if level_name is not None:
+            telemetry.add_time(level_name + '/net', cost)
+        return outputs
+
+    @arena_scope
+    def _pnet_level_maps(self, images, max_batch=1, telemetry=NULL_TELEMETRY):
+        """Face score map and bbox regression map of every pyramid level
+
+        Pyramid levels of the same resolution (canvas of the same image shape in mosaic mode)
+        run through PNet as one NHWC batch, then results are split back per image.
+
+        Parameters:
+        ----------
+        images: list of numpy array
+            input image arrays
+        max_batch: int
+            max images in one pnet batch, with coarse_to_fine every image runs alone
+        telemetry: Telemetry
+            record of a single image
+
+        Returns:
+        -------
+        level_maps: list of list, level_maps[image_id] is list of (scale, tuple_wh, cls_map, bbox_reg)
+            cls_map: h x w face score, bbox_reg: h x w x 4, levels from large to small,
+            levels run in tiles or post processed on graph have cls_map None and their boxes after
+            threshold and level nms in place of bbox_reg
+        """
+        if self.coarse_to_fine:
+            return [self._pnet_coarse_to_fine_maps(image, telemetry) for image in images]
+        level_maps = list()
+        # max_batch images at a time, one pyramid buffer slot per image of the chunk
+        for chunk_start in range(0, len(images), max_batch):
+            groups = OrderedDict()
+            for slot, image in enumerate(images[chunk_start:chunk_start + max_batch]):
+                image_id = chunk_start + slot
+                height, width, _ = image.shape
+                scales, scales_wh = self._plan(height, width)
+                level_maps.append([None] * len(scales))
+                if len(scales) == 0:
+                    continue
+                self._count_pixels(evaluated_pixels=sum([w * h for w, h in scales_wh]))
+                # A canvas over the tile working set falls back to per level batches
+                if self.is_mosaic and not self._needs_tiles(self.pyramid.mosaic_layout(scales_wh)[0]):
+                    with telemetry.timer('pnet/pyramid'):
+                        canvas, offsets = self.pyramid.build_mosaic(image, scales_wh, slot)
+                    groups.setdefault(image.shape, list()).append((image_id, scales, scales_wh, canvas, offsets))
+                else:
+                    with telemetry.timer('pnet/pyramid'):
+                        levels = self.pyramid.build(image, scales_wh, slot)
+                    for level_id, (current_scale, tuple_wh) in enumerate(zip(scales, scales_wh)):
+                        if self._needs_tiles(tuple_wh):
+                            level_name = telemetry.level(level_id, tuple_wh)
+                            level_maps[image_id][level_id] = (current_scale, tuple_wh, None, self._pnet_tiled_boxes(
+                                levels[level_id], current_scale, tuple_wh, telemetry, level_name))
+                            continue
+                        groups.setdefault(tuple_wh, list()).append((image_id, level_id, current_scale, levels[level_id]))
+
+            # An image adds one item to a group at most, so a group is one pnet batch,
+            # split under the tile working set limit
+            for key, group_items in groups.items():
+                batch_num = len(group_items)
+                if self.pnet_memory_limit is not None:
+                    # Batches run one at a time, the whole working set is theirs
+                    item_pixels = group_items[0][3].shape[0] * group_items[0][3].shape[1]
+                    batch_num = max(self.pnet_memory_limit // (PNET_BYTES_PER_PIXEL * item_pixels), 1)
+                for batch_start in range(0, len(group_items), batch_num):
+                    batch_items = group_items[batch_start:batch_start + batch_num]
+                    self._pnet_group_maps(key, batch_items, level_maps, telemetry)
+        return level_maps
+
+    def _pnet_group_maps(self, key, batch_items, level_maps, telemetry):
+        """One pnet batch of same size levels (mosaic canvases), their maps go to level_maps"""
+        if self.is_mosaic and len(batch_items[0]) == 5:
+            # One forward pass, slice every level cells back from canvas heat map
+            _, scales, scales_wh, _, offsets = batch_items[0]
+            cls_maps, bbox_regs = self._pnet_predict([item[3] for item in batch_items], telemetry)
+            for k, item in enumerate(batch_items):
+                for level_id, (current_scale, tuple_wh, (x, y)) in enumerate(zip(scales, scales_wh, offsets)):
+                    map_x, map_y = x // 2, y // 2
+                    map_w, map_h = pnet_map_size(tuple_wh[0]), pnet_map_size(tuple_wh[1])
+                    level_maps[item[0]][level_id] = (
+                        current_scale, tuple_wh, cls_maps[k, map_y:map_y + map_h, map_x:map_x + map_w, 1],
+                        bbox_regs[k, map_y:map_y + map_h, map_x:map_x + map_w])
+        elif self.pnet_on_graph:
+            level_name = telemetry.level(batch_items[0][1], key)
+            start = time.time()
+            # Images of different sizes may share a level size at different scales
+            level_boxes, threshold_num = self.pnet_detector.predict_boxes(
+                [item[3] for item in batch_items], [item[2] for item in batch_items], self.thresh[0],
+                LEVEL_NMS_THRESH, self.pnet_top_k)
+            cost = time.time() - start
+            telemetry.add_time('pnet/net', cost)
+            telemetry.add_time(level_name + '/net', cost)
+            telemetry.count(level_name + '/threshold', int(np.sum(threshold_num)))
+            telemetry.count('pnet/threshold', int(np.sum(threshold_num)))
+            for (image_id, level_id, current_scale, _), boxes in zip(batch_items, level_boxes):
+                level_maps[image_id][level_id] = (current_scale, key, None, boxes)
+        else:
+            level_name = telemetry.level(batch_items[0][1], key)
+            cls_maps, bbox_regs = self._pnet_predict([item[3] for item in batch_items], telemetry, level_name)
+            for k, (image_id, level_id, current_scale, _) in enumerate(batch_items):
+                level_maps[image_id][level_id] = (current_scale, key, cls_maps[k, :, :, 1], bbox_regs[k])
+        return level_maps
+
+    @arena_scope
+    def _pnet_coarse_to_fine_maps(self, image, telemetry=NULL_TELEMETRY):
+        """Pyramid level maps of one image in coarse to fine mode
+
+        Cells of a fine level outside the regions active in coarse levels are not evaluated,
+        their face score stays 0.
+
+        Parameters:
+        ----------
+        image: numpy array
+            input image array
+        telemetry: Telemetry
+            record of the image
+
+        Returns:
+        -------
+        level_maps: list of (scale, tuple_wh, cls_map, bbox_reg), same as _pnet_level_maps,
+            None for fine levels without roi fallback
+        """
+        height, width, _ = image.shape
+        scales, scales_wh = self._plan(height, width)
+        if len(scales) == 0:
+            return list()
+        with telemetry.timer('pnet/pyramid'):
+            levels = self.pyramid.build(image, scales_wh)
+        level_maps = [None] * len(scales)
+        coarse_start = max(len(scales) - self.coarse_levels, 0)
+        active_boxes = list()
+        for level_id in range(len(scales) - 1, coarse_start - 1, -1):
+            tuple_wh = scales_wh[level_id]
+            level_name = telemetry.level(level_id, tuple_wh)
+            if self._needs_tiles(tuple_wh):
+                map_w, map_h = pnet_map_size(tuple_wh[0]), pnet_map_size(tuple_wh[1])
+                cls_map = np.zeros((map_h, map_w), dtype=np.float32)
+                bbox_reg = np.zeros((map_h, map_w, 4), dtype=np.float32)
+                self._pnet_rect_maps(levels[level_id], (0, 0, map_w, map_h), cls_map, bbox_reg, telemetry, level_name)
+            else:
+                cls_maps, bbox_regs = self._pnet_predict([levels[level_id]], telemetry, level_name)
+                cls_map, bbox_reg = cls_maps[0, :, :, 1], bbox_regs[0]
+            level_maps[level_id] = (scales[level_id], tuple_wh, cls_map, bbox_reg)
+            self._count_pixels(evaluated_pixels=tuple_wh[0] * tuple_wh[1])
+            boxes = generate_bbox(cls_map, bbox_reg, scales[level_id], self.roi_threshold)
+            if boxes.size:
+                active_boxes.append(boxes[:, :4])
+
+        if len(active_boxes) == 0 and not self.roi_fallback:
+            return level_maps
+        if len(active_boxes):
+            rois = np.vstack(active_boxes)
+            margin = (np.maximum(rois[:, 2] - rois[:, 0], rois[:, 3] - rois[:, 1]) + 1) * self.roi_margin
+            rois = rois + np.vstack([-margin, -margin, margin, margin]).T
+
+        for level_id in range(coarse_start):
+            current_scale, tuple_wh = scales[level_id], scales_wh[level_id]
+            level_name = telemetry.level(level_id, tuple_wh)
+            if len(active_boxes) == 0:
+                # Full frame fallback
+                if self._needs_tiles(tuple_wh):
+                    level_maps[level_id] = (current_scale, tuple_wh, None, self._pnet_tiled_boxes(
+                        levels[level_id], current_scale, tuple_wh, telemetry, level_name))
+                else:
+                    cls_maps, bbox_regs = self._pnet_predict([levels[level_id]], telemetry, level_name)
+                    level_maps[level_id] = (current_scale, tuple_wh, cls_maps[0, :, :, 1], bbox_regs[0])
+                self._count_pixels(evaluated_pixels=tuple_wh[0] * tuple_wh[1])
+                continue
+            map_w, map_h = pnet_map_size(tuple_wh[0]), pnet_map_size(tuple_wh[1])
+            # Cells whose 11 x 11 window touches a roi
+            level_rois = rois * current_scale
+            x0 = np.clip(np.ceil((level_rois[:, 0] - 11) / 2), 0, map_w).astype(np.int32)
+            y0 = np.clip(np.ceil((level_rois[:, 1] - 11) / 2), 0, map_h).astype(np.int32)
+            x1 = np.clip(np.floor(level_rois[:, 2] / 2) + 1, 0, map_w).astype(np.int32)
+            y1 = np.clip(np.floor(level_rois[:, 3] / 2) + 1, 0, map_h).astype(np.int32)
+            valid = (x0 < x1) & (y0 < y1)
+            x0, y0, x1, y1 = x0[valid], y0[valid], x1[valid], y1[valid]
+            # Union of roi cells by 2D difference array
+            diff = np.zeros((map_h + 1, map_w + 1), dtype=np.int32)
+            np.add.at(diff, (y0, x0), 1)
+            np.add.at(diff, (y0, x1), -1)
+            np.add.at(diff, (y1, x0), -1)
+            np.add.at(diff, (y1, x1), 1)
+            mask = (diff.cumsum(axis=0).cumsum(axis=1)[:map_h, :map_w] > 0).astype(np.uint8)
+            cls_map = np.zeros((map_h, map_w), dtype=np.float32)
+            bbox_reg = np.zeros((map_h, map_w, 4), dtype=np.float32)
+            _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+            for cell_x, cell_y, cell_w, cell_h, _ in stats[1:]:
+                crop_wh = (2 * (cell_w - 1) + 11, 2 * (cell_h - 1) + 11)
+                self._count_pixels(evaluated_pixels=crop_wh[0] * crop_wh[1])
+                if self._needs_tiles(crop_wh):
+                    self._pnet_rect_maps(levels[level_id], (cell_x, cell_y, cell_w, cell_h), cls_map, bbox_reg,
+                                         telemetry, level_name)
+                    continue
+                # Even pixel offset keeps the crop cells aligned with the level cells
+                crop = levels[level_id][2 * cell_y:2 * cell_y + crop_wh[1], 2 * cell_x:2 * cell_x + crop_wh[0]]
+                cls_maps, bbox_regs = self._pnet_predict([crop], telemetry, level_name)
+                cls_map[cell_y:cell_y + cell_h, cell_x:cell_x + cell_w] = cls_maps[0, :, :, 1]
+                bbox_reg[cell_y:cell_y + cell_h, cell_x:cell_x + cell_w] = bbox_regs[0]
+            level_maps[level_id] = (current_scale, tuple_wh, cls_map, bbox_reg)
+        return level_maps
+
+    def detect_pnet(self, image, level_maps=None, telemetry=NULL_TELEMETRY):
         """Get face candidates through pnet
 
         Parameters:
         ----------
         image: numpy array
             input image array
+        level_maps: list
+            pnet output of every pyramid level, computed here if None
+        telemetry: Telemetry
+            record of the image
 
         Intermediate:
         ----------
@@ -56,18 +468,28 @@ class JDAPDetector(object):
         all_boxes = list()
         scale_num = 1
         show_result = False
-        for current_scale, tuple_wh in zip(self.scales, self.scales_wh):
-            im_resized = resize_image_by_wh(image, tuple_wh)
-            cls_map, bbox_reg, end_points = self.pnet_detector.predict(im_resized)
-            boxes = generate_bbox(cls_map[0, :, :, 1], bbox_reg[0], current_scale, self.thresh[0])
+        root_path = '/home/dafu/workspace/FaceDetect/tf_JDAP/evaluation/MultiScale/show/paper_test_'
+        if level_maps is None:
+            level_maps = self._pnet_level_maps([image], telemetry=telemetry)[0]
+        post_start = time.time()
+        for level_id, level_map in enumerate(level_maps):
+            if level_map is None:
+                continue
+            current_scale, tuple_wh, cls_map, bbox_reg = level_map
+            level_name = telemetry.level(level_id, tuple_wh)
+            if cls_map is None:
+                # Tiled or on graph level, threshold and nms are done and counted
+                boxes = bbox_reg
+            else:
+                boxes = generate_bbox(cls_map, bbox_reg, current_scale, self.thresh[0])
+                telemetry.count(level_name + '/threshold', len(boxes))
+                telemetry.count('pnet/threshold', len(boxes))
             # Numpy slice without security check
             if boxes.size == 0:
                 continue
-            test_image = cv2.imread('/home/dafu/workspace/FaceDetect/tf_JDAP/evaluation/MultiScale/paper_test.jpg')
-            root_path = '/home/dafu/workspace/FaceDetect/tf_JDAP/evaluation/MultiScale/show/paper_test_'
-            if show_result:
-
-                feature_map = cls_map[0, :, :, 1]
+            if show_result and cls_map is not None:
+                test_image = cv2.imread('/home/dafu/workspace/FaceDetect/tf_JDAP/evaluation/MultiScale/paper_test.jpg')
+                feature_map = cls_map.copy()
                 feature_map[feature_map <= self.thresh[0]] = 0
                 feature_map = (feature_map * 255).astype(np.uint8)
                 cv2.imwrite(root_path + str(scale_num) + '_feature_map.jpg', feature_map)
@@ -83,8 +505,11 @@ class JDAPDetector(object):
                 #cv2.imshow('a', test_image)
                 #cv2.waitKey(0)
 
-            keep = py_nms(boxes[:, :5], 0.5, 'Union')
-            boxes = boxes[keep]  # if keep is [], boxes is also []
+            if cls_map is not None:
+                keep = nms(boxes[:, :5], LEVEL_NMS_THRESH, 'Union')
+                boxes = boxes[keep]  # if keep is [], boxes is also []
+            telemetry.count(level_name + '/nms', len(boxes))
+            telemetry.count('pnet/nms', len(boxes))
             if boxes.size == 0:
                 continue
             if show_result:
@@ -99,13 +524,15 @@ class JDAPDetector(object):
             all_boxes.append(boxes)
 
         if len(all_boxes) == 0:
+            telemetry.add_time('pnet/post', time.time() - post_start)
             return None
 
         all_boxes = np.vstack(all_boxes)
 
         # merge the detection from first stage
-        keep = py_nms(all_boxes[:, 0:5], 0.7, 'Union')
+        keep = nms(all_boxes[:, 0:5], 0.7, 'Union')
         all_boxes = all_boxes[keep]
+        telemetry.count('pnet/merge_nms', len(all_boxes))
         #boxes = all_boxes[:, :5]
 
         bbw = all_boxes[:, 2] - all_boxes[:, 0] + 1
@@ -118,6 +545,7 @@ class JDAPDetector(object):
                              all_boxes[:, 3] + all_boxes[:, 8] * bbh,
                              all_boxes[:, 4]])
         boxes_c = boxes_c.T
+        telemetry.add_time('pnet/post', time.time() - post_start)
         if show_result:
             pnet_image = image.copy()
             for rect in boxes_c[:, :4]:
@@ -128,7 +556,8 @@ class JDAPDetector(object):
         return boxes_c
         #return boxes, boxes_c
 
-    def detect_rnet(self, image, dets):
+    @arena_scope
+    def detect_rnet(self, image, dets, telemetry=NULL_TELEMETRY):
         """Get face candidates using rnet
 
         Parameters:
@@ -137,6 +566,8 @@ class JDAPDetector(object):
             input image array
         dets: numpy array
             detection results of pnet
+        telemetry: Telemetry
+            record of the image
 
         Returns:
         -------
@@ -158,15 +589,22 @@ class JDAPDetector(object):
                 cv2.rectangle(rnet_image, (rect[0], rect[1]), (rect[2], rect[3]), (0, 0, 255), 2)
                 cv2.imwrite(root_path + 'rnet_square.jpg', rnet_image)
 
-        cropped_ims = self._candidate_arrange(dets, image, self.rnet_detector.data_size)
+        telemetry.count('rnet/input', len(dets))
+        telemetry.fill('rnet', len(dets), self.rnet_detector.padded_rows(len(dets)))
+        with telemetry.timer('rnet/crop'):
+            cropped_ims = self._candidate_arrange(dets, image, self.rnet_detector.data_size)
 
-        if self.is_ERC:
-            cls_scores, reg, reserve_mask = self.rnet_detector.predict(cropped_ims)
-        else:
-            cls_scores, reg = self.rnet_detector.predict(cropped_ims)
+        with telemetry.timer('rnet/net'):
+            if self.is_ERC:
+                # Rows of candidates passing both early reject classifiers
+                cls_scores, reg, reserve_mask = self.rnet_detector.predict(cropped_ims)
+                telemetry.count('rnet/erc_pass', len(reserve_mask))
+            else:
+                cls_scores, reg = self.rnet_detector.predict(cropped_ims)
         if len(cls_scores) == 0:
             return None
         keep_inds = np.where(cls_scores[:, 1] > self.thresh[1])
+        telemetry.count('rnet/threshold', len(keep_inds[0]))
         if len(keep_inds) == 0:
             return None
 
@@ -177,8 +615,9 @@ class JDAPDetector(object):
 
         boxes[:, 4] = cls_scores[:, 1][keep_inds]
         reg = reg[keep_inds]
-        keep = py_nms(boxes, 0.7)
+        keep = nms(boxes, 0.7)
         boxes = boxes[keep]
+        telemetry.count('rnet/nms', len(keep))
 
         boxes_c = calibrate_box(boxes, reg[keep])
 
@@ -190,7 +629,8 @@ class JDAPDetector(object):
                 cv2.imwrite(root_path + 'rnet_final.jpg', rnet_image_final)
         return boxes_c
 
-    def detect_onet(self, image, dets, aux_idx):
+    @arena_scope
+    def detect_onet(self, image, dets, aux_idx, telemetry=NULL_TELEMETRY):
         """Get face candidates using onet
 
         Parameters:
@@ -199,6 +639,10 @@ class JDAPDetector(object):
             input image array
         dets: numpy array
             detection results of rnet
+        aux_idx: int
+            same as detect
+        telemetry: Telemetry
+            record of the image
 
         Returns:
         -------
@@ -218,16 +662,20 @@ class JDAPDetector(object):
                 rect = [int(x) for x in rect]
                 cv2.rectangle(anet_image, (rect[0], rect[1]), (rect[2], rect[3]), (0, 0, 255), 2)
                 cv2.imwrite(root_path + 'anet_square.jpg', anet_image)
-        cropped_ims = self._candidate_arrange(dets, image, self.onet_detector.data_size)
-
-        if aux_idx == 0:
-            cls_scores, bbox_reg = self.onet_detector.predict(cropped_ims)
-        elif aux_idx == 1:  # Landmark
-            cls_scores, bbox_reg, land_reg = self.onet_detector.predict(cropped_ims)
-        elif aux_idx == 2:  # Head pose
-            cls_scores, bbox_reg, pose_reg = self.onet_detector.predict(cropped_ims)
-        elif aux_idx == 3:  # Landmark and Head pose
-            cls_scores, bbox_reg, pose_reg, land_reg = self.onet_detector.predict(cropped_ims)
+        telemetry.count('onet/input', len(dets))
+        telemetry.fill('onet', len(dets), self.onet_detector.padded_rows(len(dets)))
+        with telemetry.timer('onet/crop'):
+            cropped_ims = self._candidate_arrange(dets, image, self.onet_detector.data_size)
+
+        with telemetry.timer('onet/net'):
+            if aux_idx == 0:
+                cls_scores, bbox_reg = self.onet_detector.predict(cropped_ims)
+            elif aux_idx == 1:  # Landmark
+                cls_scores, bbox_reg, land_reg = self.onet_detector.predict(cropped_ims)
+            elif aux_idx == 2:  # Head pose
+                cls_scores, bbox_reg, pose_reg = self.onet_detector.predict(cropped_ims)
+            elif aux_idx == 3:  # Landmark and Head pose
+                cls_scores, bbox_reg, pose_reg, land_reg = self.onet_detector.predict(cropped_ims)
         if len(cls_scores) == 0:
             if aux_idx == 3:
                 return None, None, None
@@ -236,6 +684,7 @@ class JDAPDetector(object):
             return None
 
         keep_inds = np.where(cls_scores[:, 1] > self.thresh[2])
+        telemetry.count('onet/threshold', len(keep_inds[0]))
         if len(keep_inds) > 0:
             boxes = dets[keep_inds]
             boxes[:, 4] = cls_scores[:, 1][keep_inds]
@@ -256,8 +705,9 @@ class JDAPDetector(object):
 
         boxes_c = calibrate_box(boxes, bbox_reg)
 
-        keep = py_nms(boxes_c, 0.7, "Minimum")
+        keep = nms(boxes_c, 0.7, "Minimum")
         boxes_c = boxes_c[keep]
+        telemetry.count('onet/nms', len(keep))
 
         boxes = boxes[keep]
         side_w = boxes[:, 2] - boxes[:, 0] + 1
@@ -286,58 +736,363 @@ class JDAPDetector(object):
             return boxes_c, pose_reg
         return boxes_c
 
-    def detect(self, img, aux_idx=0):
+    def detect(self, img, aux_idx=0, telemetry=None):
         """Detect face in three stage
+
+        Parameters:
+        ----------
+        img: numpy array
+            input image array
+        aux_idx: int
+            auxiliary outputs of onet
+        telemetry: Telemetry
+            filled with stage timing and candidate counts of this call, if None and
+            telemetry_sink is set, a new record is submitted to the sink
         """
-        t = time.time()
-        # Preprocessing
-        self.height, self.width, self.channel = img.shape
-        self.scales, self.scales_wh = calc_scale(self.height, self.width, self.min_face_size)
-        # pnet
-        if self.pnet_detector:
-            boxes_c = self.detect_pnet(img)
+        submit = telemetry is None and self.telemetry_sink is not None
+        if submit:
+            telemetry = Telemetry()
+        elif telemetry is None:
+            telemetry = NULL_TELEMETRY
+        if telemetry.tag is None:
+            telemetry.tag = '%dx%d' % (img.shape[1], img.shape[0])
+        with telemetry.timer('total'):
+            # pnet
+            if self.pnet_detector:
+                with telemetry.timer('pnet'):
+                    boxes_c = self.detect_pnet(img, telemetry=telemetry)
             if boxes_c is None:
-                return np.array([])
+                result = np.array([])
+            else:
+                result = self._detect_refine(img, boxes_c, aux_idx, telemetry)
+        if submit:
+            self.telemetry_sink.submit(telemetry)
+        return result
 
-            t1 = time.time() - t
-            t = time.time()
+    def warmup(self, resolutions, aux_idx=0, repeat=3):
+        """Detect a noise image of every resolution, so its pnet input shapes are set up before real frames
 
+        With FcnDetector size_buckets, resolutions share most bucket shapes and a later resolution
+        may already be warm. Records do not go to telemetry_sink.
+
+        Parameters:
+        ----------
+        resolutions: list of (width, height)
+        aux_idx: int
+            same as detect
+        repeat: int
+            warm detect calls timed after the first one
+
+        Returns:
+        -------
+        list of OrderedDict per resolution: cold_ms of the first detect, warm_ms median of the
+        repeat ones, new_shapes pnet input shapes the first detect ran for the first time
+        """
+        rng = np.random.RandomState(0)
+        report = list()
+        for width, height in resolutions:
+            image = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+            shape_num = len(self.pnet_detector.input_shapes)
+            start = time.time()
+            self.detect(image, aux_idx, NULL_TELEMETRY)
+            cold = time.time() - start
+            new_shapes = len(self.pnet_detector.input_shapes) - shape_num
+            warm = list()
+            for _ in range(repeat):
+                start = time.time()
+                self.detect(image, aux_idx, NULL_TELEMETRY)
+                warm.append(time.time() - start)
+            report.append(OrderedDict([('resolution', '%dx%d' % (width, height)), ('cold_ms', cold * 1000),
+                                       ('warm_ms', float(np.median(warm)) * 1000 if warm else 0.0),
+                                       ('new_shapes', new_shapes)]))
+        return report
+
+    def detect_batch(self, images, aux_idx=0, max_batch=8):
+        """Detect face in a list of images
+
+        PNet pyramid levels of the same resolution run as one batch across images,
+        rnet and onet then refine candidates of every image.
+
+        Parameters:
+        ----------
+        images: list of numpy array
+            input image arrays
+        aux_idx: int
+            same as detect
+        max_batch: int
+            max images in one pnet batch, with coarse_to_fine every image runs alone
+
+        Returns:
+        -------
+        list of detect result, one per image in input order
+        """
+        results = [np.array([])] * len(images)
+        errors = list()
+        candidates = list()
+        level_maps = self._pnet_level_maps(images, max_batch)
+        for image_id, (img, image_level_maps) in enumerate(zip(images, level_maps)):
+            boxes_c = self.detect_pnet(img, image_level_maps)
+            if boxes_c is not None:
+                candidates.append((image_id, img, boxes_c))
+
+        def refine(image_id, img, boxes_c):
+            try:
+                results[image_id] = self._detect_refine(img, boxes_c, aux_idx)
+            except Exception as e:
+                errors.append(e)
+
+        if self.concurrent_refine and len(candidates) > 1:
+            # One thread per image, their rnet and onet crops meet in the batch scheduler
+            threads = [threading.Thread(target=refine, args=candidate) for candidate in candidates]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            for candidate in candidates:
+                refine(*candidate)
+        if len(errors):
+            raise errors[0]
+        return results
+
+    def _detect_refine(self, img, boxes_c, aux_idx, telemetry=NULL_TELEMETRY):
+        """Refine pnet candidates by rnet and onet
+        """
         # rnet
         if self.rnet_detector:
-            boxes_c = self.detect_rnet(img, boxes_c)
+            with telemetry.timer('rnet'):
+                boxes_c = self.detect_rnet(img, boxes_c, telemetry)
             if boxes_c is None:
                 return np.array([])
 
-            t2 = time.time() - t
-            t = time.time()
+        return self._detect_final(img, boxes_c, aux_idx, telemetry)
 
+    def _detect_final(self, img, boxes_c, aux_idx, telemetry=NULL_TELEMETRY):
+        """Last stage, onet and its auxiliary outputs
+        """
         # onet
         if self.onet_detector:
-            if boxes_c is None:
-                return np.array([])
-
-            if aux_idx == 0:
-                boxes_c = self.detect_onet(img, boxes_c, aux_idx)
-            elif aux_idx == 3:
+            with telemetry.timer('onet'):
                 if boxes_c is None:
-                    return np.array([]), np.array([]), np.array([])
-                boxes_c, head_pose, land_point = self.detect_onet(img, boxes_c, aux_idx)
-                return boxes_c, head_pose, land_point
-            elif aux_idx == 2:
-                if boxes_c is None:
-                    return np.array([]), np.array([])
-                boxes_c, head_pose = self.detect_onet(img, boxes_c, aux_idx)
-                return boxes_c, head_pose
-            elif aux_idx == 1:
-                if boxes_c is None:
-                    return np.array([]), np.array([])
-                boxes_c, land_point = self.detect_onet(img, boxes_c, aux_idx)
-                return boxes_c, land_point
-            else:
-                raise NotImplementedError("Not support aux_idx.")
+                    return np.array([])
+
+                if aux_idx == 0:
+                    boxes_c = self.detect_onet(img, boxes_c, aux_idx, telemetry)
+                elif aux_idx == 3:
+                    if boxes_c is None:
+                        return np.array([]), np.array([]), np.array([])
+                    boxes_c, head_pose, land_point = self.detect_onet(img, boxes_c, aux_idx, telemetry)
+                    return boxes_c, head_pose, land_point
+                elif aux_idx == 2:
+                    if boxes_c is None:
+                        return np.array([]), np.array([])
+                    boxes_c, head_pose = self.detect_onet(img, boxes_c, aux_idx, telemetry)
+                    return boxes_c, head_pose
+                elif aux_idx == 1:
+                    if boxes_c is None:
+                        return np.array([]), np.array([])
+                    boxes_c, land_point = self.detect_onet(img, boxes_c, aux_idx, telemetry)
+                    return boxes_c, land_point
+                else:
+                    raise NotImplementedError("Not support aux_idx.")
 
         return boxes_c
-        # Consume time
-        # t3 = time.time() - t
-        # print("time cost " + '{:.3f}s'.format(t1+t2+t3))
-        # print('pnet {:.3f}s  rnet {:.3f}s  onet {:.3f}s'.format(t1, t2, t3))
+
+    def detect_stream(self, images, aux_idx=0, depth=4):
+        """Detect face in a stream of images with one worker thread per stage
+
+        PNet of a later image runs while rnet and onet refine an earlier one, sess.run of
+        one stage overlaps numpy work of the others. Stages are FIFO, so results keep input order.
+
+        Parameters:
+        ----------
+        images: iterable of numpy array
+            input images, read by a feeder thread
+        aux_idx: int
+            same as detect
+        depth: int
+            max images inside the pipeline, also the size of every stage queue
+
+        Returns:
+        -------
+        generator of detect result, one per image in input order
+        """
+        def pnet_stage(img, _):
+            boxes_c = self.detect_pnet(img) if self.pnet_detector else None
+            return (boxes_c, None) if boxes_c is not None else (None, np.array([]))
+
+        def rnet_stage(img, boxes_c):
+            if self.rnet_detector:
+                boxes_c = self.detect_rnet(img, boxes_c)
+            return (boxes_c, None) if boxes_c is not None else (None, np.array([]))
+
+        def onet_stage(img, boxes_c):
+            return None, self._detect_final(img, boxes_c, aux_idx)
+
+        stop = threading.Event()
+        in_flight = threading.Semaphore(depth)
+        queues = [queue.Queue(maxsize=depth) for _ in range(4)]
+        workers = [threading.Thread(target=_stream_feeder, args=(images, queues[0], in_flight, stop))]
+        for k, stage in enumerate([pnet_stage, rnet_stage, onet_stage]):
+            workers.append(threading.Thread(target=_stream_worker, args=(stage, queues[k], queues[k + 1], stop)))
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            while True:
+                item = _stream_get(queues[-1], stop)
+                if item is _STREAM_END:
+                    break
+                in_flight.release()
+                _, _, result, error = item
+                if error is not None:
+                    raise error
+                yield result
+        finally:
+            # Consumer may stop early, let blocked workers and the feeder quit
+            stop.set()
+            in_flight.release()
+
+    def detect_video(self, frames, aux_idx=0, detect_interval=10, track_margin=0.2, track_iou=0.3):
+        """Detect face in video frames, tracking faces of the previous frame
+
+        Previous onet boxes, expanded by track_margin of their side, go straight to rnet and onet.
+        The full cascade with pnet runs on the first frame, every detect_interval frames, when
+        all tracks are lost (on the same frame) and after some tracks are lost (on the next frame).
+
+        Parameters:
+        ----------
+        frames: iterable of numpy array
+            video frames in order
+        aux_idx: int
+            same as detect
+        detect_interval: int
+            max frames between two full cascade runs, new faces show up at the latest then
+        track_margin: float
+            expansion of a previous box on every side, relative to its width and height
+        track_iou: float
+            min IoU to keep the track id of a previous box
+
+        Returns:
+        -------
+        generator of (frame, result, track_ids, is_full) per frame, result same as detect,
+        track_ids int array aligned with the result boxes, frame is the input frame
+        """
+        tracks = np.zeros((0, 5), dtype=np.float32)
+        track_ids = np.zeros(0, dtype=np.int64)
+        next_id = 0
+        since_full = detect_interval
+        can_track = self.rnet_detector is not None or self.onet_detector is not None
+        for img in frames:
+            result = None
+            is_full = not can_track or len(tracks) == 0 or since_full >= detect_interval
+            if not is_full:
+                result = self._detect_refine(img, _expand_boxes(tracks, track_margin), aux_idx)
+                boxes_c = _result_boxes(result)
+                if len(boxes_c) == 0:
+                    is_full = True
+                elif len(boxes_c) < len(tracks):
+                    # Lost faces may be back at another place, look for them in the next frame
+                    since_full = detect_interval
+                else:
+                    since_full += 1
+            if is_full:
+                result = self.detect(img, aux_idx)
+                boxes_c = _result_boxes(result)
+                since_full = 1
+            ids = _match_tracks(tracks, track_ids, boxes_c, track_iou)
+            new = ids < 0
+            ids[new] = np.arange(next_id, next_id + new.sum())
+            next_id += new.sum()
+            tracks, track_ids = boxes_c[:, :5].copy(), ids
+            yield img, result, ids, is_full
+
+
+def _result_boxes(result):
+    """Boxes of a detect result, n x 5 array even without face"""
+    boxes_c = result[0] if type(result) is tuple else result
+    if boxes_c is None or len(boxes_c) == 0:
+        return np.zeros((0, 5), dtype=np.float32)
+    return boxes_c
+
+
+def _expand_boxes(boxes, margin):
+    """Boxes enlarged by margin of their width and height on every side"""
+    expanded = boxes.copy()
+    w = boxes[:, 2] - boxes[:, 0] + 1
+    h = boxes[:, 3] - boxes[:, 1] + 1
+    expanded[:, 0] -= w * margin
+    expanded[:, 1] -= h * margin
+    expanded[:, 2] += w * margin
+    expanded[:, 3] += h * margin
+    return expanded
+
+
+def _match_tracks(tracks, track_ids, boxes, thresh):
+    """Track id of every box from the previous boxes, greedy by IoU, -1 for a new face"""
+    ids = -np.ones(len(boxes), dtype=np.int64)
+    if len(tracks) == 0 or len(boxes) == 0:
+        return ids
+    ious = np.array([IoU(box, tracks[:, :4]) for box in boxes])
+    for flat in np.argsort(-ious, axis=None):
+        box_id, track_id = np.unravel_index(flat, ious.shape)
+        if ious[box_id, track_id] <= thresh:
+            break
+        if ids[box_id] < 0 and track_ids[track_id] not in ids:
+            ids[box_id] = track_ids[track_id]
+    return ids
+
+
+# Marks the end of an image stream
+_STREAM_END = object()
+
+
+def _stream_put(out_queue, item, stop):
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _stream_get(in_queue, stop):
+    while not stop.is_set():
+        try:
+            return in_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _STREAM_END
+
+
+def _stream_feeder(images, out_queue, in_flight, stop):
+    """Put (image, boxes_c, result, error) items of the input stream"""
+    try:
+        for img in images:
+            # Blocks while depth images are in flight, stop releases it once
+            in_flight.acquire()
+            if stop.is_set():
+                return
+            if not _stream_put(out_queue, (img, None, None, None), stop):
+                return
+    except Exception as e:
+        _stream_put(out_queue, (None, None, None, e), stop)
+    _stream_put(out_queue, _STREAM_END, stop)
+
+
+def _stream_worker(stage, in_queue, out_queue, stop):
+    """Run stage on items without result, items already finished or failed pass through"""
+    while True:
+        item = _stream_get(in_queue, stop)
+        if item is _STREAM_END:
+            _stream_put(out_queue, _STREAM_END, stop)
+            return
+        img, boxes_c, result, error = item
+        if result is None and error is None:
+            try:
+                boxes_c, result = stage(img, boxes_c)
+            except Exception as e:
+                error = e
+        if not _stream_put(out_queue, (img, boxes_c, result, error), stop):
+            return
@@ -6,6 +6,10 @@ import numpy as np
 import cv2
 
 from detectAPI import DetectAPI
+from detect_pool import DetectPool, detect_images
+from telemetry import TelemetrySink
+from tools.detections import unpack_result
+from tools.result_store import ResultStore, ResultStoreWriter, export_wider
 from prepare_data.data_base import FDDB
 from prepare_data.data_base import L300WP
 from prepare_data.data_base import LS3DW
@@ -120,10 +124,59 @@ def parse_args():
                         default=[0.4, 0.2, 0.1], type=float)
     parser.add_argument('--min_face', dest='min_face', help='minimum face size for detection',
                         default=10, type=int)
+    parser.add_argument('--max_face', dest='max_face', help='maximum face size for detection, no limit if not set',
+                        default=None, type=int)
+    parser.add_argument('--coarse_to_fine', dest='coarse_to_fine', help='run fine pyramid levels only around coarse activity',
+                        action='store_true')
+    parser.add_argument('--video', dest='video', help='video file to detect with tracking, 0 for webcam',
+                        default=None, type=str)
+    parser.add_argument('--detect_interval', dest='detect_interval', help='max frames between full pnet passes',
+                        default=10, type=int)
+    parser.add_argument('--pnet_memory_mb', dest='pnet_memory_mb', help='pnet tile working set, float buffers of pnet '
+                        'passes without image and uint8 pyramid, large levels run in tiles',
+                        default=None, type=float)
+    parser.add_argument('--tile_workers', dest='tile_workers', help='pnet tiles run in parallel', default=1, type=int)
+    parser.add_argument('--pnet_on_graph', dest='pnet_on_graph', help='pnet threshold and level nms in graph',
+                        action='store_true')
+    parser.add_argument('--size_buckets', dest='size_buckets', help='pad pnet inputs to a few bucket sizes',
+                        action='store_true')
+    parser.add_argument('--warmup', dest='warmup', help='WxH resolutions detected once at load', nargs="+",
+                        default=None, type=str)
+    parser.add_argument('--workers', dest='workers', help='detect wider images in worker processes',
+                        default=1, type=int)
+    parser.add_argument('--is_ERC', dest='is_ERC', help='rnet with early reject classifier', action='store_true')
+    parser.add_argument('--as_detections', dest='as_detections', help='columnar Detections results, also between '
+                        'worker processes', action='store_true')
+    parser.add_argument('--store', dest='store', help='append results to this result store, wider files are '
+                        'exported from it at the end', default=None, type=str)
+    parser.add_argument('--telemetry', dest='telemetry', help='export stage telemetry histograms, .json or .csv',
+                        default=None, type=str)
     args = parser.parse_args()
     return args
 
 
+def parse_resolutions(sizes):
+    """ WxH strings as (width, height) list, None if not given """
+    if not sizes:
+        return None
+    return [tuple(int(x) for x in size.split('x')) for size in sizes]
+
+
+def print_warmup(report):
+    print('%-12s %10s %10s %10s %12s' % ('resolution', 'cold ms', 'warm ms', 'cold-warm', 'new shapes'))
+    for row in report:
+        print('%-12s %10.2f %10.2f %10.2f %12d' % (row['resolution'], row['cold_ms'], row['warm_ms'],
+                                                   row['cold_ms'] - row['warm_ms'], row['new_shapes']))
+
+
+def read_frames(cap):
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            return
+        yield frame
+
+
 if __name__ == '__main__':
     args = parse_args()
     print('Called with argument:')
@@ -131,8 +184,21 @@ if __name__ == '__main__':
     #output_file = '/home/dafu/workspace/FaceDetect/tf_JDAP/evaluation/aflw2000/onet_OHEM_0.7_wop_pnet_300WLP_pose_yaw_16_0.1_0.01_0.01.txt'
     output_file = '/home/dafu/workspace/FaceDetect/tf_JDAP/evaluation/onet/onet_OHEM_0.7_wop_pnet_300WLP_landmark68_1w_mean_shape_16_0.4_0.1_0.01.txt'
     output = False
-    detector = DetectAPI(args.prefix, args.epoch, args.test_mode, args.batch_size,
-                         is_ERC=False, thresh=args.thresh, min_face_size=args.min_face)
+    api_args = (args.prefix, args.epoch, args.test_mode, args.batch_size)
+    api_kwargs = dict(is_ERC=args.is_ERC, thresh=args.thresh, min_face_size=args.min_face,
+                      max_face_size=args.max_face, coarse_to_fine=args.coarse_to_fine,
+                      pnet_memory_limit=int(args.pnet_memory_mb * 1024 * 1024) if args.pnet_memory_mb else None,
+                      tile_workers=args.tile_workers, pnet_on_graph=args.pnet_on_graph, size_buckets=args.size_buckets,
+                      warmup_resolutions=parse_resolutions(args.warmup), as_detections=args.as_detections)
+    if args.workers > 1:
+        # Bulk evaluation only, results are not drawn
+        if args.dataset_name != 'wider' or args.video is not None or args.telemetry:
+            raise ValueError('--workers is for wider evaluation without video and telemetry')
+        detector = DetectPool(*api_args, workers=args.workers, **api_kwargs)
+    else:
+        detector = DetectAPI(*api_args, telemetry_sink=TelemetrySink() if args.telemetry else None, **api_kwargs)
+        if detector.warmup_report:
+            print_warmup(detector.warmup_report)
     mode = 'val'
     is_wider = False
     # Select data set
@@ -148,48 +214,68 @@ if __name__ == '__main__':
         brew_fun = LS3DW
 
     Evaluator = brew_fun(args.dataset_path, args.name_list)
-    is_cap = False
+    is_cap = args.video is not None
 
     import time
 
     count = 1
     if is_cap:
-        cap = cv2.VideoCapture(0)
+        cap = cv2.VideoCapture(0 if args.video == '0' else args.video)
         if cap.isOpened():
+            videos = detector.detect_video(read_frames(cap), args.detect_interval)
+            frame_num, full_num, cost = 0, 0, 0.0
             while (True):
-                # get a frame
-                ret, frame = cap.read()
-                t = time.clock()
-                results = detector.detect(frame)
-                print("time: %d ms" % int((time.clock() - t) * 1000))
+                # get a frame and its result, frame reading included
+                t = time.time()
+                try:
+                    frame, results, track_ids, is_full = next(videos)
+                except StopIteration:
+                    break
+                frame_cost = time.time() - t
+                frame_num += 1
+                full_num += is_full
+                cost += frame_cost
+                print("frame %d %s faces %d time: %d ms" % (frame_num, 'full' if is_full else 'track',
+                                                            len(track_ids), int(frame_cost * 1000)))
                 # Return detect result adapt to evaluation
-                if type(results) == np.ndarray and len(results):
-                    detector.show_result(frame, results, is_cap=True)
-                elif type(results) == tuple and results[0] is not None:
+                cal_boxes = unpack_result(results)[0]
+                if len(cal_boxes):
                     detector.show_result(frame, results, is_cap=True)
+                for track_id, bbox in zip(track_ids, cal_boxes):
+                    cv2.putText(frame, str(track_id), (int(bbox[0]), int(bbox[1]) - 4), 1, 1, (0, 200, 200), 2)
 
                 # show a frame
                 cv2.imshow("capture", frame)
                 if cv2.waitKey(1) & 0xFF == ord('q'):
                     break
+            if frame_num:
+                print("%d frames, %d full pass, mean time: %.1f ms" % (frame_num, full_num, cost / frame_num * 1000))
         cap.release()
         cv2.destroyAllWindows()
     elif is_wider:
-        for label_info in Evaluator.label_infos:
+        images = (cv2.imread(Evaluator.get_image_name(label_info)) for label_info in Evaluator.label_infos)
+        store = ResultStoreWriter(args.store, detector.aux_idx) if args.store else None
+        # All output result, in order from worker processes with --workers
+        for image_id, results in enumerate(detect_images(detector, images)):
+            label_info = Evaluator.label_infos[image_id]
             count += 1
             # if count % 10:
             #     continue
             if count % 100 == 0:
                 print(count)
-            image_name = Evaluator.get_image_name(label_info)
-            # print(image_name)
-            image = cv2.imread(image_name)
-            # All output result
-            results = detector.detect(image)
-            Evaluator.do_eval(label_info, results, output_dir)
+            if store is not None:
+                store.append(label_info.strip().split()[0], results)
+            else:
+                Evaluator.do_eval(label_info, results, output_dir)
+        if store is not None:
+            store.close()
+            with ResultStore(args.store) as results_store:
+                export_wider(results_store, output_dir)
     else:
         save_dir = '/home/dafu/Pictures/300W-Testset-3D'
         # Demo test
+        # Results for eval_accuracy, read by tools/evaluation.py --eval_file <store>
+        store = ResultStoreWriter(args.store, detector.aux_idx) if args.store else None
         if output:
             fout = open(output_file, 'w')
         for label_info in Evaluator.label_infos:
@@ -203,10 +289,13 @@ if __name__ == '__main__':
             image = cv2.imread(image_name)
             # All output result
             results = detector.detect(image)
-            if output:
+            if store is not None:
+                # Name relative to the dataset, what eval_accuracy reads from the labels
+                store.append(label_info.strip().split()[0], results)
+            elif output:
                 #fout.write(Evaluator.do_eval(label_info, results, 'pose'))
                 fout.write(Evaluator.do_eval(label_info, results))
-            elif (type(results) == np.ndarray and len(results)) or (type(results) == tuple and results[0] is not None):
+            elif len(unpack_result(results)[0]):
                 # Return detect result adapt to evaluation
                 if save_dir != '':
                     detector.show_result(image, results, os.path.join(save_dir, os.path.basename(image_name)))
@@ -214,3 +303,17 @@ if __name__ == '__main__':
                     detector.show_result(image, results)
         if output:
             fout.close()
+        if store is not None:
+            store.close()
+    if isinstance(detector, DetectPool):
+        detector.close()
+    else:
+        print('PNet pixels: %s' % detector.jdap_detector.pixel_stats())
+        print('Buffer arena: %s' % detector.jdap_detector.arena_stats())
+        if args.is_ERC:
+            print('RNet early reject: %s' % detector.erc_stats())
+    if args.telemetry:
+        if args.telemetry.endswith('.csv'):
+            detector.telemetry_sink.to_csv(args.telemetry)
+        else:
+            detector.telemetry_sink.to_json(args.telemetry)
@@ -0,0 +1,45 @@
+import tensorflow as tf
+from tools.freeze_graph import read_graph_def
+
+
+class Runtime(object):
+    def __init__(self, intra_op_threads=0, inter_op_threads=0):
+        """
+        Graph and session that one or several detectors are built in.
+        Args:
+            intra_op_threads: Threads of one op (matmul, conv), 0 lets tensorflow pick
+            inter_op_threads: Ops run in parallel, 0 lets tensorflow pick
+        """
+        self.graph = tf.Graph()
+        config = tf.ConfigProto(allow_soft_placement=True, gpu_options=tf.GPUOptions(allow_growth=True),
+                                intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self._import_num = 0
+
+    def restore(self, build_fn, model_path):
+        """ Build a net in the graph and restore only the variables it created from checkpoint
+        Returns:
+            what build_fn returns
+        """
+        with self.graph.as_default():
+            existing = set(tf.global_variables())
+            outputs = build_fn()
+            saver = tf.train.Saver([v for v in tf.global_variables() if v not in existing])
+            saver.restore(self.sess, model_path)
+        return outputs
+
+    def import_frozen(self, pb_path):
+        """ Import a frozen GraphDef under its own name scope
+        Returns:
+            scope of the imported nodes
+        """
+        scope = 'frozen_%d' % self._import_num
+        self._import_num += 1
+        with self.graph.as_default():
+            tf.import_graph_def(read_graph_def(pb_path), name=scope)
+        return scope
+
+    def close(self):
+        """ Free the session, detectors built in this runtime can not run after """
+        self.sess.close()
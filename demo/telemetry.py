@@ -0,0 +1,149 @@
+"""
+Per image telemetry of JDAPDetector
+@@Telemetry: wall time of stages and pyramid levels, crop and network time, candidate counts, batch fill
+@@TelemetrySink: thread safe histograms of many records per image class, exported as JSON or CSV
+"""
+import csv
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+
+# Histogram bucket upper bounds, the last bucket is open
+TIME_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000]
+FILL_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+BUCKETS = {'time_ms': TIME_BUCKETS_MS, 'count': COUNT_BUCKETS, 'fill': FILL_BUCKETS}
+
+
+class Telemetry(object):
+    def __init__(self, tag=None):
+        """
+        Measurements of one detect call, filled by the stage methods it is passed to.
+        Names are "<stage>/<part>", e.g. rnet/crop, rnet/net, rnet/threshold, and
+        "level<id>/<part>" for pnet pyramid levels, level sizes are in level_sizes.
+        Args:
+            tag: Image class the record is aggregated under, image resolution if None
+        """
+        self.tag = tag
+        self.times = OrderedDict()
+        self.counts = OrderedDict()
+        self.fills = OrderedDict()
+        self.level_sizes = OrderedDict()
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def count(self, name, num):
+        self.counts[name] = self.counts.get(name, 0) + num
+
+    def fill(self, name, rows, padded_rows):
+        """ Real rows over rows run with batch padding """
+        self.fills[name] = float(rows) / max(padded_rows, 1)
+
+    def level(self, level_id, tuple_wh):
+        """ Name prefix of a pyramid level """
+        self.level_sizes[level_id] = tuple_wh
+        return 'level%02d' % level_id
+
+    def as_dict(self):
+        return OrderedDict([('tag', self.tag),
+                            ('time_ms', OrderedDict([(k, v * 1000) for k, v in self.times.items()])),
+                            ('count', self.counts),
+                            ('fill', self.fills),
+                            ('level_sizes', OrderedDict([(k, list(v)) for k, v in self.level_sizes.items()]))])
+
+
+class _NullTelemetry(Telemetry):
+    """ Stage methods called without a record, nothing is measured """
+    @contextmanager
+    def timer(self, name):
+        yield
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, num):
+        pass
+
+    def fill(self, name, rows, padded_rows):
+        pass
+
+    def level(self, level_id, tuple_wh):
+        return 'level%02d' % level_id
+
+
+NULL_TELEMETRY = _NullTelemetry(tag='')
+
+
+class TelemetrySink(object):
+    def __init__(self):
+        """
+        Histograms of every measurement over submitted records, per tag.
+        """
+        self._lock = threading.Lock()
+        # (tag, kind, name) -> [bucket counts, num, sum, max]
+        self._stats = OrderedDict()
+        self.record_num = 0
+
+    def submit(self, telemetry):
+        record = telemetry.as_dict()
+        with self._lock:
+            self.record_num += 1
+            for kind in ['time_ms', 'count', 'fill']:
+                for name, value in record[kind].items():
+                    self._add(record['tag'], kind, name, value)
+
+    def _add(self, tag, kind, name, value):
+        key = (tag, kind, name)
+        # numpy scalars are not json serializable
+        value = int(value) if kind == 'count' else float(value)
+        stat = self._stats.get(key)
+        if stat is None:
+            stat = [np.zeros(len(BUCKETS[kind]) + 1, dtype=np.int64), 0, 0.0, value]
+            self._stats[key] = stat
+        stat[0][np.searchsorted(BUCKETS[kind], value, side='left')] += 1
+        stat[1] += 1
+        stat[2] += value
+        stat[3] = max(stat[3], value)
+
+    def summary(self):
+        """ One row per (tag, kind, name): num, mean, max, p50/p90/p99 (bucket upper bound) and bucket counts
+        """
+        rows = list()
+        with self._lock:
+            for (tag, kind, name), (hist, num, total, max_value) in self._stats.items():
+                bounds = BUCKETS[kind] + [max_value]
+                cum = np.cumsum(hist)
+                row = OrderedDict([('tag', tag), ('kind', kind), ('name', name), ('num', num),
+                                   ('mean', total / num), ('max', max_value)])
+                for q in [50, 90, 99]:
+                    row['p%d' % q] = min(bounds[np.searchsorted(cum, num * q / 100.0, side='left')], max_value)
+                row['buckets'] = OrderedDict([('<=%g' % b, int(c)) for b, c in zip(BUCKETS[kind], hist)] +
+                                             [('>%g' % BUCKETS[kind][-1], int(hist[-1]))])
+                rows.append(row)
+        return rows
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'records': self.record_num, 'stats': self.summary()}, f, indent=2)
+
+    def to_csv(self, path):
+        """ Long format, one line per histogram bucket """
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['tag', 'kind', 'name', 'num', 'mean', 'max', 'p50', 'p90', 'p99', 'bucket', 'bucket_num'])
+            for row in self.summary():
+                head = list(row.values())[:-1]
+                for bucket, bucket_num in row['buckets'].items():
+                    writer.writerow(head + [bucket, bucket_num])
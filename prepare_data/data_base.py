@@ -2,6 +2,8 @@ import os.path as osp
 import numpy as np
 from collections import OrderedDict
 from tools.utils import *
+from tools.detections import unpack_result
+from tools.result_store import ResultStore, is_result_store, fddb_lines, wider_lines
 import cv2
 
 __all__ = ['FDDB', 'WIDER', 'CelebA', 'AFLW', 'L300WP', 'LS3DW']
@@ -22,12 +24,7 @@ def redetect(image_info, detector, eval_mode):
     square_bbox = np.array([int(x) for x in square_bbox])
     dets = square_bbox[np.newaxis, :]
 
-    [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = pad(dets, width, height)
-    cropped_ims = np.zeros((1, 48, 48, 3), dtype=np.float32)
-    for i in range(1):
-        tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.uint8)
-        tmp[dy[i]:edy[i] + 1, dx[i]:edx[i] + 1, :] = image[y[i]:ey[i] + 1, x[i]:ex[i] + 1, :]
-        cropped_ims[i, :, :, :] = resize_image_by_wh(tmp, (48, 48))
+    cropped_ims = crop_resize_batch(image, dets, 48, normalize=False)
     results = detector.predict(cropped_ims)
     landmark_reg = []
     head_pose = []
@@ -57,6 +54,72 @@ def redetect(image_info, detector, eval_mode):
     return head_pose, land_point
 
 
+def _landmark_pose_line(pure_name, cal_boxes, pose_reg=None, landmark_reg=None):
+    """ name n, rounded boxes, pose (1 or 3 per box) and landmark points (x y per point) of every box """
+    box_num = len(cal_boxes)
+    best_box = np.round(cal_boxes[:, :4]).astype(np.int32)
+    parts = [pure_name, ' %d ' % box_num, '%d ' * best_box.size % tuple(best_box.ravel())]
+    if pose_reg is not None:
+        pose_reg = np.asarray(pose_reg)[:, :3]
+        parts.append('%.4f ' * pose_reg.size % tuple(pose_reg.ravel()))
+    if landmark_reg is not None:
+        # [x x x .. y y y ..] to x y x y ..
+        points = np.asarray(landmark_reg).reshape(box_num, 2, -1).transpose(0, 2, 1)
+        parts.append('%d ' * points.size % tuple(points.ravel()))
+    parts.append('\n')
+    return ''.join(parts)
+
+
+def _predictions(eval_file, eval_mode):
+    """ (image name, n, boxes, pose, landmarks) of every image of an eval file or result store,
+    landmarks as x y of every point, pose and landmarks None if not in eval_mode or n is 0
+    """
+    if isinstance(eval_file, ResultStore) or is_result_store(eval_file):
+        store = eval_file if isinstance(eval_file, ResultStore) else ResultStore(eval_file)
+        try:
+            for image_name, detections in store.items():
+                # Checked on every record, images without face have the columns too
+                has_column = {'pose': detections.pose is not None, 'landmark': detections.landmarks is not None}
+                missing = [x for x in ['pose', 'landmark'] if x in eval_mode and not has_column[x]]
+                if missing:
+                    # No views of the store left for its close
+                    del detections
+                    raise ValueError('Result store %s has no %s column for eval_mode %s' %
+                                     (store.path, ' and '.join(missing), eval_mode))
+                # Copies, the mapped store is closed at the end
+                cand_num = len(detections)
+                box_pred = np.round(detections.boxes).astype(np.int32)
+                pose_pred, landmark_pred = None, None
+                if cand_num and 'pose' in eval_mode:
+                    # Rounded as do_eval lines write it, both inputs give the same accuracy
+                    pose_pred = np.round(detections.pose[:, :3].astype(np.float64), 4).astype(np.float32)
+                if cand_num and 'landmark' in eval_mode:
+                    landmark_pred = detections.landmarks.reshape(cand_num, 2, -1).transpose(0, 2, 1)
+                    landmark_pred = landmark_pred.reshape(cand_num, -1).astype(np.int32)
+                del detections
+                yield image_name, cand_num, box_pred, pose_pred, landmark_pred
+        finally:
+            if store is not eval_file:
+                store.close()
+        return
+    with open(eval_file, 'r') as f:
+        for pred in f:
+            detect_info = pred.strip().split()
+            image_name = detect_info[0]
+            cand_num = int(detect_info[1])
+            pred_info = np.array(detect_info[2:])
+            box_pred = np.reshape(pred_info[:cand_num * 4], [cand_num, 4]).astype(np.int32)
+            pred_info = pred_info[cand_num * 4:]
+            pose_pred, landmark_pred = None, None
+            if cand_num and 'pose' in eval_mode:
+                pose_dim = 3
+                pose_pred = np.reshape(pred_info[:cand_num * pose_dim], [cand_num, pose_dim]).astype(np.float32)
+                pred_info = pred_info[cand_num * pose_dim:]
+            if cand_num and 'landmark' in eval_mode:
+                landmark_pred = np.reshape(pred_info, [cand_num, -1]).astype(np.int32)
+            yield image_name, cand_num, box_pred, pose_pred, landmark_pred
+
+
 class _DataBase(object):
     def __init__(self, dataset_path, image_name_file):
         self.label_infos = self.get_labels(image_name_file)
@@ -77,7 +140,7 @@ class _DataBase(object):
         """
 
         Args:
-            eval_file:
+            eval_file: do_eval lines or a result store of the same images in order
             eval_dim:
             eval_mode:
             detector: if fail detect face, using detector
@@ -92,95 +155,84 @@ class _DataBase(object):
         yaw_pose_cls_error_pose = np.zeros([3, 3], dtype=np.float32)
         yaw_pose_cls_error_landmark = np.zeros([3, eval_dim], dtype=np.float32)
         yaw_pose_cls_sample_num = np.zeros([3], dtype=np.int32)
-        with open(eval_file, 'r') as f:
-            detect_result = f.readlines()
-            valid_num = 0
-            for gt_info, pred in zip(self.label_infos, detect_result):
-                gt_result = self.label_parser(gt_info)
-                gt_image_name = gt_result['image_name'][len(self.dataset_path) + 1:].strip()
-                gt_box = gt_result['gt_boxes']
-                gt_pose = gt_result['head_pose']
-                yaw_pose_cls_index = np.abs(int(gt_pose[1] * 180 / 3.14)) / 30
-                if yaw_pose_cls_index >= 3:
-                    yaw_pose_cls_index = 2
-                gt_landmark = np.reshape(gt_result['landmarks'], [-1, 2]).astype(np.int32)
-                normalizer = np.sqrt((gt_box[3] - gt_box[1] + 1) * (gt_box[2] - gt_box[0] + 1))
-
-                detect_info = pred.strip().split()
-                image_name = detect_info[0]
-                if image_name != gt_image_name:
-                    assert (image_name + ' is not match ' + gt_image_name)
-                cand_num = int(detect_info[1])
-                pred_info = np.array(detect_info[2:])
-                box_pred = np.reshape(pred_info[:cand_num * 4], [cand_num, 4]).astype(np.int32)
-                pred_info = pred_info[cand_num * 4:]
-                is_fail_detect = False
-                if cand_num == 0:
-                    #print(image_name + ' fail detect.')
+        valid_num = 0
+        for gt_info, pred in zip(self.label_infos, _predictions(eval_file, eval_mode)):
+            gt_result = self.label_parser(gt_info)
+            gt_image_name = gt_result['image_name'][len(self.dataset_path) + 1:].strip()
+            gt_box = gt_result['gt_boxes']
+            gt_pose = gt_result['head_pose']
+            yaw_pose_cls_index = np.abs(int(gt_pose[1] * 180 / 3.14)) / 30
+            if yaw_pose_cls_index >= 3:
+                yaw_pose_cls_index = 2
+            gt_landmark = np.reshape(gt_result['landmarks'], [-1, 2]).astype(np.int32)
+            normalizer = np.sqrt((gt_box[3] - gt_box[1] + 1) * (gt_box[2] - gt_box[0] + 1))
+
+            image_name, cand_num, box_pred, pose_cands, landmark_cands = pred
+            # Stores hold the relative name, do_eval lines the base name
+            if image_name not in (gt_image_name, osp.basename(gt_image_name)):
+                raise ValueError(image_name + ' is not match ' + gt_image_name)
+            is_fail_detect = False
+            if cand_num == 0:
+                #print(image_name + ' fail detect.')
+                fail_image_info.append(gt_result)
+                is_fail_detect = True
+                best_id = 0
+                pose_pred, landmark_pred = redetect(gt_result, detector, eval_mode)
+            else:
+                ious = IoU(gt_box, box_pred)
+                best_id = np.argmax(ious)
+                if ious[best_id] < 0.4:
+                    #print(gt_image_name + ' without suitable face.')
                     fail_image_info.append(gt_result)
                     is_fail_detect = True
                     best_id = 0
                     pose_pred, landmark_pred = redetect(gt_result, detector, eval_mode)
-                else:
-                    ious = IoU(gt_box, box_pred)
-                    best_id = np.argmax(ious)
-                    if ious[best_id] < 0.4:
-                        #print(gt_image_name + ' without suitable face.')
-                        fail_image_info.append(gt_result)
-                        is_fail_detect = True
-                        best_id = 0
-                        pose_pred, landmark_pred = redetect(gt_result, detector, eval_mode)
-
-                if is_fail_detect == False:
-                    if 'pose' in eval_mode:
-                        pose_dim = 3
-                        pose_pred = np.reshape(pred_info[:cand_num * pose_dim], [cand_num, pose_dim]).astype(np.float32)
-                        pred_info = pred_info[cand_num * pose_dim:]
-                    if 'landmark' in eval_mode:
-                        landmark_pred = np.reshape(pred_info, [cand_num, -1]).astype(np.int32)
-
-                if 'landmark' in eval_mode:
-                    landmark_pred = np.reshape(np.array(landmark_pred[best_id], np.int32), [-1, 2])
-                    if eval_dim == 7:
-                        gt_landmark = gt_landmark[seven_points_idx]
-                        if landmark_pred.shape[0] != 7:
-                            landmark_pred = landmark_pred[seven_points_idx]
-                    elif eval_dim == 68:
-                        assert (landmark_pred.shape[0] == eval_dim)
-
-                    yaw_pose_cls_error_landmark[yaw_pose_cls_index] += \
-                        np.sqrt(np.square(gt_landmark[:, 0] - landmark_pred[:, 0]) +
-                                np.square(gt_landmark[:, 1] - landmark_pred[:, 1])) / normalizer
-                if 'pose' in eval_mode:
-                    pose_pred = pose_pred[best_id]
-                    yaw_pose_cls_error_pose[yaw_pose_cls_index] += np.abs(gt_pose - pose_pred)
-                valid_num += 1
-                yaw_pose_cls_sample_num[yaw_pose_cls_index] += 1
-                if vis and is_fail_detect:
-                    image = cv2.imread(gt_result['image_name'])
-                    for i in range(eval_dim):
-                        cv2.circle(image, (gt_landmark[i][0], gt_landmark[i][1]), 1, (0, 0, 255), 2)
-                    for i in range(eval_dim):
-                        cv2.circle(image, (int(landmark_pred[i][0]), int(landmark_pred[i][1])), 1, (0, 255, 0), 2)
-                    for m in range(cand_num):
-                        cv2.rectangle(image, (box_pred[m][0], box_pred[m][1]), (box_pred[m][2], box_pred[m][3]),
-                                      (0, 0, 128), 2)
-                    cv2.rectangle(image, (gt_box[0], gt_box[1]), (gt_box[2], gt_box[3]), (200, 200, 0), 2)
-                    cv2.imshow('a', image)
-                    cv2.waitKey(0)
-
-            print("angle bin: [0,30]   (30,60]    (60,)")
-            print("sample num:")
-            print(yaw_pose_cls_sample_num)
+
+            if is_fail_detect == False:
+                pose_pred, landmark_pred = pose_cands, landmark_cands
+
             if 'landmark' in eval_mode:
-                #print(yaw_pose_cls_error_landmark / yaw_pose_cls_sample_num)
-                print("small    medium  large")
-                landmark_error = np.sum(np.transpose(yaw_pose_cls_error_landmark) / yaw_pose_cls_sample_num, axis=0) * 100 / eval_dim
-                print(landmark_error)
-                print(np.mean(landmark_error))
-                print(np.std(landmark_error))
+                landmark_pred = np.reshape(np.array(landmark_pred[best_id], np.int32), [-1, 2])
+                if eval_dim == 7:
+                    gt_landmark = gt_landmark[seven_points_idx]
+                    if landmark_pred.shape[0] != 7:
+                        landmark_pred = landmark_pred[seven_points_idx]
+                elif eval_dim == 68:
+                    assert (landmark_pred.shape[0] == eval_dim)
+
+                yaw_pose_cls_error_landmark[yaw_pose_cls_index] += \
+                    np.sqrt(np.square(gt_landmark[:, 0] - landmark_pred[:, 0]) +
+                            np.square(gt_landmark[:, 1] - landmark_pred[:, 1])) / normalizer
             if 'pose' in eval_mode:
-                print((np.transpose(yaw_pose_cls_error_pose) / yaw_pose_cls_sample_num) * 180 / 3.14)
+                pose_pred = pose_pred[best_id]
+                yaw_pose_cls_error_pose[yaw_pose_cls_index] += np.abs(gt_pose - pose_pred)
+            valid_num += 1
+            yaw_pose_cls_sample_num[yaw_pose_cls_index] += 1
+            if vis and is_fail_detect:
+                image = cv2.imread(gt_result['image_name'])
+                for i in range(eval_dim):
+                    cv2.circle(image, (gt_landmark[i][0], gt_landmark[i][1]), 1, (0, 0, 255), 2)
+                for i in range(eval_dim):
+                    cv2.circle(image, (int(landmark_pred[i][0]), int(landmark_pred[i][1])), 1, (0, 255, 0), 2)
+                for m in range(cand_num):
+                    cv2.rectangle(image, (box_pred[m][0], box_pred[m][1]), (box_pred[m][2], box_pred[m][3]),
+                                  (0, 0, 128), 2)
+                cv2.rectangle(image, (gt_box[0], gt_box[1]), (gt_box[2], gt_box[3]), (200, 200, 0), 2)
+                cv2.imshow('a', image)
+                cv2.waitKey(0)
+
+        print("angle bin: [0,30]   (30,60]    (60,)")
+        print("sample num:")
+        print(yaw_pose_cls_sample_num)
+        if 'landmark' in eval_mode:
+            #print(yaw_pose_cls_error_landmark / yaw_pose_cls_sample_num)
+            print("small    medium  large")
+            landmark_error = np.sum(np.transpose(yaw_pose_cls_error_landmark) / yaw_pose_cls_sample_num, axis=0) * 100 / eval_dim
+            print(landmark_error)
+            print(np.mean(landmark_error))
+            print(np.std(landmark_error))
+        if 'pose' in eval_mode:
+            print((np.transpose(yaw_pose_cls_error_pose) / yaw_pose_cls_sample_num) * 180 / 3.14)
         results = {'fail_image_info': fail_image_info, 'yaw_pose_cls_sample_num': yaw_pose_cls_sample_num,
                    'yaw_pose_cls_error_pose': yaw_pose_cls_error_pose,
                    'yaw_pose_cls_error_landmark': yaw_pose_cls_error_landmark}
@@ -208,20 +260,7 @@ class FDDB(_DataBase):
     def do_eval(self, image_name, results):
         #pure_image_name = os.path.splitext(image_name.split(self.dataset_path)[-1][1:])
         pure_image_name = image_name.strip()
-        cal_boxes = results[0] if type(results) is tuple else results
-
-        box_num = cal_boxes.shape[0]
-        x = cal_boxes[:, 0]
-        y = cal_boxes[:, 1]
-        w = cal_boxes[:, 2] - cal_boxes[:, 0] + 1
-        h = cal_boxes[:, 3] - cal_boxes[:, 1] + 1
-        scores = cal_boxes[:, 4]
-
-        write_result = '%s \n%d\n' % (pure_image_name, box_num)
-        for i in range(box_num):
-            # Face rect and score
-            write_result += '%d %d %d %d %.4f\n' % (x[i], y[i], w[i], h[i], scores[i])
-        return write_result
+        return fddb_lines(pure_image_name, unpack_result(results)[0])
 
 
 class WIDER(_DataBase):
@@ -243,7 +282,8 @@ class WIDER(_DataBase):
         super(WIDER, self).__init__(dataset_root_path, image_name_file)
         self.dataset_image_path = osp.join(dataset_root_path, image_dir_name)
         self.mode = mode
-        self.is_make_empty_dir = False
+        # Output dirs made so far, do_eval makes the dir of its image only
+        self.made_dirs = set()
 
 
     # TODO: parser regular
@@ -260,10 +300,13 @@ class WIDER(_DataBase):
     def make_empty_dir(self, output_dir_root):
         for label_info in self.label_infos:
             curr_dir_name = self.get_image_name(label_info).split('/')[-2]
-            make_dir_name = os.path.join(output_dir_root, curr_dir_name)
-            if not os.path.exists(make_dir_name):
-                os.makedirs(make_dir_name)
-        self.is_make_empty_dir = True
+            self.make_dir(os.path.join(output_dir_root, curr_dir_name))
+
+    def make_dir(self, dir_name):
+        if dir_name not in self.made_dirs:
+            if not os.path.exists(dir_name):
+                os.makedirs(dir_name)
+            self.made_dirs.add(dir_name)
 
     def do_eval(self, label_info, results, output_dir_root):
         """ Format
@@ -274,33 +317,18 @@ class WIDER(_DataBase):
             ...
             < face im >
         """
-        if self.is_make_empty_dir == False:
-            self.make_empty_dir(output_dir_root)
         image_name = self.get_image_name(label_info)
         split_info = image_name.split('/')
         pure_image_name = split_info[-1]
         output_dir_name = os.path.join(output_dir_root, split_info[-2])
+        self.make_dir(output_dir_name)
         output_file_name = os.path.join(output_dir_name, pure_image_name[:-4] + '.txt')
-        cal_boxes = results[0] if type(results) is tuple else results
-        write_result = '%s \n' % pure_image_name
-        if (cal_boxes is None) or len(cal_boxes) == 0:
+        cal_boxes = unpack_result(results)[0]
+        if len(cal_boxes) == 0:
             print(pure_image_name + ' fail to detect.')
-            write_result += '0 \n'
-        else:
-            box_num = cal_boxes.shape[0]
-            x = cal_boxes[:, 0]
-            y = cal_boxes[:, 1]
-            w = cal_boxes[:, 2] - cal_boxes[:, 0] + 1
-            h = cal_boxes[:, 3] - cal_boxes[:, 1] + 1
-            scores = cal_boxes[:, 4]
-
-            write_result += '%d\n' % box_num
-            for i in range(box_num):
-                # Face rect and score
-                write_result += '%d %d %d %d %.4f\n' % (x[i], y[i], w[i], h[i], scores[i])
-        fout = open(output_file_name, 'w')
-        fout.write(write_result)
-        fout.close()
+        write_result = wider_lines(pure_image_name, cal_boxes)
+        with open(output_file_name, 'w') as fout:
+            fout.write(write_result)
         return write_result
 
 
@@ -330,39 +358,16 @@ class L300WP(_DataBase):
 
     def do_eval(self, label_info, results, task='landmark_pose'):
         info_dict = self.label_parser(label_info)
-        cal_boxes = results[0] if type(results) is tuple else results
+        cal_boxes, pose_reg, landmark_reg = unpack_result(results)
         pure_name = (info_dict['image_name']).split('/')[-1]
         write_result = pure_name
         if (cal_boxes is None) or len(cal_boxes) == 0:
             print(info_dict['image_name'] + ' fail to detect.')
             return write_result + ' 0 \n'
 
-        best_box = np.round(cal_boxes).astype(np.int32)
-        has_landmark = False
-        if 'landmark' in task:
-            has_landmark = True
-            landmark_reg = results[-1]
-        has_head_pose = False
-        if 'pose' in task:
-            has_head_pose = True
-            pose_reg = results[1]
-        cand_box_num = len(best_box)
-        write_result += ' %d ' % cand_box_num
-        for box_id in range(cand_box_num):
-            write_result += ''.join(['%d ' % x for x in best_box[box_id][:-1]])
-        if has_head_pose:
-            for box_id in range(cand_box_num):
-                if pose_reg.shape[1] == 1:
-                    write_result += '%.4f ' % (pose_reg[box_id][0])
-                else:
-                    write_result += '%.4f %.4f %.4f ' % (pose_reg[box_id][0], pose_reg[box_id][1], pose_reg[box_id][2])
-        if has_landmark:
-            landmard_pt_num = landmark_reg.shape[-1] // 2
-            for box_id in range(cand_box_num):
-                for l in range(landmard_pt_num):
-                    write_result += '%d %d ' % (landmark_reg[box_id][l], landmark_reg[box_id][landmard_pt_num + l])
-        write_result += '\n'
-        return write_result
+        pose_reg = pose_reg if 'pose' in task else None
+        landmark_reg = landmark_reg if 'landmark' in task else None
+        return _landmark_pose_line(pure_name, cal_boxes, pose_reg, landmark_reg)
 
 
 class LS3DW(_DataBase):
@@ -379,25 +384,14 @@ class LS3DW(_DataBase):
 
     def do_eval(self, label_info, results, task='landmark_pose'):
         info_dict = self.label_parser(label_info)
-        cal_boxes = results[0] if type(results) is tuple else results
+        cal_boxes, pose_reg, landmark_reg = unpack_result(results)
         pure_name = (info_dict['image_name']).split('/')[-1]
         write_result = pure_name
         if (cal_boxes is None) or len(cal_boxes) == 0:
             print(info_dict['image_name'] + ' fail to detect.')
             return write_result + ' 0 \n'
 
-        best_box = np.round(cal_boxes).astype(np.int32)
-        landmark_reg = results[-1]
-        cand_box_num = len(best_box)
-        write_result += ' %d ' % cand_box_num
-        for box_id in range(cand_box_num):
-            write_result += '%d %d %d %d ' % (best_box[box_id][0], best_box[box_id][1], best_box[box_id][2], best_box[box_id][3])
-        if 'landmark' in task:
-            for box_id in range(cand_box_num):
-                for l in range(landmark_reg.shape[-1]//2):
-                    write_result += '%d %d ' % (landmark_reg[box_id][l], landmark_reg[box_id][landmark_reg.shape[-1]//2 + l])
-        write_result += '\n'
-        return write_result
+        return _landmark_pose_line(pure_name, cal_boxes, None, landmark_reg if 'landmark' in task else None)
 
 
 class CelebA(_DataBase):
@@ -10,7 +10,8 @@ from operator import itemgetter, attrgetter
 LANDMARK_POINTS = 68
 SAMPLE_PER_IMAGE = 3
 IOU_THRESH = 0.65
-MAX_MEMORY = 3000 * 4000
+# PNet tile working set of the detector, large images run in tiles instead of being skipped
+PNET_MEMORY_LIMIT = 1024 * 1024 * 1024
 net_size = 48
 
 def celeba_test_net_save(dataset_path, annotation_file, annotation_box_file, output_file, mtcnn_detector, vis=False):
@@ -40,9 +41,6 @@ def celeba_test_net_save(dataset_path, annotation_file, annotation_box_file, out
         gt_box[3] = gt_box[1] + gt_box[3]
         image = cv2.imread(im_path)
         image_height, image_width, _ = image.shape
-        # Avoid GPU memory broken
-        if image_height * image_width >= MAX_MEMORY:
-            continue
         boxes = mtcnn_detector.detect(image)
         ious = IoU(gt_box, boxes)
         if len(boxes) == 0 or len(gt_box) == 0:
@@ -113,8 +111,6 @@ def aflw_test_net_save(dataset_path, annotation_file, output_file, mtcnn_detecto
         image_path = os.path.join(dataset_path, fileName)
         image = cv2.imread(image_path)
         image_height, image_width, _ = image.shape
-        if image_width * image_height >= MAX_MEMORY:
-            continue
         boxes = mtcnn_detector.detect(image)
         if len(boxes) == 0 or len(gt_box) == 0:
             continue
@@ -170,9 +166,6 @@ def test_core(detector, dataset_indicator, save_dir, output_file, vis=False):
         print(image_name)
         image = cv2.imread(image_name)
         image_height, image_width, _ = image.shape
-        # Avoid GPU memory broken
-        if image_height * image_width >= MAX_MEMORY:
-            continue
         # Detect image
         bbox_c = detector.detect(image)
         if len(bbox_c) == 0 or len(gt_box) == 0:
@@ -239,7 +232,8 @@ if __name__ == '__main__':
     # Load model and dataset_indicator
     detector = DetectAPI(['../models/pnet/pnet_OHEM_0.7_wo_pooling/pnet',
                           '../models/rnet/rnet_wider_OHEM_0.7_wop_pnet/rnet', ''],
-                         [13, 16, 16], "rnet", [2048, 256, 16], False, [0.4, 0.1, 0.1], 64)
+                         [13, 16, 16], "rnet", [2048, 256, 16], False, [0.4, 0.1, 0.1], 64,
+                         pnet_memory_limit=PNET_MEMORY_LIMIT)
     dataset_name = '300WLP'
     if dataset_name == '300WLP':
         dataset_dir = '/home/dafu/data/300W-LP'
@@ -1,4 +1,5 @@
 from demo.detectAPI import DetectAPI
+from demo.detect_pool import DetectPool, detect_images
 from data_base import WIDER
 from tools.utils import *
 
@@ -25,14 +26,13 @@ def detect_save_pickle(detector, dataset_indicator, pickle_name):
         raise Exception("pickle file not exist.")
     fin.close()
 
-    for label_info in dataset_indicator.label_infos:
+    images = (cv2.imread(dataset_indicator.get_image_name(x)) for x in dataset_indicator.label_infos)
+    # Detector is DetectAPI or DetectPool, results in image order either way
+    for cal_boxes in detect_images(detector, images):
         # Interactive information
         if count % 100 == 0:
             print("Handle image %d " % count)
         count += 1
-        image_name = dataset_indicator.get_image_name(label_info)
-        image = cv2.imread(image_name)
-        cal_boxes = detector.detect(image)
         detections.append(cal_boxes)
 
     with open(pickle_name, 'wb') as f:
@@ -210,6 +210,8 @@ def parse_args():
                         default=[0.4, 0.1, 0.7], type=float)
     parser.add_argument('--min_face', dest='min_face', help='minimum face size for detection',
                         default=48, type=int)
+    parser.add_argument('--workers', dest='workers', help='detector processes, each loads its own models',
+                        default=1, type=int)
     args = parser.parse_args()
     return args
 
@@ -226,10 +228,16 @@ if __name__ == '__main__':
     val_pickle_name = osp.join(osp.join(data_dir, 'cands_val_%s%d_0.4_0.1.pkl' % (add_dir_name, net_size)))
     if stage == 1:
         # Load model and dataset_indicator
-        detector = DetectAPI(args.prefix, args.epoch, args.test_mode, args.batch_size, False, args.thresh, args.min_face)
+        api_args = (args.prefix, args.epoch, args.test_mode, args.batch_size, False, args.thresh, args.min_face)
+        if args.workers > 1:
+            detector = DetectPool(*api_args, workers=args.workers)
+        else:
+            detector = DetectAPI(*api_args)
         # 1. Detect and save pickle
         detect_save_pickle(detector, train_dataset_indicator, train_pickle_name)
         detect_save_pickle(detector, val_dataset_indicator, val_pickle_name)
+        if args.workers > 1:
+            detector.close()
 
     elif stage == 2:
         # 2. Crop and save face samples by pickle file
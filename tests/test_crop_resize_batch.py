@@ -0,0 +1,82 @@
+"""
+crop_resize_batch against the per box crop path it replaced
+@@Reference: zero image of every box, copy of its part inside the image, resize_image_by_wh
+"""
+import unittest
+import numpy as np
+from tools.arena import BufferArena
+from tools.utils import crop_resize_batch, pad, resize_image_by_wh
+
+
+def reference_crops(img, dets, net_size):
+    """ Per box pad + resize_image_by_wh, a box entirely outside the image stays zero """
+    height, width, _ = img.shape
+    [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = pad(dets, width, height)
+    cropped_ims = np.zeros((dets.shape[0], net_size, net_size, 3), dtype=np.float32)
+    for i in range(dets.shape[0]):
+        tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.uint8)
+        if ex[i] >= x[i] and ey[i] >= y[i]:
+            tmp[dy[i]:edy[i] + 1, dx[i]:edx[i] + 1, :] = img[y[i]:ey[i] + 1, x[i]:ex[i] + 1, :]
+        cropped_ims[i, :, :, :] = resize_image_by_wh(tmp, (net_size, net_size))
+    return cropped_ims
+
+
+def boxes(rows):
+    return np.array([list(row) + [0.9] for row in rows], dtype=np.float32)
+
+
+class CropOutsideTest(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.RandomState(0).randint(0, 256, (60, 80, 3)).astype(np.uint8)
+
+    def test_outside_boxes_are_zero_padding(self):
+        # Border box first, its scratch crop must not leak into the outside boxes after it
+        dets = boxes([(-10, -10, 19, 19), (100, 10, 129, 39), (10, -50, 39, -21), (-40, 70, -11, 99),
+                      (20, 20, 43, 43)])
+        expected = reference_crops(self.img, dets.copy(), 24)
+        got = crop_resize_batch(self.img, dets.copy(), 24)
+        np.testing.assert_array_equal(got, expected)
+        np.testing.assert_array_equal(got[1:4], np.float32(-127.5 * 0.0078125))
+
+
+class CropEquivalenceTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.img = rng.randint(0, 256, (90, 120, 3)).astype(np.uint8)
+        height, width, _ = self.img.shape
+        rows = list()
+        for kind in ['inside', 'partly', 'outside', 'degenerate'] * 12:
+            if kind == 'degenerate':
+                # 1 pixel boxes and 1 pixel wide or high strips, on the border too
+                x1, y1 = rng.randint(-1, width + 1), rng.randint(-1, height + 1)
+                w, h = [(1, 1), (1, rng.randint(2, 30)), (rng.randint(2, 30), 1)][rng.randint(3)]
+            else:
+                w = h = rng.randint(2, 70)
+                if kind == 'inside':
+                    x1, y1 = rng.randint(0, width - w + 1), rng.randint(0, height - h + 1)
+                elif kind == 'partly':
+                    x1, y1 = rng.randint(-w + 1, width), rng.randint(-h + 1, height)
+                else:
+                    x1 = rng.choice([rng.randint(-3 * w, -w + 1), rng.randint(width, width + 2 * w)])
+                    y1 = rng.randint(-2 * h, height + 2 * h)
+            rows.append((x1, y1, x1 + w - 1, y1 + h - 1))
+        order = rng.permutation(len(rows))
+        self.dets = boxes([rows[k] for k in order])
+
+    def test_same_as_per_box_path(self):
+        for net_size in [12, 24, 48]:
+            expected = reference_crops(self.img, self.dets.copy(), net_size)
+            np.testing.assert_array_equal(crop_resize_batch(self.img, self.dets.copy(), net_size), expected)
+
+    def test_uint8_and_arena(self):
+        arena = BufferArena()
+        for dets in [self.dets[::-1], self.dets]:
+            expected = reference_crops(self.img, dets.copy(), 24)
+            # Reused crop and scratch buffers of the previous call must not leak
+            with arena.scope():
+                patches = crop_resize_batch(self.img, dets.copy(), 24, normalize=False, arena=arena)
+                np.testing.assert_array_equal((patches - 127.5) * 0.0078125, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+"""
+DetectAPI with the early reject rnet and a plain onet, on synthetic checkpoints
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'demo'))
+
+
+@unittest.skipIf(tf is None, 'tensorflow is not installed')
+class ErcOnetTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_erc_onet_detect_returns_boxes(self):
+        from benchmark.synthetic import SYNTHETIC_EPOCH, make_checkpoint, planted_image
+        from detectAPI import DetectAPI
+        tf.flags.FLAGS.ERC_thresh = 0.0
+        prefix = [make_checkpoint(name, self.work_dir) for name in ['pnet', 'rnet_erc', 'onet']]
+        api = DetectAPI(prefix, [SYNTHETIC_EPOCH] * 3, 'onet', [256, 256, 16], True, [0.0, 0.0, 0.0], 24)
+        self.assertEqual(api.aux_idx, 0)
+        image, _ = planted_image(120, 160, face_num=2)
+        result = api.detect(image)
+        self.assertIsInstance(result, np.ndarray)
+        self.assertEqual(result.shape[1:], (5,))
+        self.assertGreater(len(result), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+DetectAPI.reset_model against streams in flight, on synthetic checkpoints
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'demo'))
+
+
+@unittest.skipIf(tf is None, 'tensorflow is not installed')
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _prefix(self, folder):
+        from benchmark.synthetic import make_checkpoint
+        return [make_checkpoint(name, os.path.join(self.work_dir, folder)) for name in ['pnet', 'rnet', 'onet']]
+
+    def _api(self, shared_session):
+        from benchmark.synthetic import SYNTHETIC_EPOCH
+        from detectAPI import DetectAPI
+        return DetectAPI(self._prefix('a'), [SYNTHETIC_EPOCH] * 3, 'onet', [256, 256, 16], False,
+                         [0.0, 0.0, 0.0], 24, shared_session=shared_session)
+
+    def test_shared_session_same_paths_keep_models(self):
+        from benchmark.synthetic import SYNTHETIC_EPOCH
+        api = self._api(True)
+        jdap_detector = api.jdap_detector
+        api.reset_model(self._prefix('a'), [SYNTHETIC_EPOCH] * 3)
+        self.assertIs(api.jdap_detector, jdap_detector)
+
+    def test_open_stream_times_out_and_releases_on_close(self):
+        from benchmark.synthetic import SYNTHETIC_EPOCH, planted_image
+        api = self._api(False)
+        image, _ = planted_image(120, 160, face_num=2)
+        stream = api.detect_stream([image] * 3)
+        next(stream)
+        with self.assertRaises(RuntimeError):
+            api.reset_model(self._prefix('b'), [SYNTHETIC_EPOCH] * 3, release_timeout=0.1)
+        # New models serve, the open stream still holds the old ones
+        api.detect(image)
+        self.assertEqual(len(api._pending_release), 1)
+        stream.close()
+        self.assertEqual(api._pending_release, {})
+        self.assertEqual(api._in_flight, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
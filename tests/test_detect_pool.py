@@ -0,0 +1,64 @@
+"""
+DetectPool waiting for results of dead or silent workers
+"""
+import os
+import sys
+import unittest
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'demo'))
+import detect_pool
+from detect_pool import DetectPool
+
+
+class FakeProcess(object):
+    def __init__(self, exitcode):
+        self.exitcode = exitcode
+
+    def is_alive(self):
+        return self.exitcode is None
+
+
+class CollectTest(unittest.TestCase):
+    def setUp(self):
+        self.poll_seconds, detect_pool.POLL_SECONDS = detect_pool.POLL_SECONDS, 0.01
+        # A pool without processes, only the result side of it
+        self.pool = DetectPool.__new__(DetectPool)
+        self.pool._result_queue = Queue()
+        self.pool._pending = set([3, 4])
+        self.pool._in_flight = 2
+        self.pool._free_slots = list()
+        self.pool._results = dict()
+        self.pool.result_timeout = None
+
+    def tearDown(self):
+        detect_pool.POLL_SECONDS = self.poll_seconds
+
+    def test_result(self):
+        self.pool._workers = [FakeProcess(None)]
+        self.pool._result_queue.put(('result', 3, 0, 'boxes'))
+        self.pool._collect()
+        self.assertEqual(self.pool._results, {3: 'boxes'})
+        self.assertEqual(self.pool._pending, set([4]))
+        self.assertEqual(self.pool._free_slots, [0])
+
+    def test_dead_worker_raises(self):
+        self.pool._workers = [FakeProcess(None), FakeProcess(-9)]
+        with self.assertRaises(RuntimeError) as context:
+            self.pool._collect()
+        self.assertIn('1 (exit code -9)', str(context.exception))
+        self.assertIn('[3, 4]', str(context.exception))
+
+    def test_timeout_raises(self):
+        self.pool._workers = [FakeProcess(None)]
+        self.pool.result_timeout = 0.05
+        with self.assertRaises(RuntimeError) as context:
+            self.pool._collect()
+        self.assertIn('[3, 4]', str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
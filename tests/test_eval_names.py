@@ -0,0 +1,43 @@
+"""
+eval_accuracy pairs result store records with the labels by relative image name
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from prepare_data.data_base import L300WP
+from tools.result_store import ResultStoreWriter
+
+
+class EvalNameTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.label_file = os.path.join(self.work_dir, 'labels.txt')
+        with open(self.label_file, 'w') as f:
+            f.write('afw/a.jpg 10 10 50 50 0.1 0.2 0.3' + ' 20' * 14 + '\n')
+        self.store = os.path.join(self.work_dir, 'results.jds')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_mismatch_raises(self):
+        with ResultStoreWriter(self.store, 2) as store:
+            store.append('helen/a.jpg', (np.array([[10, 10, 50, 50, 0.9]]), np.zeros((1, 3))))
+        evaluator = L300WP(self.work_dir, self.label_file)
+        with self.assertRaises(ValueError):
+            evaluator.eval_accuracy(self.store, eval_mode='pose-task')
+
+    def test_missing_column_raises(self):
+        # aux_idx 0 stores have neither pose nor landmarks
+        with ResultStoreWriter(self.store, 0) as store:
+            store.append('afw/a.jpg', np.array([[10, 10, 50, 50, 0.9]]))
+        evaluator = L300WP(self.work_dir, self.label_file)
+        for eval_mode in ['pose-task', 'landmark-task']:
+            with self.assertRaises(ValueError) as context:
+                evaluator.eval_accuracy(self.store, eval_mode=eval_mode)
+            self.assertIn(eval_mode.split('-')[0], str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+"""
+Memoized scale plans of PyramidBuilder
+"""
+import unittest
+from tools.pyramid import PyramidBuilder
+from tools.utils import calc_scale
+
+
+class PlanPixelsTest(unittest.TestCase):
+    def test_full_pixels_ignore_max_face_size(self):
+        pyramid = PyramidBuilder()
+        full = calc_scale(480, 640, 24, 0.709)
+        full_pixels = sum([w * h for w, h in full[1]])
+        for max_face_size in [None, 100]:
+            plan, pixels = pyramid.plan_pixels(480, 640, 24, 0.709, max_face_size)
+            self.assertEqual(plan, calc_scale(480, 640, 24, 0.709, max_face_size=max_face_size))
+            self.assertEqual(pixels, full_pixels)
+            self.assertIs(pyramid.plan(480, 640, 24, 0.709, max_face_size), plan)
+        self.assertLess(len(pyramid.plan(480, 640, 24, 0.709, 100)[1]), len(full[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Reusable numpy buffers of a detector
+@@A named buffer grows to the largest size asked for and is viewed at the shape of every request
+@@Buffers live in pools, a thread holds one pool inside scope() so concurrent threads never share a buffer
+@@Pools go back to the arena at scope end, short lived threads (detect_batch refine, tiles) reuse them
+"""
+import functools
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+# Capacity of a regrown buffer over the size asked for, a slightly larger next request does not allocate again
+GROWTH = 1.25
+
+
+class BufferArena(object):
+    def __init__(self, enabled=True):
+        """
+        Args:
+            enabled: False allocates a new array on every get, the behaviour without arena
+        """
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Pools no thread is holding, name -> flat buffer
+        self._free = list()
+        self.pool_num = 0
+        self.alloc_num = 0
+        self.reuse_num = 0
+        self.bytes = 0
+
+    @contextmanager
+    def scope(self):
+        """ get in this thread uses one pool until the outermost scope ends, arrays of get
+        must not be used after it
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            with self._lock:
+                if self._free:
+                    self._local.pool = self._free.pop()
+                else:
+                    self._local.pool = dict()
+                    self.pool_num += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                pool, self._local.pool = self._local.pool, None
+                with self._lock:
+                    self._free.append(pool)
+
+    def get(self, name, shape, dtype=np.float32):
+        """ Uninitialized array of shape, valid until the next get of name in the same scope.
+        A new array outside any scope.
+        """
+        shape = tuple(int(x) for x in shape)
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        pool = getattr(self._local, 'pool', None)
+        if not self.enabled or pool is None:
+            return np.empty(shape, dtype=dtype)
+        buf = pool.get(name)
+        if buf is not None and buf.dtype == dtype and buf.size >= size:
+            with self._lock:
+                self.reuse_num += 1
+            return buf[:size].reshape(shape)
+        old_bytes = buf.nbytes if buf is not None else 0
+        capacity = int(size * GROWTH) if buf is not None else size
+        buf = np.empty(capacity, dtype=dtype)
+        pool[name] = buf
+        with self._lock:
+            self.alloc_num += 1
+            self.bytes += buf.nbytes - old_bytes
+        return buf[:size].reshape(shape)
+
+    def stats(self):
+        """ Pools, bytes held by all pools, buffer allocations and reuses since creation """
+        with self._lock:
+            return {'pools': self.pool_num, 'bytes': self.bytes, 'allocs': self.alloc_num,
+                    'reuses': self.reuse_num}
+
+
+def arena_scope(method):
+    """ Method decorator, the body runs in self.arena.scope() """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.arena.scope():
+            return method(self, *args, **kwargs)
+    return wrapper
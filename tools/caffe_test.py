@@ -7,6 +7,7 @@ import numpy as np
 import glob
 from collections import OrderedDict
 from utils import *
+from nms import nms
 
 
 def consistency(net_size, deploy, caffemodel, img_list):
@@ -34,18 +35,8 @@ def consistency(net_size, deploy, caffemodel, img_list):
 
 
 def _candidate_arrange(dets, img, height, width, net_size):
-
-    [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = pad(dets, width, height)
-    num_boxes = dets.shape[0]
-
-    cropped_ims = np.zeros((num_boxes, 3, net_size, net_size), dtype=np.float32)
-    for i in range(num_boxes):
-        tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.uint8)
-        tmp[dy[i]:edy[i] + 1, dx[i]:edx[i] + 1, :] = img[y[i]:ey[i] + 1, x[i]:ex[i] + 1, :]
-        norm_img = resize_image_by_wh(tmp, (net_size, net_size))
-        norm_img = np.transpose(norm_img, [2, 0, 1])  # C H W
-        cropped_ims[i, :, :, :] = norm_img
-    return cropped_ims
+    cropped_ims = crop_resize_batch(img, dets, net_size)
+    return np.transpose(cropped_ims, [0, 3, 1, 2])  # N C H W
 
 
 def inference(deploys, caffemodels, image_list, thresh):
@@ -73,7 +64,7 @@ def inference(deploys, caffemodels, image_list, thresh):
             # Numpy slice without security check
             if boxes.size == 0:
                 continue
-            keep = py_nms(boxes[:, :5], 0.5, 'Union')
+            keep = nms(boxes[:, :5], 0.5, 'Union')
             boxes = boxes[keep]  # if keep is [], boxes is also []
             if boxes.size == 0:
                 continue
@@ -85,7 +76,7 @@ def inference(deploys, caffemodels, image_list, thresh):
         all_boxes = np.vstack(all_boxes)
 
         # merge the detection from first stage
-        keep = py_nms(all_boxes[:, 0:5], 0.7, 'Union')
+        keep = nms(all_boxes[:, 0:5], 0.7, 'Union')
         all_boxes = all_boxes[keep]
         boxes = all_boxes[:, :5]
 
@@ -119,7 +110,7 @@ def inference(deploys, caffemodels, image_list, thresh):
             boxes[:, 4] = result['prob1'][:, 1][keep_inds]
             bbox_reg = result['conv5-2'][keep_inds]
 
-        keep = py_nms(boxes, 0.7)
+        keep = nms(boxes, 0.7)
         boxes = boxes[keep]
         boxes_c = calibrate_box(boxes, bbox_reg[keep])
 
@@ -143,7 +134,7 @@ def inference(deploys, caffemodels, image_list, thresh):
             landmark = result['conv6-3'][keep_inds]
             pose_reg = result['conv6-4'][keep_inds]
 
-        keep = py_nms(boxes, 0.7, 'Minimum')
+        keep = nms(boxes, 0.7, 'Minimum')
         boxes = boxes[keep]
         landmark = landmark[keep]
         pose_reg = pose_reg[keep]
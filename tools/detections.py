@@ -0,0 +1,198 @@
+"""
+Columnar detect results
+@@Detections holds boxes, scores, landmarks, pose and source stage of every face as contiguous arrays
+@@Faces of several images are one set of rows, offsets tells the rows of every image
+@@Row slices and images are views, to_bytes/from_bytes is a header and the raw arrays
+"""
+import struct
+import numpy as np
+
+# Stage a face comes from, the last stage of the cascade that ran
+STAGE_PNET, STAGE_RNET, STAGE_ONET = 0, 1, 2
+# Magic, version, flags, faces, images, landmark and pose columns + 1 (0 if None), 8 byte aligned
+_HEADER = struct.Struct('<4sHHIIII')
+_MAGIC = b'JDET'
+_VERSION = 1
+
+
+class Detections(object):
+    __slots__ = ('boxes', 'scores', 'landmarks', 'pose', 'stages', 'offsets')
+
+    def __init__(self, boxes, scores, landmarks=None, pose=None, stages=None, offsets=None):
+        """
+        Args:
+            boxes: n x 4 float32, x1 y1 x2 y2
+            scores: n float32
+            landmarks: n x 2k float32 as detect returns them [x x x .. y y y ..], None if not predicted
+            pose: n x 3 float32 pitch yaw roll in radian, None if not predicted
+            stages: n int8, STAGE_*, onet if None
+            offsets: images + 1 int64, rows of image i are offsets[i]:offsets[i + 1], one image if None
+        Arrays are kept as given when dtype and layout already fit, no copy.
+        """
+        num = len(boxes)
+        self.boxes = np.ascontiguousarray(boxes, dtype=np.float32).reshape(num, 4)
+        self.scores = np.ascontiguousarray(scores, dtype=np.float32).reshape(num)
+        self.landmarks = _rows(landmarks, num)
+        self.pose = _rows(pose, num)
+        if stages is None:
+            stages = np.full(num, STAGE_ONET, dtype=np.int8)
+        self.stages = np.ascontiguousarray(stages, dtype=np.int8).reshape(num)
+        if offsets is None:
+            offsets = [0, num]
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_result(cls, result, aux_idx=0, stage=STAGE_ONET):
+        """ Detections of one image from a detect result of aux_idx, stage its last stage """
+        boxes, pose, landmarks = unpack_result(result)
+        if aux_idx not in (1, 3):
+            landmarks = None
+        if aux_idx not in (2, 3):
+            pose = None
+        num = len(boxes)
+        if num == 0:
+            # Nothing found, landmarks and pose are None or empty
+            landmarks = None if aux_idx not in (1, 3) else np.zeros((0, 0), dtype=np.float32)
+            pose = None if aux_idx not in (2, 3) else np.zeros((0, 3), dtype=np.float32)
+        return cls(boxes[:, :4], boxes[:, 4], landmarks, pose, np.full(num, stage, dtype=np.int8))
+
+    @classmethod
+    def concat(cls, detections):
+        """ One Detections of the images of all detections in order, arrays are copied once """
+        detections = list(detections)
+        if not detections:
+            return cls(np.zeros((0, 4)), np.zeros(0))
+        row_num = [len(x) for x in detections]
+        offsets = [np.zeros(1, dtype=np.int64)]
+        start = 0
+        for x, num in zip(detections, row_num):
+            offsets.append(x.offsets[1:] - x.offsets[0] + start)
+            start += num
+
+        def column(name):
+            arrays = [getattr(x, name) for x in detections]
+            if any(a is None for a in arrays):
+                return None
+            # Images without face have no landmark columns
+            width = max(a.shape[1] for a in arrays)
+            return np.concatenate([a if a.shape[1] == width else np.zeros((len(a), width), np.float32)
+                                   for a in arrays])
+
+        return cls(np.concatenate([x.boxes for x in detections]), np.concatenate([x.scores for x in detections]),
+                   column('landmarks'), column('pose'), np.concatenate([x.stages for x in detections]),
+                   np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    @property
+    def image_num(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """ Rows of index as one image, views for a slice, copies for an index array """
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1 if index != -1 else None)
+        boxes = self.boxes[index]
+        return Detections(boxes, self.scores[index],
+                          None if self.landmarks is None else self.landmarks[index],
+                          None if self.pose is None else self.pose[index], self.stages[index], [0, len(boxes)])
+
+    def image(self, image_id):
+        """ Rows of one image, views """
+        return self[int(self.offsets[image_id]):int(self.offsets[image_id + 1])]
+
+    def split(self):
+        return [self.image(k) for k in range(self.image_num)]
+
+    def box_scores(self):
+        """ n x 5 boxes with score column, what detect returns """
+        return np.hstack([self.boxes, self.scores[:, np.newaxis]])
+
+    def as_result(self, aux_idx=0):
+        """ Detect result of aux_idx of one image, for code not taking Detections """
+        boxes = self.box_scores()
+        if aux_idx == 3:
+            return boxes, self.pose, self.landmarks
+        elif aux_idx == 1:
+            return boxes, self.landmarks
+        elif aux_idx == 2:
+            return boxes, self.pose
+        return boxes
+
+    def to_bytes(self):
+        """ Header and the raw little endian arrays, stages last so float arrays stay aligned """
+        land_dim = 0 if self.landmarks is None else self.landmarks.shape[1] + 1
+        pose_dim = 0 if self.pose is None else self.pose.shape[1] + 1
+        header = _HEADER.pack(_MAGIC, _VERSION, 0, len(self), self.image_num, land_dim, pose_dim)
+        arrays = [self.offsets.astype('<i8'), self.boxes.astype('<f4'), self.scores.astype('<f4')]
+        arrays += [x.astype('<f4') for x in (self.landmarks, self.pose) if x is not None]
+        arrays.append(self.stages)
+        return header + b''.join(x.tobytes() for x in arrays)
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        """ Detections of to_bytes data at offset, arrays are views of data (read only of bytes) """
+        magic, version, _, num, image_num, land_dim, pose_dim = _HEADER.unpack_from(data, offset)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('Not Detections data of version %d' % _VERSION)
+        shapes = [('<i8', (image_num + 1,)), ('<f4', (num, 4)), ('<f4', (num,))]
+        if land_dim:
+            shapes.append(('<f4', (num, land_dim - 1)))
+        if pose_dim:
+            shapes.append(('<f4', (num, pose_dim - 1)))
+        shapes.append((np.int8, (num,)))
+        arrays = list()
+        offset += _HEADER.size
+        for dtype, shape in shapes:
+            array = np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+            offset += array.nbytes
+            arrays.append(array)
+        offsets, boxes, scores = arrays[:3]
+        landmarks = arrays[3] if land_dim else None
+        pose = arrays[-2] if pose_dim else None
+        return cls(boxes, scores, landmarks, pose, arrays[-1], offsets)
+
+    def byte_size(self):
+        """ Size of to_bytes """
+        size = _HEADER.size + self.offsets.nbytes + len(self) * (4 * 4 + 4 + 1)
+        return size + sum(x.size * 4 for x in (self.landmarks, self.pose) if x is not None)
+
+    def __reduce__(self):
+        # Pickled through to_bytes, DetectPool results cross processes
+        return _from_bytes_copy, (self.to_bytes(),)
+
+    def __repr__(self):
+        return 'Detections(faces=%d, images=%d, landmarks=%s, pose=%s)' % (
+            len(self), self.image_num, self.landmarks is not None, self.pose is not None)
+
+
+def _from_bytes_copy(data):
+    # Writable arrays of an own buffer
+    return Detections.from_bytes(bytearray(data))
+
+
+def _rows(array, num):
+    """ float32 num x d array, None stays None """
+    if array is None:
+        return None
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    if array.ndim == 2:
+        return array
+    return array.reshape(num, -1) if num else array.reshape(0, 0)
+
+
+def unpack_result(result):
+    """
+    (boxes, pose, landmarks) of a Detections or a detect result, boxes n x 5 with score, empty
+    if nothing is found. Of a tuple result pose is result[1] and landmarks result[-1], None without.
+    """
+    if isinstance(result, Detections):
+        return result.box_scores(), result.pose, result.landmarks
+    if type(result) is tuple:
+        boxes, pose, landmarks = result[0], result[1], result[-1]
+    else:
+        boxes, pose, landmarks = result, None, None
+    if boxes is None or len(boxes) == 0:
+        boxes = np.zeros((0, 5), dtype=np.float32)
+    return boxes, pose, landmarks
@@ -47,7 +47,7 @@ def parse_args():
                         #default='/home/dafu/data/LS3D-W/LS3D-W/300W-Testset-3D',
                         #default='/home/dafu/data/LS3D-W/LS3D-W/300VW-3D',
                         type=str)
-    parser.add_argument('--eval_file', dest='eval_file', help='eval file name',
+    parser.add_argument('--eval_file', dest='eval_file', help='eval file name or result store',
                         # landmark 68 and pose
     #default='/home/dafu/workspace/FaceDetect/tf_JDAP/evaluation/aflw2000/onet_OHEM_0.7_wop_pnet_300WLP_pose_landmark68_1w_mean_shape_16_0.1_0.01_0.01.txt',
     #default='/home/dafu/workspace/FaceDetect/tf_JDAP/evaluation/aflw2000/onet_OHEM_0.7_wop_pnet_300WLP_pose_landmark68_0.1w_16_0.1_0.01_0.01.txt',
@@ -0,0 +1,131 @@
+"""
+Freeze detectors into pruned inference GraphDef
+@@Only input placeholders and named output nodes are kept, variables become constants
+@@DetectAPI(frozen=True) loads <prefix>-<epoch>.pb instead of the checkpoint
+@@Startup benchmark compares cold start of both loading modes in fresh processes
+"""
+import argparse
+import subprocess
+import sys
+import time
+import tensorflow as tf
+
+# Detector outputs are exported as OUTPUT_SCOPE/<name>
+OUTPUT_SCOPE = 'output'
+
+
+def name_outputs(outputs):
+    """ Identity ops with fixed names, the nodes a frozen graph is pruned to
+    Args:
+        outputs: OrderedDict of output name and tensor
+
+    Returns:
+        list of named tensors in the same order
+    """
+    return [tf.identity(tensor, name='%s/%s' % (OUTPUT_SCOPE, name)) for name, tensor in outputs.items()]
+
+
+def read_graph_def(pb_path):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(pb_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def frozen_tensor(graph, name, is_output=True, scope=''):
+    """ Tensor of an imported frozen graph by its exported name
+    """
+    if is_output:
+        name = '%s/%s' % (OUTPUT_SCOPE, name)
+    if scope:
+        name = '%s/%s' % (scope, name)
+    return graph.get_tensor_by_name(name + ':0')
+
+
+def _rename_nodes(graph_def, renames):
+    """ Rename nodes and the inputs refer to them ("name", "name:1", "^name") """
+    for node in graph_def.node:
+        node.name = renames.get(node.name, node.name)
+        for k, inp in enumerate(node.input):
+            control = inp.startswith('^')
+            name, sep, port = inp.lstrip('^').partition(':')
+            if name in renames:
+                node.input[k] = ('^' if control else '') + renames[name] + sep + port
+
+
+def freeze_detector(detector, pb_path):
+    """ Fold variables of a checkpoint loaded detector into constants and keep its outputs only
+    """
+    output_nodes = [getattr(detector, name).op.name for name in detector.output_names]
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        detector.sess, detector.sess.graph.as_graph_def(), output_nodes)
+    # Several detectors in one runtime graph get uniquified names (input_image_1), export the plain ones
+    renames = dict([(node, '%s/%s' % (OUTPUT_SCOPE, name)) for node, name in zip(output_nodes, detector.output_names)])
+    for attr, name in [('image_op', 'input_image'), ('width_op', 'image_width'), ('height_op', 'image_height'),
+                       ('scales_op', 'pnet_scales'), ('threshold_op', 'pnet_threshold'),
+                       ('iou_threshold_op', 'pnet_iou_threshold'), ('top_k_op', 'pnet_top_k'),
+                       ('valid_size_op', 'pnet_valid_size')]:
+        if hasattr(detector, attr):
+            renames[getattr(detector, attr).op.name] = name
+    _rename_nodes(graph_def, renames)
+    with tf.gfile.GFile(pb_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('%s: %d nodes, %.2f MB' % (pb_path, len(graph_def.node), graph_def.ByteSize() / 1024.0 / 1024.0))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Freeze JDAP detectors',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--test_mode', dest='test_mode', help='test net type, can be pnet, rnet or onet',
+                        default='onet_landmark_pose', type=str)
+    parser.add_argument('--prefix', dest='prefix', help='prefix of model name', nargs="+", type=str)
+    parser.add_argument('--epoch', dest='epoch', help='epoch number of model to load', nargs="+",
+                        default=[13, 16, 16], type=int)
+    parser.add_argument('--batch_size', dest='batch_size', help='list of batch size used in prediction', nargs="+",
+                        default=[2048, 256, 16], type=int)
+    parser.add_argument('--is_ERC', dest='is_ERC', help='rnet with early reject classifier', action='store_true')
+    parser.add_argument('--benchmark', dest='benchmark', help='compare checkpoint and frozen cold start',
+                        action='store_true')
+    parser.add_argument('--repeat', dest='repeat', help='processes per loading mode in benchmark', default=3, type=int)
+    parser.add_argument('--load', dest='load', help='internal, load once in checkpoint or frozen mode and exit',
+                        default='', type=str)
+    args = parser.parse_args()
+    return args
+
+
+def build_api(args, frozen):
+    from demo.detectAPI import DetectAPI
+    return DetectAPI(args.prefix, args.epoch, args.test_mode, args.batch_size, is_ERC=args.is_ERC,
+                     thresh=[0.6, 0.7, 0.7], min_face_size=24, frozen=frozen)
+
+
+def startup_benchmark(repeat):
+    """ Wall time of fresh processes that import tensorflow and load all detectors,
+    and the load time they report themselves
+    """
+    argv = [a for a in sys.argv[1:] if a != '--benchmark']
+    for mode in ['checkpoint', 'frozen']:
+        walls, loads = list(), list()
+        for _ in range(repeat):
+            t = time.time()
+            out = subprocess.check_output([sys.executable, sys.argv[0], '--load', mode] + argv)
+            walls.append(time.time() - t)
+            loads.append(float(out.decode().strip().split()[-1]))
+        print('%-10s process %.3fs  load %.3fs  (best of %d)' % (mode, min(walls), min(loads), repeat))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.load:
+        t = time.time()
+        build_api(args, args.load == 'frozen')
+        print('load %.4f' % (time.time() - t))
+    elif args.benchmark:
+        startup_benchmark(args.repeat)
+    else:
+        api = build_api(args, frozen=False)
+        jdap = api.jdap_detector
+        for detector, prefix, epoch in zip([jdap.pnet_detector, jdap.rnet_detector, jdap.onet_detector],
+                                           args.prefix, args.epoch):
+            if detector is not None:
+                freeze_detector(detector, '%s-%s.pb' % (prefix, epoch))
@@ -0,0 +1,221 @@
+"""
+Greedy non maximum suppression
+@@Same keep set and keep order as tools.utils.py_nms
+@@Tiled overlap matrix for small and medium candidate number
+@@Sort and sweep with size bucketing for large candidate number
+"""
+import time
+import numpy as np
+
+# Candidate number to switch strategy in auto mode
+TILED_MAX_NUM = 192
+SWEEP_MIN_NUM = 10000
+TILE_SIZE = 512
+
+
+def _overlap(x1, y1, x2, y2, areas, i, idx, mode):
+    """ Overlap between box i and boxes idx, same arithmetic as py_nms
+    """
+    xx1 = np.maximum(x1[i], x1[idx])
+    yy1 = np.maximum(y1[i], y1[idx])
+    xx2 = np.minimum(x2[i], x2[idx])
+    yy2 = np.minimum(y2[i], y2[idx])
+
+    w = np.maximum(0.0, xx2 - xx1 + 1)
+    h = np.maximum(0.0, yy2 - yy1 + 1)
+    inter = w * h
+    if mode == "Union":
+        return inter / (areas[i] + areas[idx] - inter)
+    elif mode == "Minimum":
+        return inter / np.minimum(areas[i], areas[idx])
+    raise ValueError("Not support nms mode %s." % mode)
+
+
+def _overlap_matrix(x1, y1, x2, y2, areas, rows, cols, mode):
+    """ Overlap of every (rows[k], cols[m]) pair, len(rows) x len(cols)
+    """
+    return _overlap(x1, y1, x2, y2, areas, rows[:, np.newaxis], cols[np.newaxis, :], mode)
+
+
+def nms_greedy(x1, y1, x2, y2, areas, thresh, mode):
+    """ Reference loop of py_nms, boxes are already in descending score order
+    """
+    keep = list()
+    order = np.arange(x1.size)
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        ovr = _overlap(x1, y1, x2, y2, areas, i, order[1:], mode)
+        inds = np.where(ovr <= thresh)[0]
+        order = order[inds + 1]
+    return np.array(keep, dtype=np.intp)
+
+
+def nms_tiled(x1, y1, x2, y2, areas, thresh, mode, tile_size=TILE_SIZE):
+    """ Suppression matrix of all pairs built tile by tile (tile_size x N overlaps at once),
+    then one cheap pass over the rows in score order.
+    A kept box never overlaps a former kept box (it would have been suppressed), so a kept
+    row can be applied to the whole alive mask.
+    """
+    num = x1.size
+    cols = np.arange(num)
+    suppressed = np.empty((num, num), dtype=np.bool_)
+    for start in range(0, num, tile_size):
+        rows = cols[start:start + tile_size]
+        suppressed[rows] = _overlap_matrix(x1, y1, x2, y2, areas, rows, cols, mode) > thresh
+    alive = np.ones(num, dtype=np.bool_)
+    keep = list()
+    i = 0
+    while True:
+        keep.append(i)
+        alive[i] = False
+        alive &= np.logical_not(suppressed[i])
+        rest = np.flatnonzero(alive[i + 1:])
+        if rest.size == 0:
+            break
+        i += rest[0] + 1
+    return np.array(keep, dtype=np.intp)
+
+
+def nms_sweep(x1, y1, x2, y2, areas, thresh, mode):
+    """ Sort and sweep with spatial bucketing.
+    Candidates are bucketed by box width (one octave per bucket, PNet boxes of one scale
+    share the same width) and sorted by (bucket, x1) into one key array. Boxes overlapping
+    a kept box must start inside (x1 - max_width_of_bucket, x2 + 1), so the windows of all
+    buckets are found with one searchsorted and only the alive boxes inside are tested.
+    """
+    num = x1.size
+    widths = x2 - x1 + 1
+    bucket_ids = np.floor(np.log2(np.maximum(widths, 1))).astype(np.int32)
+    _, bucket_ids = np.unique(bucket_ids, return_inverse=True)
+    bucket_num = bucket_ids.max() + 1
+    max_widths = np.zeros(bucket_num, dtype=widths.dtype)
+    np.maximum.at(max_widths, bucket_ids, widths)
+    # Keys of two buckets never interleave
+    x_min = x1.min()
+    span = x2.max() - x_min + max_widths.max() + 2
+    keys = bucket_ids * span + (x1 - x_min)
+    sorted_idx = np.argsort(keys, kind='mergesort')
+    keys = keys[sorted_idx]
+    bucket_offsets = np.arange(bucket_num) * span - x_min
+
+    alive = np.ones(num, dtype=np.bool_)
+    keep = list()
+    for i in range(num):
+        if not alive[i]:
+            continue
+        keep.append(i)
+        alive[i] = False
+        lo = np.searchsorted(keys, bucket_offsets + (x1[i] - max_widths), side='left')
+        hi = np.searchsorted(keys, bucket_offsets + (x2[i] + 1), side='left')
+        counts = hi - lo
+        total = counts.sum()
+        if total == 0:
+            continue
+        # Concatenate [lo, hi) windows without a python loop over buckets
+        pos = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(total)
+        cand = sorted_idx[pos]
+        cand = cand[alive[cand]]
+        if cand.size == 0:
+            continue
+        ovr = _overlap(x1, y1, x2, y2, areas, i, cand, mode)
+        alive[cand[ovr > thresh]] = False
+    return np.array(keep, dtype=np.intp)
+
+
+def choose_method(num):
+    """ Strategy picked by auto mode, thresholds measured with benchmark()
+    """
+    if num <= TILED_MAX_NUM:
+        return 'tiled'
+    elif num < SWEEP_MIN_NUM:
+        return 'greedy'
+    return 'sweep'
+
+
+def nms(dets, thresh, mode="Union", method='auto'):
+    """ greedily select boxes with high confidence
+    Keep boxes overlap <= thresh rule out overlap > thresh
+    Args:
+        dets: Must be 2D-array. Format [[x1, y1, x2, y2 score],[...]]
+        thresh: retain overlap <= thresh
+        mode: Union and Minimum
+        method: 'auto', 'greedy', 'tiled' or 'sweep'
+
+    Returns:
+        indexes to keep, in descending score order as py_nms
+    """
+    if len(dets.shape) != 2 or dets.shape[0] == 0:
+        return np.array([], dtype=np.intp)
+    if mode not in ("Union", "Minimum"):
+        raise ValueError("Not support nms mode %s." % mode)
+    order = dets[:, 4].argsort()[::-1]
+    # Work in score order, every strategy returns ranks
+    x1 = dets[order, 0]
+    y1 = dets[order, 1]
+    x2 = dets[order, 2]
+    y2 = dets[order, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    if method == 'auto':
+        method = choose_method(order.size)
+    if method == 'greedy':
+        keep = nms_greedy(x1, y1, x2, y2, areas, thresh, mode)
+    elif method == 'tiled':
+        keep = nms_tiled(x1, y1, x2, y2, areas, thresh, mode)
+    elif method == 'sweep':
+        keep = nms_sweep(x1, y1, x2, y2, areas, thresh, mode)
+    else:
+        raise ValueError("Not support nms method %s." % method)
+    return order[keep]
+
+
+def synthetic_pnet_boxes(num, width=1920, height=1080, min_face_size=24, scale_factor=0.709, seed=0):
+    """ PNet-like candidates: boxes of a few discrete sizes clustered around faces
+    """
+    rng = np.random.RandomState(seed)
+    sides = list()
+    side = float(min_face_size)
+    while side < min(width, height):
+        sides.append(side)
+        side /= scale_factor
+    side = np.array(sides)[rng.randint(0, len(sides), num)]
+    centers = rng.rand(max(num // 50, 1), 2) * [width, height]
+    center = centers[rng.randint(0, len(centers), num)] + rng.randn(num, 2) * side[:, np.newaxis] * 0.3
+    x1 = np.round(center[:, 0] - side / 2)
+    y1 = np.round(center[:, 1] - side / 2)
+    return np.vstack([x1, y1, x1 + np.round(side) - 1, y1 + np.round(side) - 1, rng.rand(num)]).T
+
+
+def benchmark(nums=(64, 192, 1000, 5000, 20000, 50000), thresh=0.5, mode="Union", repeat=3,
+              tiled_max_num=4096):
+    """ Micro benchmark of every method on realistic candidate numbers, checks keep sets equal
+    tiled needs a num x num matrix, it is skipped above tiled_max_num
+    """
+    print("%s nms, thresh %.2f" % (mode, thresh))
+    print("%8s %8s %12s %12s %12s %8s" % ('num', 'keep', 'greedy(ms)', 'tiled(ms)', 'sweep(ms)', 'auto'))
+    for num in nums:
+        dets = synthetic_pnet_boxes(num)
+        costs = list()
+        reference = None
+        for method in ['greedy', 'tiled', 'sweep']:
+            if method == 'tiled' and num > tiled_max_num:
+                costs.append(float('nan'))
+                continue
+            best = float('inf')
+            for _ in range(repeat):
+                t = time.time()
+                keep = nms(dets, thresh, mode, method)
+                best = min(best, time.time() - t)
+            if reference is None:
+                reference = keep
+            elif not np.array_equal(reference, keep):
+                raise AssertionError("%s keep set differs from greedy in %d boxes" % (method, num))
+            costs.append(best * 1000)
+        print("%8d %8d %12.2f %12.2f %12.2f %8s" % (num, reference.size, costs[0], costs[1], costs[2],
+                                                    choose_method(num)))
+
+
+if __name__ == '__main__':
+    benchmark(mode="Union")
+    benchmark(thresh=0.7, mode="Minimum")
@@ -0,0 +1,147 @@
+"""
+Image pyramid of PNet
+@@Scale plan and its full pyramid pixels memoized per plan arguments
+@@Levels are resized and normalized into BufferArena buffers, kept across frame size changes
+@@Incremental mode derives a level from a larger level instead of the origin image
+@@Levels stay uint8 for detectors normalizing on graph
+"""
+import cv2
+import numpy as np
+from tools.utils import calc_scale, calc_mosaic_layout
+from tools.arena import BufferArena
+
+# Plans kept before the memo is cleared, frame sizes of a deployment are few
+MAX_PLAN_NUM = 64
+
+
+def _normalize(raw, out):
+    """ (raw - 127.5) * 0.0078125 into a float32 buffer, float32 arithmetic is exact here """
+    np.copyto(out, raw, casting='unsafe')
+    np.subtract(out, np.float32(127.5), out=out)
+    np.multiply(out, np.float32(0.0078125), out=out)
+
+
+class PyramidBuilder(object):
+    def __init__(self, incremental=False, min_ratio=2.0, normalize=True, arena=None):
+        """
+        Args:
+            incremental: Resize a level from the smallest already built level at least
+                min_ratio times larger (both sides), the origin image if there is none
+            min_ratio: INTER_AREA from a source >= 2x larger keeps anti-aliasing close to
+                resizing the origin image, a smaller ratio trades quality for speed
+            normalize: False keeps levels and canvas in the image dtype (uint8)
+            arena: BufferArena of levels and canvas, a new one if None. Buffers are reused only
+                inside arena.scope(), a new array is allocated per level outside
+        """
+        self.incremental = incremental
+        self.min_ratio = min_ratio
+        self.normalize = normalize
+        self._plans = dict()
+        self._layouts = dict()
+        self._sources = dict()
+        self.arena = arena if arena is not None else BufferArena()
+
+    def plan(self, height, width, min_face_size=24, scale_factor=0.709, max_face_size=None):
+        """ Memoized calc_scale, returns (scales, scales_wh)
+        """
+        return self.plan_pixels(height, width, min_face_size, scale_factor, max_face_size)[0]
+
+    def plan_pixels(self, height, width, min_face_size=24, scale_factor=0.709, max_face_size=None):
+        """ Memoized (plan, pixels of the full pyramid), full is the plan without max_face_size
+        """
+        key = (height, width, min_face_size, scale_factor, max_face_size)
+        entry = self._plans.get(key)
+        if entry is None:
+            if len(self._plans) >= MAX_PLAN_NUM:
+                self._plans.clear()
+                self._layouts.clear()
+                self._sources.clear()
+            plan = calc_scale(height, width, min_face_size, scale_factor, max_face_size=max_face_size)
+            full_plan = plan if max_face_size is None else calc_scale(height, width, min_face_size, scale_factor)
+            entry = (plan, sum([w * h for w, h in full_plan[1]]))
+            self._plans[key] = entry
+        return entry
+
+    def mosaic_layout(self, scales_wh):
+        """ Memoized calc_mosaic_layout
+        """
+        key = tuple(scales_wh)
+        layout = self._layouts.get(key)
+        if layout is None:
+            layout = calc_mosaic_layout(scales_wh)
+            self._layouts[key] = layout
+        return layout
+
+    def source_levels(self, scales_wh):
+        """ Memoized level index every level is resized from, -1 is the origin image
+        """
+        key = tuple(scales_wh)
+        sources = self._sources.get(key)
+        if sources is not None:
+            return sources
+        sources = list()
+        for level_id, (w, h) in enumerate(scales_wh):
+            source = -1
+            if self.incremental:
+                for prev_id in range(level_id - 1, -1, -1):
+                    prev_w, prev_h = scales_wh[prev_id]
+                    if prev_w >= self.min_ratio * w and prev_h >= self.min_ratio * h:
+                        source = prev_id
+                        break
+            sources.append(source)
+        self._sources[key] = sources
+        return sources
+
+    def _resize_levels(self, img, scales_wh, slot):
+        sources = self.source_levels(scales_wh)
+        raw_levels = list()
+        for level_id, tuple_wh in enumerate(scales_wh):
+            shape = (tuple_wh[1], tuple_wh[0]) + img.shape[2:]
+            source = img if sources[level_id] < 0 else raw_levels[sources[level_id]]
+            dst = self.arena.get(('raw', slot, level_id), shape, img.dtype)
+            raw_levels.append(cv2.resize(source, tuple_wh, dst=dst, interpolation=cv2.INTER_AREA))
+        return raw_levels
+
+    def build(self, img, scales_wh, slot=0):
+        """
+        Normalization levels of img, same values as resize_image_by_wh when not incremental,
+        resized levels only if not normalize. Returned arrays are reused by the next build of the same slot
+        in the same arena scope.
+        Args:
+            img: Origin image
+            scales_wh: Pyramid level sizes (width, height) from plan
+            slot: Buffer set, images used at the same time need different slots
+
+        Returns:
+            List of float32 level images
+        """
+        if not self.normalize:
+            return self._resize_levels(img, scales_wh, slot)
+        levels = list()
+        for level_id, raw in enumerate(self._resize_levels(img, scales_wh, slot)):
+            level = self.arena.get(('norm', slot, level_id), raw.shape, np.float32)
+            _normalize(raw, level)
+            levels.append(level)
+        return levels
+
+    def build_mosaic(self, img, scales_wh, slot=0):
+        """
+        Every level pasted at its offset of the memoized mosaic_layout into one zero canvas, reused by
+        the next build of the same slot in the same arena scope
+        Returns:
+            canvas: Normalization canvas (image dtype if not normalize)
+            offsets: Top left (x, y) of every level in canvas
+        """
+        canvas_wh, offsets = self.mosaic_layout(scales_wh)
+        shape = (canvas_wh[1], canvas_wh[0]) + img.shape[2:]
+        # The buffer may hold another layout, gutters must be zero again, no kept pnet cell sees them
+        dtype = np.float32 if self.normalize else img.dtype
+        canvas = self.arena.get(('canvas', slot), shape, dtype)
+        canvas.fill(0)
+        for raw, (x, y) in zip(self._resize_levels(img, scales_wh, slot), offsets):
+            level = canvas[y:y + raw.shape[0], x:x + raw.shape[1]]
+            if self.normalize:
+                _normalize(raw, level)
+            else:
+                level[...] = raw
+        return canvas, offsets
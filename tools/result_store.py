@@ -0,0 +1,211 @@
+"""
+Append only store of detect results
+@@<path> holds the Detections.to_bytes record of every image, <path>.idx its image name, offset and length
+@@Writes go through large file buffers, a run may append to the store of an earlier run
+@@ResultStore memory maps <path>, every record is read as Detections views, no parsing
+@@WIDER and FDDB submission files are exported from a store in bulk
+Usage:
+    python -m tools.result_store wider <store> <output_dir>
+    python -m tools.result_store fddb <store> <output_file>
+"""
+import argparse
+import mmap
+import os
+import struct
+import numpy as np
+from tools.detections import Detections
+
+# Magic and version at the start of the data file
+_FILE_HEADER = struct.Struct('<4sI')
+_MAGIC = b'JDRS'
+_VERSION = 1
+# Offset, length and name bytes of a record, then the utf-8 name
+_INDEX_ENTRY = struct.Struct('<QIH')
+# Records start 8 byte aligned, the arrays of a mapped record are aligned
+_ALIGN = 8
+BUFFER_SIZE = 1 << 20
+
+
+class ResultStoreWriter(object):
+    def __init__(self, path, aux_idx=0, buffer_size=BUFFER_SIZE):
+        """
+        Args:
+            path: data file, <path>.idx is the index, both are appended to if they exist
+            aux_idx: aux_idx of the detect results given to append
+            buffer_size: Bytes buffered per file
+        """
+        self.path = path
+        self.aux_idx = aux_idx
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._data = open(path, 'ab', buffer_size)
+        self._index = open(path + '.idx', 'ab', buffer_size)
+        if size == 0:
+            self._data.write(_FILE_HEADER.pack(_MAGIC, _VERSION))
+            size = _FILE_HEADER.size
+        else:
+            _check_header(path)
+        self._offset = size
+        self.image_num = 0
+
+    def append(self, image_name, result):
+        """ Result of one image, a detect result of aux_idx or Detections """
+        if not isinstance(result, Detections):
+            result = Detections.from_result(result, self.aux_idx)
+        if result.image_num != 1:
+            raise ValueError('A record is one image, got %d' % result.image_num)
+        data = result.to_bytes()
+        data += b'\0' * (-len(data) % _ALIGN)
+        name = image_name.encode('utf-8')
+        self._data.write(data)
+        self._index.write(_INDEX_ENTRY.pack(self._offset, len(data), len(name)) + name)
+        self._offset += len(data)
+        self.image_num += 1
+
+    def flush(self):
+        # Data before index, an index entry never points past the data
+        self._data.flush()
+        self._index.flush()
+
+    def close(self):
+        if self._data.closed:
+            return
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResultStore(object):
+    def __init__(self, path):
+        """ Read only view of the store at path, records of an interrupted write are left out """
+        _check_header(path)
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path + '.idx', 'rb') as f:
+            index = f.read()
+        names, offsets, lengths = list(), list(), list()
+        pos = 0
+        while pos + _INDEX_ENTRY.size <= len(index):
+            offset, length, name_len = _INDEX_ENTRY.unpack_from(index, pos)
+            pos += _INDEX_ENTRY.size
+            if pos + name_len > len(index) or offset + length > len(self._map):
+                break
+            names.append(index[pos:pos + name_len].decode('utf-8'))
+            offsets.append(offset)
+            lengths.append(length)
+            pos += name_len
+        self.names = names
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        # Later records of the same name win
+        self._ids = dict((name, k) for k, name in enumerate(names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, image_name):
+        return image_name in self._ids
+
+    def __getitem__(self, key):
+        """ Detections of record key or of image name key, views of the mapped file valid until close """
+        if not isinstance(key, (int, np.integer)):
+            key = self._ids[key]
+        return Detections.from_bytes(self._map, int(self.offsets[key]))
+
+    def items(self):
+        """ (image name, Detections) of every record in write order """
+        for k, name in enumerate(self.names):
+            yield name, self[k]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_result_store(path):
+    """ True if path is the data file of a store """
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
+def _check_header(path):
+    with open(path, 'rb') as f:
+        header = f.read(_FILE_HEADER.size)
+    if len(header) < _FILE_HEADER.size or _FILE_HEADER.unpack(header) != (_MAGIC, _VERSION):
+        raise ValueError('%s is not a result store of version %d' % (path, _VERSION))
+
+
+def _xywh_scores(boxes):
+    """ Flat x y w h score of n x 5 boxes, what the submission rows hold """
+    rows = np.empty((len(boxes), 5), dtype=np.float64)
+    rows[:, 0:2] = boxes[:, 0:2]
+    rows[:, 2:4] = boxes[:, 2:4] - boxes[:, 0:2] + 1
+    rows[:, 4] = boxes[:, 4]
+    return tuple(rows.ravel())
+
+
+def fddb_lines(image_name, boxes):
+    """ FDDB result of one image, n x 5 boxes """
+    return '%s \n%d\n' % (image_name, len(boxes)) + '%d %d %d %d %.4f\n' * len(boxes) % _xywh_scores(boxes)
+
+
+def wider_lines(image_name, boxes):
+    """ WIDER result file of one image, n x 5 boxes """
+    if len(boxes) == 0:
+        return '%s \n0 \n' % image_name
+    return '%s \n%d\n' % (image_name, len(boxes)) + '%d %d %d %d %.4f\n' * len(boxes) % _xywh_scores(boxes)
+
+
+def export_fddb(store, output_file, buffer_size=BUFFER_SIZE):
+    """ One FDDB result file of all images of store, in write order """
+    with open(output_file, 'w', buffer_size) as f:
+        for name, detections in store.items():
+            f.write(fddb_lines(name, detections.box_scores()))
+
+
+def export_wider(store, output_dir_root):
+    """ WIDER result files, <output_dir_root>/<event>/<image>.txt of every image name <event>/<image>.jpg """
+    made_dirs = set()
+    for name, detections in store.items():
+        event_dir, image_name = name.split('/')[-2:]
+        output_dir = os.path.join(output_dir_root, event_dir)
+        if output_dir not in made_dirs:
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            made_dirs.add(output_dir)
+        with open(os.path.join(output_dir, os.path.splitext(image_name)[0] + '.txt'), 'w') as f:
+            f.write(wider_lines(image_name, detections.box_scores()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export a result store to submission files',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('format', help='wider or fddb', choices=['wider', 'fddb'], type=str)
+    parser.add_argument('store', help='result store data file', type=str)
+    parser.add_argument('output', help='wider output dir or fddb output file', type=str)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with ResultStore(args.store) as store:
+        if args.format == 'wider':
+            export_wider(store, args.output)
+        else:
+            export_fddb(store, args.output)
+        print('%d images exported' % len(store))
@@ -0,0 +1,94 @@
+"""
+CPU throughput and memory of detector session layouts
+@@separate: one graph and session per net (default)
+@@shared: pnet, rnet and onet in one graph and session
+@@Every layout runs in a fresh process, peak RSS of the process is reported
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+# (name, shared_session, intra_op_threads, inter_op_threads), 0 lets tensorflow pick
+LAYOUTS = [('separate', False, 0, 0),
+           ('shared', True, 0, 0),
+           ('shared-intra1', True, 1, 0),
+           ('shared-1x1', True, 1, 1)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare shared and separate detector sessions on CPU',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--test_mode', dest='test_mode', help='test net type, can be pnet, rnet or onet',
+                        default='onet', type=str)
+    parser.add_argument('--prefix', dest='prefix', help='prefix of model name', nargs="+", type=str)
+    parser.add_argument('--epoch', dest='epoch', help='epoch number of model to load', nargs="+",
+                        default=[13, 16, 16], type=int)
+    parser.add_argument('--batch_size', dest='batch_size', help='list of batch size used in prediction', nargs="+",
+                        default=[2048, 256, 16], type=int)
+    parser.add_argument('--frozen', dest='frozen', help='load frozen .pb graphs', action='store_true')
+    parser.add_argument('--image_num', dest='image_num', help='images detected per layout', default=50, type=int)
+    parser.add_argument('--width', dest='width', help='synthetic image width', default=640, type=int)
+    parser.add_argument('--height', dest='height', help='synthetic image height', default=480, type=int)
+    parser.add_argument('--no_arena', dest='no_arena', help='allocate buffers per call, to compare peak RSS',
+                        action='store_true')
+    parser.add_argument('--layout', dest='layout', help='internal, run one layout and exit', default='', type=str)
+    args = parser.parse_args()
+    return args
+
+
+def synthetic_images(num, width, height, seed=0):
+    """ Smoothed noise, gives pnet a realistic number of candidates unlike a flat image
+    """
+    import cv2
+    rng = np.random.RandomState(seed)
+    images = list()
+    for _ in range(num):
+        image = rng.randint(0, 256, (height // 8, width // 8, 3)).astype(np.uint8)
+        images.append(cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR))
+    return images
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on linux and bytes on mac
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 / 1024.0 if sys.platform == 'darwin' else rss / 1024.0
+
+
+def run_layout(args, name):
+    """ Load all nets in one layout, warm up once and detect every image, prints one result line
+    """
+    from demo.detectAPI import DetectAPI
+    _, shared_session, intra_op_threads, inter_op_threads = [x for x in LAYOUTS if x[0] == name][0]
+    t = time.time()
+    api = DetectAPI(args.prefix, args.epoch, args.test_mode, args.batch_size, is_ERC=False,
+                    thresh=[0.6, 0.7, 0.7], min_face_size=24, frozen=args.frozen, shared_session=shared_session,
+                    intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads,
+                    buffer_arena=not args.no_arena)
+    load_time = time.time() - t
+    images = synthetic_images(args.image_num, args.width, args.height)
+    api.detect(images[0])
+    t = time.time()
+    for image in images:
+        api.detect(image)
+    cost = time.time() - t
+    print('result %.4f %.4f %.2f' % (load_time, len(images) / cost, peak_rss_mb()))
+
+
+def compare_layouts(args):
+    argv = sys.argv[1:]
+    print('%-14s %10s %12s %14s' % ('layout', 'load(s)', 'images/s', 'peak RSS(MB)'))
+    for name, _, _, _ in LAYOUTS:
+        out = subprocess.check_output([sys.executable, sys.argv[0], '--layout', name] + argv)
+        load_time, speed, rss = [float(x) for x in out.decode().strip().split('\n')[-1].split()[1:]]
+        print('%-14s %10.3f %12.2f %14.1f' % (name, load_time, speed, rss))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.layout:
+        run_layout(args, args.layout)
+    else:
+        compare_layouts(args)
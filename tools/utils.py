@@ -163,6 +163,58 @@ def pad(bboxes, w, h):
     return return_list
 
 
+def crop_resize_batch(img, dets, net_size, normalize=True, arena=None):
+    """Crop all candidate boxes and resize them to net_size in one call
+    Still one cv2.resize per box in a python loop, cv2 has no batched resize. What is shared is
+    memory: every box is resized into its slot of one output array, interior boxes are resampled
+    straight from image views, boxes crossing the border share one zero-filled scratch buffer,
+    so no temporary image is allocated per box.
+    Output is identical to padding every box with zeros and calling resize_image_by_wh,
+    a box entirely outside the image gives an all zero (before normalization) patch.
+    Note: like pad, the box coordinates of dets are clipped to the image in place.
+    Args:
+        img: Origin image, height x width x 3, uint8
+        dets: numpy array, n x 5, squared candidate boxes
+        net_size: Output patch size
+        normalize: False keeps uint8 patches for detectors normalizing on graph
+        arena: BufferArena the uint8 patches and scratch are taken from, new arrays if None
+
+    Returns:
+        Normalization patches, n x net_size x net_size x 3, float32 (uint8 if not normalize)
+    """
+    height, width, channel = img.shape
+    [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = pad(dets, width, height)
+    num_boxes = dets.shape[0]
+    shape = (num_boxes, net_size, net_size, channel)
+    patches = arena.get(('crops', net_size), shape, np.uint8) if arena else np.empty(shape, dtype=np.uint8)
+    dsize = (net_size, net_size)
+
+    border = (dx > 0) | (dy > 0) | (edx < tmpw - 1) | (edy < tmph - 1)
+    # pad clips one side only, such a box ends before it starts
+    outside = (ex < x) | (ey < y)
+    if border.any():
+        shape = (tmph[border].max(), tmpw[border].max(), channel)
+        scratch = arena.get('crop_scratch', shape, np.uint8) if arena else np.empty(shape, dtype=np.uint8)
+    for i in range(num_boxes):
+        if outside[i]:
+            patches[i] = 0
+            continue
+        if border[i]:
+            tmp = scratch[:tmph[i], :tmpw[i]]
+            tmp.fill(0)
+            tmp[dy[i]:edy[i] + 1, dx[i]:edx[i] + 1, :] = img[y[i]:ey[i] + 1, x[i]:ex[i] + 1, :]
+        else:
+            tmp = img[y[i]:ey[i] + 1, x[i]:ex[i] + 1, :]
+        cv2.resize(tmp, dsize, dst=patches[i], interpolation=cv2.INTER_AREA)
+
+    if not normalize:
+        return patches
+    cropped_ims = patches.astype(np.float32)
+    cropped_ims -= 127.5
+    cropped_ims *= 0.0078125
+    return cropped_ims
+
+
 def resize_image(img, scale):
     """
         resize image and transform dimention to [batchsize, channel, height, width]
@@ -200,7 +252,7 @@ def resize_image_by_wh(img, tuple_wh):
     return img_resized
 
 
-def calc_scale(image_height, image_width, min_face_size=24, scale_factor=0.709, pattern_size=12):
+def calc_scale(image_height, image_width, min_face_size=24, scale_factor=0.709, pattern_size=12, max_face_size=None):
     tuple_wh_scales = list()
     scales = list()
     current_scale = float(pattern_size) / min_face_size  # find initial scale
@@ -209,6 +261,9 @@ def calc_scale(image_height, image_width, min_face_size=24, scale_factor=0.709,
     while min(current_height, current_width) >= pattern_size:
         tuple_wh_scales.append((current_width, current_height))
         scales.append(current_scale)
+        # Coarser levels only find faces larger than max_face_size
+        if max_face_size is not None and pattern_size / current_scale >= max_face_size:
+            break
         current_scale *= scale_factor
         current_height = int(current_scale * image_height)
         current_width = int(current_scale * image_width)
@@ -216,7 +271,80 @@ def calc_scale(image_height, image_width, min_face_size=24, scale_factor=0.709,
     return scales, tuple_wh_scales
 
 
-def generate_bbox(cls_map, reg, scale, threshold):
+def pnet_map_size(length, stride=2, field=11):
+    """
+    Number of PNet(JDAP_12Net_wo_pooling) heat map cells along one image side.
+    Every cell only sees a field x field window, cells are stride apart.
+    """
+    return (length - field) // stride + 1
+
+
+def pnet_bucket_size(length, per_octave=8, align=16):
+    """
+    Bucket of a PNet input side, the smallest bucket >= length. Buckets are align multiples,
+    per_octave of them in every octave above 8 * align, so padding stays under 1 / per_octave
+    of the side and every octave has a handful of input shapes.
+    """
+    length = int(length)
+    step = max(align, (1 << (length.bit_length() - 1)) // per_octave)
+    return (length + step - 1) // step * step
+
+
+# Bytes one input pixel costs a PNet(JDAP_12Net_wo_pooling) forward pass: uint8 feed and float32
+# normalized input, conv1, conv2 and conv3 outputs on 1/4 of the pixels twice for PReLU temporaries,
+# cls and bbox maps
+PNET_BYTES_PER_PIXEL = 3 + 4 * 3 + 2 * (10 + 16 + 32) + (2 + 4 + 2)
+
+
+def calc_pnet_tiles(map_w, map_h, max_pixels, stride=2, field=11):
+    """
+    Split a PNet heat map into tiles whose input window has at most max_pixels pixels
+    (one cell at least). Tiles partition the cells, so no box is found twice, and their
+    input windows overlap by field - stride pixels, so every cell sees its whole window.
+    Args:
+        map_w, map_h: Heat map size, see pnet_map_size
+        max_pixels: Input pixels of one tile
+
+    Returns:
+        List of (cell_x, cell_y, cell_w, cell_h), row major
+    """
+    cells = lambda pixels: max((pixels - field) // stride + 1, 1)
+    tile_w = min(map_w, cells(int(np.sqrt(max_pixels))))
+    tile_h = min(map_h, cells(max_pixels // ((tile_w - 1) * stride + field)))
+    return [(x, y, min(tile_w, map_w - x), min(tile_h, map_h - y))
+            for y in range(0, map_h, tile_h) for x in range(0, map_w, tile_w)]
+
+
+def calc_mosaic_layout(scales_wh, stride=2, gutter=2):
+    """
+    Pack all pyramid levels into one canvas by shelves, largest level at top left.
+    Level offsets are stride aligned, so heat map cells of the canvas line up with
+    the cells of every level and no cell window covers two levels.
+    Args:
+        scales_wh: Pyramid level sizes (width, height) from calc_scale
+        stride: Network stride
+        gutter: Minimum empty pixels between two levels
+
+    Returns:
+        canvas_wh: Canvas size (width, height)
+        offsets: Top left (x, y) of every level in canvas
+    """
+    align = lambda v: (v + stride - 1) // stride * stride
+    canvas_w = scales_wh[0][0]
+    if len(scales_wh) > 1:
+        canvas_w = align(scales_wh[0][0] + gutter) + scales_wh[1][0]
+    offsets = list()
+    shelf_x, shelf_y, shelf_h = 0, 0, 0
+    for w, h in scales_wh:
+        if shelf_x + w > canvas_w:
+            shelf_x, shelf_y, shelf_h = 0, align(shelf_y + shelf_h + gutter), 0
+        offsets.append((shelf_x, shelf_y))
+        shelf_x = align(shelf_x + w + gutter)
+        shelf_h = max(shelf_h, h)
+    return (canvas_w, shelf_y + shelf_h), offsets
+
+
+def generate_bbox(cls_map, reg, scale, threshold, offset=(0, 0)):
     """ generate bbox from feature map
     Parameters:
     ----------
@@ -228,6 +356,8 @@ def generate_bbox(cls_map, reg, scale, threshold):
             scale of this detection
         threshold: float number
             detect threshold
+        offset: (x, y)
+            cell of map[0, 0] in the whole level map, for maps of a tile
     Returns:
     -------
         bbox array
@@ -245,10 +375,11 @@ def generate_bbox(cls_map, reg, scale, threshold):
     dx1, dy1, dx2, dy2 = [reg[t_index[0], t_index[1], i] for i in range(4)]
     reg = np.array([dx1, dy1, dx2, dy2])
     score = cls_map[t_index[0], t_index[1]]
-    boundingbox = np.vstack([np.round((stride*t_index[1])/scale),
-                             np.round((stride*t_index[0])/scale),
-                             np.round((stride*t_index[1]+cellsize)/scale - 1),
-                             np.round((stride*t_index[0]+cellsize)/scale - 1),
+    cell_x, cell_y = t_index[1] + offset[0], t_index[0] + offset[1]
+    boundingbox = np.vstack([np.round((stride*cell_x)/scale),
+                             np.round((stride*cell_y)/scale),
+                             np.round((stride*cell_x+cellsize)/scale - 1),
+                             np.round((stride*cell_y+cellsize)/scale - 1),
                              score.T,
                              reg])
 